@@ -0,0 +1,249 @@
+import numpy as np
+import pandas as pd
+
+from regions import default as regions_default
+
+# bit widths used to pack several coded dimensions into one int64 key
+# ('pin' is a pincode value + 1, 'place' a (state, district) pair of the joined view)
+KEY_BITS = {'state': 15, 'state_norm': 15, 'district': 24, 'pincode': 24, 'day': 24, 'leaf': 32, 'week': 24,
+            'pin': 20, 'place': 19, 'state_raw': 15, 'district_raw': 24}
+# Codebook place table entry of a raw (state, district) pair not seen yet
+UNRESOLVED = -2
+
+
+class KeyCodec:
+    # stable value -> integer code mapping; a code never changes once assigned,
+    # so arrays indexed by code can keep growing across chunks and files
+    def __init__(self, values=(), dtype=object):
+        self.dtype = dtype
+        self.index = pd.Index(list(values), dtype=dtype)
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def values(self):
+        return self.index.to_numpy()
+
+    def encode(self, values):
+        # factorize the chunk, then resolve only its distinct values against the
+        # known keys; missing values get -1
+        if isinstance(getattr(values, 'dtype', None), pd.CategoricalDtype):
+            # already dictionary-encoded: resolve the categories, remap the codes
+            lookup = np.append(self.encode(np.asarray(values.cat.categories, dtype=self.dtype)), -1)
+            return lookup[values.cat.codes.to_numpy()]
+        codes, uniques = pd.factorize(np.asarray(values, dtype=self.dtype), use_na_sentinel=True)
+        if len(uniques) == 0:
+            return codes.astype(np.int64)
+        known = self.index.get_indexer(uniques)
+        new = known < 0
+        if new.any():
+            start = len(self.index)
+            self.index = self.index.append(pd.Index(uniques[new], dtype=self.dtype))
+            known[new] = np.arange(start, start + int(new.sum()))
+        lookup = np.append(known, -1).astype(np.int64)
+        return lookup[codes]
+
+    def decode(self, codes):
+        return self.values[codes]
+
+    def lookup(self, values):
+        # codes for already-known values without registering new ones
+        return self.index.get_indexer(pd.Index(list(values), dtype=self.dtype))
+
+
+class Codebook:
+    # one codec per dimension, shared by every accumulator fed from the same
+    # scan. 'state' and 'district' hold canonical names from the region table;
+    # the spellings found in the files are coded under 'state_raw' and
+    # 'district_raw'
+    def __init__(self, dates=None, regions=None):
+        self.codecs = {'state': KeyCodec(), 'district': KeyCodec(), 'pincode': KeyCodec(), 'state_norm': KeyCodec(),
+                       'state_raw': KeyCodec(), 'district_raw': KeyCodec()}
+        # dates.DateDecoder used for raw date strings
+        self.dates = dates
+        self.regions = regions or regions_default()
+        # raw state code -> state_norm code
+        self._norm = np.zeros(0, dtype=np.int64)
+        # (raw state code + 1, raw district code + 1) -> canonical state and
+        # district codes, grown as the raw codecs grow
+        self._places = np.full((2, 0, 0), UNRESOLVED, dtype=np.int32)
+
+    def __getitem__(self, dim):
+        return self.codecs[dim]
+
+    def __contains__(self, dim):
+        return dim in self.codecs
+
+    def encode(self, dim, values):
+        return self.codecs[dim].encode(values)
+
+    def places(self, states, districts):
+        # raw state and district codes (-1 where missing) -> canonical state
+        # and district codes. Each distinct raw pair goes through the region
+        # table once, however many rows, chunks and files carry it; after
+        # that a chunk costs two lookups in a small dense table
+        n_states, n_districts = len(self.codecs['state_raw']) + 1, len(self.codecs['district_raw']) + 1
+        _, rows, cols = self._places.shape
+        if n_states > rows or n_districts > cols:
+            grown = np.full((2, max(n_states, 2 * rows), max(n_districts, 2 * cols)), UNRESOLVED, dtype=np.int32)
+            grown[:, :rows, :cols] = self._places
+            self._places = grown
+        flat = (states + 1) * self._places.shape[2] + (districts + 1)
+        table = self._places.reshape(2, -1)
+        state = table[0][flat]
+        todo = state == UNRESOLVED
+        if todo.any():
+            self._resolve(np.unique(flat[todo]))
+            state = table[0][flat]
+        return state.astype(np.int64), table[1][flat].astype(np.int64)
+
+    def _resolve(self, flat):
+        raw_states = np.append(self.codecs['state_raw'].values, None)
+        raw_districts = np.append(self.codecs['district_raw'].values, None)
+        state, district = np.divmod(flat, self._places.shape[2])
+        names = [self.regions.resolve(s, d)[:2] for s, d in zip(raw_states[state - 1], raw_districts[district - 1])]
+        table = self._places.reshape(2, -1)
+        table[0][flat] = self.codecs['state'].encode(np.array([s for s, _ in names], dtype=object))
+        table[1][flat] = self.codecs['district'].encode(np.array([d for _, d in names], dtype=object))
+
+    def normalized_states(self, codes):
+        # canonical state codes -> codes of the lower-cased name; each
+        # distinct state is normalized once, however many rows carry it
+        codec = self.codecs['state']
+        done = len(self._norm)
+        if done < len(codec):
+            names = pd.Series(codec.values[done:], dtype=object).str.strip().str.lower()
+            self._norm = np.concatenate([self._norm, self.codecs['state_norm'].encode(names)])
+        return np.append(self._norm, -1)[codes]
+
+
+def pack_keys(dims, codes):
+    key = np.zeros(len(codes[0]), dtype=np.int64)
+    for dim, c in zip(dims, codes):
+        bits = KEY_BITS[dim]
+        if len(c) and int(c.max()) >= (1 << bits):
+            raise ValueError(f'too many distinct {dim} keys to pack ({int(c.max()) + 1})')
+        key = (key << bits) | c.astype(np.int64)
+    return key
+
+
+def unpack_keys(dims, key):
+    out = []
+    for dim in reversed(dims):
+        bits = KEY_BITS[dim]
+        out.append(key & ((1 << bits) - 1))
+        key = key >> bits
+    return out[::-1]
+
+
+class KeyedSum:
+    # running (keys x columns) int64 totals; dims are codebook dimensions whose
+    # codes index the rows directly, or are packed into a composite slot key
+    def __init__(self, dims, codebook):
+        self.dims = tuple(dims)
+        self.codebook = codebook
+        self.slots = KeyCodec(dtype=np.int64) if len(self.dims) > 1 else None
+        self.columns = []
+        self.totals = np.zeros((0, 0), dtype=np.int64)
+        # source rows behind each key; codec-indexed slots can belong to keys
+        # this accumulator never saw, and retracted keys drop back to zero
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        if self.slots is not None:
+            return len(self.slots)
+        return len(self.codebook[self.dims[0]])
+
+    def _column_index(self, columns):
+        for c in columns:
+            if c not in self.columns:
+                self.columns.append(c)
+        idx = np.array([self.columns.index(c) for c in columns], dtype=np.intp)
+        return idx
+
+    def _grow(self, n_rows):
+        rows, cols = self.totals.shape
+        if n_rows <= rows and len(self.columns) <= cols:
+            return
+        grown = np.zeros((max(n_rows, rows * 2), len(self.columns)), dtype=np.int64)
+        grown[:rows, :cols] = self.totals
+        self.totals = grown
+        counts = np.zeros(len(grown), dtype=np.int64)
+        counts[:len(self.counts)] = self.counts
+        self.counts = counts
+
+    def add(self, codes, values, columns, counts=None):
+        # codes: one code array per dim; values: (rows x len(columns)) counts;
+        # counts: source rows behind each value row (1 each by default)
+        valid = np.ones(len(values), dtype=bool)
+        for c in codes:
+            valid &= c >= 0
+        if counts is None:
+            counts = np.ones(len(values), dtype=np.int64)
+        if not valid.all():
+            codes = [c[valid] for c in codes]
+            values = values[valid]
+            counts = counts[valid]
+        if self.slots is not None:
+            slot = self.slots.encode(pack_keys(self.dims, codes))
+        else:
+            slot = codes[0]
+        col_idx = self._column_index(columns)
+        self._grow(len(self))
+        if len(slot) == 0:
+            return
+        block = np.zeros((len(slot), len(self.columns)), dtype=np.int64)
+        block[:, col_idx] = values
+        np.add.at(self.totals, slot, block)
+        np.add.at(self.counts, slot, counts)
+
+    def rows(self):
+        # slots holding data, in slot order
+        return np.flatnonzero(self.counts[:len(self)] > 0)
+
+    def key_codes(self, rows):
+        # per-dim codes for the given slots
+        if self.slots is None:
+            return [rows.astype(np.int64)]
+        packed = np.asarray(self.slots.values, dtype=np.int64)[rows]
+        return unpack_keys(self.dims, packed)
+
+    def to_frame(self, index_name='key'):
+        # one row per key, age columns sorted, plus total_updates; built from the
+        # arrays directly, no per-key Python loop
+        rows = self.rows()
+        cols = sorted(self.columns)
+        order = [self.columns.index(c) for c in cols]
+        df = pd.DataFrame(self.totals[rows][:, order] if len(rows) else np.zeros((0, len(cols)), dtype=np.int64),
+                          columns=cols)
+        keys = self.key_codes(rows)
+        if len(self.dims) == 1:
+            df.index = pd.Index(self.codebook[self.dims[0]].decode(keys[0]), name=index_name)
+        else:
+            df.index = pd.MultiIndex.from_arrays(self._decode(keys), names=list(self.dims))
+        if not df.empty:
+            df['total_updates'] = df.sum(axis=1)
+            # ties are broken by key so the order does not depend on code order
+            df = df.sort_index().sort_values('total_updates', ascending=False, kind='stable')
+        return df
+
+    def _decode(self, keys):
+        return [self.codebook[d].decode(k) if d in self.codebook else k for d, k in zip(self.dims, keys)]
+
+    def partial(self):
+        # picklable snapshot keyed by decoded values, so it can be merged into an
+        # accumulator with a different codebook
+        rows = self.rows()
+        return {
+            'keys': self._decode(self.key_codes(rows)),
+            'columns': list(self.columns),
+            'totals': self.totals[rows, :len(self.columns)],
+            'counts': self.counts[rows],
+        }
+
+    def merge(self, partial, sign=1):
+        # sign=-1 retracts a partial that was merged earlier
+        codes = [self.codebook.encode(d, k) if d in self.codebook else np.asarray(k, dtype=np.int64)
+                 for d, k in zip(self.dims, partial['keys'])]
+        self.add(codes, sign * partial['totals'], partial['columns'], sign * partial['counts'])
@@ -1,238 +1,332 @@
 import os
-import glob
+import json
+import argparse
 import pandas as pd
-from collections import defaultdict
-import matplotlib.pyplot as plt
-from statsmodels.tsa.holtwinters import ExponentialSmoothing
+
+import instrument
+from cache import ColumnarCache
+from incremental import IncrementalStore
+from model_store import ModelStore, MAX_BYTES as MODEL_STORE_BYTES
+from parallel import scan_folder_parallel
+from cube import build as build_cube
+from dates import date_format
+from pipeline import Pipeline, Stage
+from hierarchy import RECONCILERS, hierarchical_forecasts, display_names
+from join import join as join_sides, write_reports as write_joined_reports
+from forecast import (ENGINES, HORIZON_WEEKS, SERIES_TIMEOUT, SeriesIndex, run_forecasts, with_display_names,
+                      write_forecasts, series_frame, indicators)
+from reader import ReaderProfile, parse_size
+from regions import default as regions_default, match_summary, state_keys, unmatched
+from render import chart, manifest_entry, render_charts
+from serve import mark_run
+from scan import list_csv_files, new_codebook, make_aggregators, scan_folder
+from sketches import MODES as HOTSPOT_MODES
+from spikes import Detector, write_alerts
 
 BASE_DIR = os.path.dirname(os.path.dirname(__file__))
 DEMO_DIR = os.path.join(BASE_DIR, 'api_data_aadhar_demographic')
 BIO_DIR = os.path.join(BASE_DIR, 'api_data_aadhar_biometric')
 OUT_DIR = os.path.join(BASE_DIR, 'analysis', 'outputs')
 os.makedirs(OUT_DIR, exist_ok=True)
-
-CHUNKSIZE = 200_000
-DATE_COL = 'date'
-
-
-def clean_columns(cols):
-    return [c.strip().lower().replace(' ', '_') for c in cols]
-
-
-def accumulate_from_folder(folder, prefix):
-    # prefix: 'demo' or 'bio'
-    state_acc = defaultdict(lambda: defaultdict(int))
-    district_acc_gujarat = defaultdict(lambda: defaultdict(int))
-    file_list = sorted(glob.glob(os.path.join(folder, '*.csv')))
-    for fp in file_list:
-        for chunk in pd.read_csv(fp, chunksize=CHUNKSIZE):
-            chunk.columns = clean_columns(chunk.columns)
-            # find age columns matching prefix
-            age_cols = [c for c in chunk.columns if c.startswith(f'{prefix}_age')]
-            if not age_cols:
-                continue
-            # ensure state and district columns exist
-            if 'state' not in chunk.columns:
-                continue
-            # fillna for age cols
-            chunk[age_cols] = chunk[age_cols].fillna(0)
-            # group by state
-            grp_state = chunk.groupby('state')[age_cols].sum()
-            for state, row in grp_state.iterrows():
-                for col in age_cols:
-                    state_acc[state][col] += int(row[col])
-            # Gujarat district accum
-            gch = chunk[chunk['state'].str.strip().str.lower() == 'gujarat']
-            if not gch.empty and 'district' in gch.columns:
-                grp_dist = gch.groupby('district')[age_cols].sum()
-                for dist, row in grp_dist.iterrows():
-                    for col in age_cols:
-                        district_acc_gujarat[dist][col] += int(row[col])
-    return state_acc, district_acc_gujarat
-
-
-def dict_to_df(acc):
-    # acc: dict key-> dict(col->value)
-    rows = []
-    cols = set()
-    for k, sub in acc.items():
-        cols.update(sub.keys())
-    cols = sorted(cols)
-    for k, sub in acc.items():
-        row = {'key': k}
-        for c in cols:
-            row[c] = sub.get(c, 0)
-        rows.append(row)
-    df = pd.DataFrame(rows)
-    if not df.empty:
-        df = df.set_index('key')
-        # add total
-        df['total_updates'] = df.sum(axis=1)
-        df = df.sort_values('total_updates', ascending=False)
-    return df
-
-
-def main():
-    print('Processing demographic files...')
-    state_demo, guj_demo = accumulate_from_folder(DEMO_DIR, 'demo')
-    print('Processing biometric files...')
-    state_bio, guj_bio = accumulate_from_folder(BIO_DIR, 'bio')
-
-    df_state_demo = dict_to_df(state_demo)
-    df_state_bio = dict_to_df(state_bio)
-    df_guj_demo = dict_to_df(guj_demo)
-    df_guj_bio = dict_to_df(guj_bio)
+# insight and recommendation text of the report, the PDF and the slides
+NARRATIVE = os.path.join(BASE_DIR, 'analysis', 'narrative.json')
+# modules whose code decides what a scan of a dataset folder yields
+SCAN_CODE = ('scan.py', 'accumulators.py', 'reader.py', 'schema.py', 'dates.py', 'regions.py', 'regions.csv',
+             'cube.py', 'join.py', 'sketches.py', 'spill.py', 'cache.py', 'parallel.py', 'incremental.py')
+
+
+def scan_dataset(folder, prefix, daily=False, cache=None, workers=1, incremental=False, profile=None,
+                 daily_memory=None, pincode=False, hotspots=None, joined=False, spikes=False):
+    # one read of the folder feeds state totals, district totals for every
+    # state, the cube cells and (optionally) the daily state/district/date
+    # series, the weekly pincode leaves, the pincode hot spots and the daily
+    # pincode series of the spike detector
+    agg_kwargs = {'daily': daily, 'daily_memory': daily_memory, 'cube': True}
+    if pincode:
+        agg_kwargs['pincode'] = True
+    if hotspots:
+        agg_kwargs['hotspots'] = hotspots
+    if joined:
+        agg_kwargs['joined'] = True
+        agg_kwargs['daily_memory'] = daily_memory
+    if spikes:
+        agg_kwargs['spikes'] = True
+        agg_kwargs['daily_memory'] = daily_memory
+    if incremental:
+        store = IncrementalStore(prefix, prefix, agg_kwargs)
+        results = store.update(folder, cache=cache, workers=workers, profile=profile)
+        print('  files: {new} new, {changed} changed, {removed} removed, {unchanged} unchanged'.format(**store.stats))
+        return results
+    if workers > 1:
+        return scan_folder_parallel(folder, prefix, workers, agg_kwargs, profile=profile, cache=cache)
+    codebook = new_codebook(prefix)
+    aggregators = make_aggregators(codebook, **agg_kwargs)
+    return scan_folder(folder, prefix, aggregators, codebook, profile=profile, cache=cache)
+
+
+def parse_states(value):
+    # None selects every state
+    if value.strip().lower() == 'all':
+        return None
+    # any spelling the region table knows selects the state
+    return state_keys([s for s in value.split(',') if s.strip()])
+
+
+def state_display_names(df_state):
+    # normalized state -> its canonical name, highest state first
+    names = {}
+    for raw in df_state.index:
+        names.setdefault(str(raw).strip().lower(), raw)
+    return names
+
+
+def district_frames(df_district, df_state, states):
+    # {state name: per-district frame} for the selected states, sliced from the
+    # all-states district totals
+    if df_district.empty:
+        return {}
+    present = set(df_district.index.get_level_values('state_norm'))
+    frames = {}
+    for norm, name in state_display_names(df_state).items():
+        if norm not in present or (states is not None and norm not in states):
+            continue
+        df = df_district.xs(norm, level='state_norm')
+        df.index.name = 'key'
+        frames[name] = df
+    return frames
+
+
+def slug(name):
+    return str(name).replace(' ', '_')
+
+
+def arg_parser(add_help=True):
+    # also the parent of pipeline.py's parser
+    parser = argparse.ArgumentParser(description='Aggregate, chart and forecast Aadhaar update datasets.',
+                                     add_help=add_help)
+    parser.add_argument('--no-cache', action='store_true',
+                        help='parse the source CSVs directly instead of using the columnar cache')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='ingest with a pool of N processes, split by file and by range within large files')
+    parser.add_argument('--incremental', action='store_true',
+                        help='fold only new or changed files into the aggregates persisted by the previous run')
+    parser.add_argument('--memory-budget', type=parse_size, default=None,
+                        help="working memory for ingestion, e.g. '512M' or '4G'; chunk sizes are derived from it")
+    parser.add_argument('--daily-memory', type=parse_size, default=None,
+                        help="memory cap for the daily series before it spills sorted runs to disk (default 256M)")
+    parser.add_argument('--engine', choices=['c', 'pyarrow'], default='c',
+                        help='CSV parser engine (pyarrow is optional)')
+    parser.add_argument('--forecast-workers', type=int, default=os.cpu_count(),
+                        help='processes used to fit the per-series forecasts')
+    parser.add_argument('--forecast-engine', choices=ENGINES, default='statsmodels',
+                        help="'batch' fits every series at once in vectorized NumPy (hw_batch.py)")
+    parser.add_argument('--forecast-timeout', type=float, default=SERIES_TIMEOUT,
+                        help='seconds one series may spend fitting before falling back to its mean')
+    parser.add_argument('--no-model-cache', action='store_true',
+                        help='refit every forecast instead of reusing stored models for unchanged series')
+    parser.add_argument('--model-cache-size', type=parse_size, default=MODEL_STORE_BYTES,
+                        help='size cap of the forecast model store; least recently used models are evicted')
+    parser.add_argument('--hierarchy', choices=RECONCILERS, default=None,
+                        help='also write coherent India/state/district/pincode forecasts reconciled this way')
+    parser.add_argument('--hotspots', choices=HOTSPOT_MODES, default=None,
+                        help='write the top pincodes per state, district and week (sketched, or exact)')
+    parser.add_argument('--joined', action='store_true',
+                        help='join demographic and biometric cells and write ratio and divergence reports')
+    parser.add_argument('--spikes', action='store_true',
+                        help='alert on days far above normal in any state, district or pincode daily series')
+    parser.add_argument('--chart-workers', type=int, default=os.cpu_count(),
+                        help='processes used to render charts')
+    parser.add_argument('--states', default='gujarat',
+                        help="comma-separated states for district summaries, charts and forecasts, or 'all'")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='threads running independent stages side by side (the scans, charts and indicators)')
+    parser.add_argument('--profile', action='store_true',
+                        help='also run cProfile and tracemalloc and add the hot spots to the run report')
+    parser.add_argument('--trace', default=None,
+                        help='write the run stages as a Chrome trace-event file (chrome://tracing, Perfetto)')
+    return parser
+
+
+def parse_args(argv=None):
+    return arg_parser().parse_args(argv)
+
+
+def read_narrative(path):
+    # the prose of the report, the PDF and the slides; each reads only its own
+    # part, so editing one rebuilds only that document
+    with open(path) as f:
+        text = json.load(f)
+    return {'report_text': text['report'], 'pdf_text': text['pdf'], 'slide_text': text['slides']}
+
+
+def ingest(folder, prefix, label, daily, pincode, hotspots, joined, daily_memory, workers, incremental, engine,
+           memory_budget, no_cache, spikes=False):
+    print(f'Processing {label} files...')
+    profile = ReaderProfile(engine=engine, memory_budget=memory_budget)
+    cache = None if no_cache else ColumnarCache(profile=profile)
+    res = scan_dataset(folder, prefix, daily=daily, cache=cache, workers=workers, incremental=incremental,
+                       profile=profile, daily_memory=daily_memory, pincode=pincode, hotspots=hotspots, joined=joined,
+                       spikes=spikes)
+    instrument.fields()['workers'] = workers
+    if cache is not None:
+        print(f'Columnar cache ({label}): {cache.hits} hits, {cache.misses} misses')
+    bad = res.get('dates')
+    if bad is not None and not bad.empty:
+        print(f'Warning: {bad["rows"].sum()} {label} rows have dates not matching {date_format(prefix)} '
+              f'and were left out of the daily series (e.g. {", ".join(bad["value"].head(3))})')
+    return {prefix: res}
+
+
+def aggregate(demo, bio, states):
+    # every raw state/district spelling and the canonical name it was counted under
+    matches = pd.concat([demo['regions'].assign(dataset='demo'), bio['regions'].assign(dataset='bio')],
+                        ignore_index=True)
+    missing = unmatched(matches)
+    if not missing.empty:
+        print(f'Warning: {missing["rows"].sum()} rows carry {len(missing)} state/district names the region table '
+              f'does not know (e.g. {", ".join(missing["raw_state"].astype(str).unique()[:3])}); '
+              f'see outputs/region_matches.csv')
+
+    states = parse_states(states)
+    # summaries are read back from the cubes, which stay on disk for queries
+    demo_cube = build_cube(demo['cube'], 'demo')
+    bio_cube = build_cube(bio['cube'], 'bio')
+    df_state_demo = demo_cube.totals('state')
+    df_state_bio = bio_cube.totals('state')
+    dist_demo = district_frames(demo_cube.totals('district'), df_state_demo, states)
+    dist_bio = district_frames(bio_cube.totals('district'), df_state_bio, states)
 
     # Save outputs
-    df_state_demo.to_csv(os.path.join(OUT_DIR, 'state_summary_demographic.csv'))
-    df_state_bio.to_csv(os.path.join(OUT_DIR, 'state_summary_biometric.csv'))
-    df_guj_demo.to_csv(os.path.join(OUT_DIR, 'gujarat_demographic_by_district.csv'))
-    df_guj_bio.to_csv(os.path.join(OUT_DIR, 'gujarat_biometric_by_district.csv'))
-
-    # Create simple bar charts
-    def make_bar(series, title, outpath):
-        plt.figure(figsize=(10, 6))
-        series.plot(kind='bar', color='C0')
-        plt.title(title)
-        plt.ylabel('Total updates')
-        plt.tight_layout()
-        plt.savefig(outpath)
-        plt.close()
-
-    if not df_state_demo.empty:
-        make_bar(df_state_demo['total_updates'].head(10), 'Top 10 States by Demographic Updates', os.path.join(OUT_DIR, 'state_demographic_top10.png'))
-    if not df_state_bio.empty:
-        make_bar(df_state_bio['total_updates'].head(10), 'Top 10 States by Biometric Updates', os.path.join(OUT_DIR, 'state_biometric_top10.png'))
-    if not df_guj_demo.empty:
-        make_bar(df_guj_demo['total_updates'].head(15), 'Top Gujarat Districts (Demographic)', os.path.join(OUT_DIR, 'gujarat_demographic_top15.png'))
-    if not df_guj_bio.empty:
-        make_bar(df_guj_bio['total_updates'].head(15), 'Top Gujarat Districts (Biometric)', os.path.join(OUT_DIR, 'gujarat_biometric_top15.png'))
-
-    # --- Forecasting (Holt-Winters) for top 5 states and Gujarat top 5 districts ---
+    written = [os.path.join(OUT_DIR, 'state_summary_demographic.csv'),
+               os.path.join(OUT_DIR, 'state_summary_biometric.csv')]
+    df_state_demo.to_csv(written[0])
+    df_state_bio.to_csv(written[1])
+    for label, frames in (('demographic', dist_demo), ('biometric', dist_bio)):
+        for name, df in frames.items():
+            written.append(os.path.join(OUT_DIR, f'{slug(name).lower()}_{label}_by_district.csv'))
+            df.to_csv(written[-1])
+    if 'hotspots' in demo:
+        written.append(os.path.join(OUT_DIR, 'pincode_hotspots.csv'))
+        demo['hotspots'].to_csv(written[-1], index=False)
+    written.append(os.path.join(OUT_DIR, 'region_matches.csv'))
+    matches.to_csv(written[-1], index=False)
+
+    bad_dates = {label: res['dates'] for label, res in (('demographic', demo), ('biometric', bio))
+                 if 'dates' in res and not res['dates'].empty}
+    summaries = {'state_demo': df_state_demo, 'state_bio': df_state_bio, 'dist_demo': dist_demo,
+                 'dist_bio': dist_bio, 'hotspots': demo.get('hotspots'), 'matches': matches,
+                 'regions': regions_default().version, 'bad_dates': bad_dates}
+    return {'summaries': summaries, 'written': written}
+
+
+def join_stage(demo, bio, daily_memory):
+    # demographic x biometric on (state, district, pincode, day), merged
+    # from both sides' sorted cells block by block
+    totals, by_day, summary = join_sides(demo['joined'], bio['joined'], memory_cap=daily_memory)
+    ratios, div, written = write_joined_reports(totals, by_day, OUT_DIR)
+    instrument.fields()['cells'] = summary['rows']
+    print(f'Joined view: {summary["rows"]:,} cells, {summary["keys_both"]:,} with both updates, '
+          f'{summary["keys_demo_only"]:,} demographic only, {summary["keys_bio_only"]:,} biometric only')
+    return {'joined': (ratios, div), 'written': written}
+
+
+def spike_stage(demo):
+    # folds the days not seen by the previous run into the per-series
+    # running statistics in .cache/spikes and writes the ranked alerts
+    detector = Detector('demo')
+    detector.update(demo['pincode_daily'])
+    detector.save()
+    written = write_alerts(detector.alerts, detector.last_day, OUT_DIR)
+    stats = detector.stats
+    instrument.fields().update(days=stats['days'], alerts=stats['alerts'], rebuilt=stats['rebuilt'])
+    print(f'Demand spikes: {stats["days"]} new days folded{" (history changed, refolded)" if stats["rebuilt"] else ""}'
+          f', {stats["alerts"]} new alerts, {len(detector.alerts)} in all')
+    return {'spikes': (detector.alerts, detector.last_day), 'written': written}
+
+
+def forecast_stage(demo, engine, timeout, workers, model_cache, model_cache_size):
+    # Holt-Winters for every state and district series
     forecast_dir = os.path.join(OUT_DIR, 'forecasts')
     os.makedirs(forecast_dir, exist_ok=True)
+    index = SeriesIndex(demo['daily'])
+    tasks = index.tasks(HORIZON_WEEKS, timeout)
+    print(f'Forecasting {len(tasks)} series...')
+    instrument.fields()['series'] = len(tasks)
+    models = ModelStore(max_bytes=model_cache_size) if model_cache else None
+    forecasts = run_forecasts(tasks, workers, engine, models)
+    forecasts = with_display_names(forecasts, index)
+    if models is not None:
+        print('Model store: {hits} reused, {warm} warm refits, {misses} fitted, {evicted} evicted'.format(**models.stats()))
+    forecast_path = write_forecasts(forecasts, forecast_dir)
+    timed_out = int((forecasts.drop_duplicates(['kind', 'state', 'district'])['method'] == 'timeout').sum())
+    if timed_out:
+        print(f'Warning: {timed_out} forecast fits exceeded {timeout}s and fell back to the mean')
+    return {'forecasts': forecasts, 'series_names': (index.state_names, index.district_names),
+            'written': [forecast_path]}
+
+
+def hierarchy_stage(demo, method, workers):
+    # coherent forecasts over India -> state -> district -> pincode
+    tree, coherent, timing = hierarchical_forecasts(demo['pincode'], method, HORIZON_WEEKS, workers)
+    instrument.fields().update(method=method, nodes=len(tree))
+    coherent = display_names(coherent, demo['pincode'])
+    path = write_forecasts(coherent, os.path.join(OUT_DIR, 'forecasts'), 'hierarchy_forecasts')
+    print(f'Hierarchical forecasts ({method}): {len(tree)} nodes in '
+          f'{sum(timing.values()):.1f}s -> {os.path.relpath(path, BASE_DIR)}')
+    return {'hierarchy': coherent, 'written': [path]}
+
+
+def chart_stage(summaries, forecasts, series_names, workers):
+    # every chart of the run, collected as specs and drawn together by
+    # render_charts; returns their manifest entries and the highlighted
+    # forecast series
+    df_state_demo, df_state_bio = summaries['state_demo'], summaries['state_bio']
+    dist_demo, dist_bio = summaries['dist_demo'], summaries['dist_bio']
+    state_names, district_names = series_names
+    forecast_dir = os.path.join(OUT_DIR, 'forecasts')
+    charts = []
+    highlights = {}
 
-    def build_daily_aggregates(folder, prefix):
-        # returns DataFrame with columns ['state','district','date','total_updates']
-        rows = []
-        file_list = sorted(glob.glob(os.path.join(folder, '*.csv')))
-        for fp in file_list:
-            for chunk in pd.read_csv(fp, chunksize=CHUNKSIZE):
-                chunk.columns = clean_columns(chunk.columns)
-                date_col = DATE_COL if DATE_COL in chunk.columns else 'date'
-                age_cols = [c for c in chunk.columns if c.startswith(f'{prefix}_age')]
-                if not age_cols or 'state' not in chunk.columns:
-                    continue
-                # total updates per row
-                chunk['total_updates'] = chunk[age_cols].fillna(0).sum(axis=1)
-                # parse date
-                try:
-                    chunk['date'] = pd.to_datetime(chunk[date_col], dayfirst=True, errors='coerce')
-                except Exception:
-                    chunk['date'] = pd.to_datetime(chunk[date_col], errors='coerce')
-                chunk = chunk.dropna(subset=['date'])
-                grp = chunk.groupby(['state', 'district', 'date'])['total_updates'].sum().reset_index()
-                rows.append(grp)
-        if rows:
-            df = pd.concat(rows, ignore_index=True)
-            return df
-        return pd.DataFrame(columns=['state', 'district', 'date', 'total_updates'])
-
-    demo_daily = build_daily_aggregates(DEMO_DIR, 'demo')
-
-    def fit_and_forecast(series, periods):
-        # resample weekly to reduce noise
-        s = series.resample('W').sum()
-        # choose seasonal if enough data
-        seasonal = None
-        sp = None
-        if len(s) >= 26:
-            # assume yearly seasonality on weekly data (~52)
-            seasonal = 'add'
-            sp = 52
-        try:
-            model = ExponentialSmoothing(s, trend='add', seasonal=seasonal, seasonal_periods=sp, damped_trend=False)
-            fit = model.fit(optimized=True)
-            fc = fit.forecast(periods)
-            return s, fc
-        except Exception:
-            # fallback: simple last-value repeat
-            fc = pd.Series([s.mean()] * periods, index=pd.date_range(s.index[-1] + pd.Timedelta(weeks=1), periods=periods, freq='W'))
-            return s, fc
-
-    horizon_weeks = 12  # ~3 months
-
-    # Top 5 states by demographic totals
-    top_states = []
-    if not df_state_demo.empty:
-        top_states = list(df_state_demo.index[:5])
+    def make_bar(series, title, outpath, group='top', state=''):
+        charts.append(chart('bar', outpath, series, title, group=group, state=state))
 
+    if not df_state_demo.empty:
+        make_bar(df_state_demo['total_updates'].head(10), 'Top 10 States by Demographic Updates', 'state_demographic_top10.png')
+    if not df_state_bio.empty:
+        make_bar(df_state_bio['total_updates'].head(10), 'Top 10 States by Biometric Updates', 'state_biometric_top10.png')
+    for name, df in dist_demo.items():
+        make_bar(df['total_updates'].head(15), f'Top {name} Districts (Demographic)', f'{slug(name).lower()}_demographic_top15.png',
+                 'districts', name)
+    for name, df in dist_bio.items():
+        make_bar(df['total_updates'].head(15), f'Top {name} Districts (Biometric)', f'{slug(name).lower()}_biometric_top15.png',
+                 'districts', name)
+
+    def save_forecast(df, title, stem, state=''):
+        # per-series CSV and chart for the highlighted series
+        df.to_csv(os.path.join(forecast_dir, f'{stem}_forecast.csv'))
+        highlights[stem] = df
+        charts.append(chart('forecast', f'forecasts/{stem}_forecast.png', df, title, group='forecast', state=state))
+
+    # highlighted: top 5 states and the top 5 districts of each selected state
+    top_states = list(df_state_demo.index[:5]) if not df_state_demo.empty else []
     for st in top_states:
-        ser = demo_daily[demo_daily['state'].str.strip().str.lower() == st.strip().lower()]
-        if ser.empty:
-            continue
-        ts = ser.groupby('date')['total_updates'].sum()
-        ts.index = pd.to_datetime(ts.index)
-        hist, fc = fit_and_forecast(ts, horizon_weeks)
-        # save CSV and chart
-        out_csv = os.path.join(forecast_dir, f'state_{st.replace(" ","_")}_forecast.csv')
-        pd.concat([hist.rename('historical'), fc.rename('forecast')], axis=1).to_csv(out_csv)
-        plt.figure(figsize=(10, 5))
-        hist.plot(label='historical')
-        fc.plot(label='forecast')
-        plt.title(f'Weekly updates - {st}')
-        plt.legend()
-        plt.tight_layout()
-        plt.savefig(os.path.join(forecast_dir, f'state_{st.replace(" ","_")}_forecast.png'))
-        plt.close()
-
-    # Gujarat top 5 districts (demographic)
-    guj = df_guj_demo
-    guj_top5 = list(guj.index[:5]) if not guj.empty else []
-    for dist in guj_top5:
-        ser = demo_daily[(demo_daily['state'].str.strip().str.lower() == 'gujarat') & (demo_daily['district'].str.strip().str.lower() == dist.strip().lower())]
-        if ser.empty:
-            continue
-        ts = ser.groupby('date')['total_updates'].sum()
-        ts.index = pd.to_datetime(ts.index)
-        hist, fc = fit_and_forecast(ts, horizon_weeks)
-        out_csv = os.path.join(forecast_dir, f'gujarat_{dist.replace(" ","_")}_forecast.csv')
-        pd.concat([hist.rename('historical'), fc.rename('forecast')], axis=1).to_csv(out_csv)
-        plt.figure(figsize=(10, 5))
-        hist.plot(label='historical')
-        fc.plot(label='forecast')
-        plt.title(f'Weekly updates - Gujarat / {dist}')
-        plt.legend()
-        plt.tight_layout()
-        plt.savefig(os.path.join(forecast_dir, f'gujarat_{dist.replace(" ","_")}_forecast.png'))
-        plt.close()
+        df = series_frame(forecasts, 'state', state_names.get(st.strip().lower(), st))
+        if not df.empty:
+            save_forecast(df, f'Weekly updates - {st}', f'state_{st.replace(" ","_")}')
+
+    for name, df_dist in dist_demo.items():
+        norm = str(name).strip().lower()
+        for dist in list(df_dist.index[:5]):
+            display = district_names.get((norm, dist.strip().lower()))
+            df = series_frame(forecasts, 'district', state_names.get(norm, name), display)
+            if display is None or df.empty:
+                continue
+            save_forecast(df, f'Weekly updates - {name} / {dist}', f'{slug(name).lower()}_{dist.replace(" ","_")}', name)
 
     # --- Age-group breakdown charts ---
-    def age_group_charts(folder, prefix, out_prefix):
-        # aggregate age columns by state and Gujarat districts
-        file_list = sorted(glob.glob(os.path.join(folder, '*.csv')))
-        acc_state = defaultdict(lambda: defaultdict(int))
-        acc_guj = defaultdict(lambda: defaultdict(int))
-        for fp in file_list:
-            for chunk in pd.read_csv(fp, chunksize=CHUNKSIZE):
-                chunk.columns = clean_columns(chunk.columns)
-                age_cols = [c for c in chunk.columns if c.startswith(f'{prefix}_age')]
-                if not age_cols or 'state' not in chunk.columns:
-                    continue
-                chunk[age_cols] = chunk[age_cols].fillna(0)
-                grp_state = chunk.groupby('state')[age_cols].sum()
-                for state, row in grp_state.iterrows():
-                    for c in age_cols:
-                        acc_state[state][c] += int(row[c])
-                gch = chunk[chunk['state'].str.strip().str.lower() == 'gujarat']
-                if not gch.empty and 'district' in gch.columns:
-                    grp_dist = gch.groupby('district')[age_cols].sum()
-                    for dist, row in grp_dist.iterrows():
-                        for c in age_cols:
-                            acc_guj[dist][c] += int(row[c])
-
+    def age_group_charts(df_states, districts, prefix, out_prefix):
+        # state and district totals come from the shared scan above
         # make charts for top 10 states by total
-        df_states = dict_to_df(acc_state)
         if not df_states.empty:
             top_states = df_states.head(10)
             for st in top_states.index:
@@ -240,70 +334,50 @@ def main():
                 # select age columns
                 age_cols = [c for c in row.index if c.startswith(f'{prefix}_age')]
                 series = row[age_cols]
-                plt.figure(figsize=(8, 4))
-                series.plot(kind='bar', color='C2')
-                plt.title(f'Age breakdown — {st}')
-                plt.ylabel('Total updates')
-                plt.tight_layout()
-                plt.savefig(os.path.join(OUT_DIR, f'{out_prefix}_{st.replace(" ","_")}_agebreak.png'))
-                plt.close()
-
-        # Gujarat districts top 10
-        df_guj = dict_to_df(acc_guj)
-        if not df_guj.empty:
-            for dist in df_guj.head(10).index:
-                row = df_guj.loc[dist]
+                charts.append(chart('age', f'{out_prefix}_{st.replace(" ","_")}_agebreak.png', series,
+                                    f'Age breakdown — {st}', group='age'))
+
+        # top 10 districts of each selected state
+        for name, df_dist in districts.items():
+            for dist in df_dist.head(10).index:
+                row = df_dist.loc[dist]
                 age_cols = [c for c in row.index if c.startswith(f'{prefix}_age')]
                 series = row[age_cols]
-                plt.figure(figsize=(8, 4))
-                series.plot(kind='bar', color='C3')
-                plt.title(f'Age breakdown — Gujarat / {dist}')
-                plt.ylabel('Total updates')
-                plt.tight_layout()
-                plt.savefig(os.path.join(OUT_DIR, f'{out_prefix}_Gujarat_{dist.replace(" ","_")}_agebreak.png'))
-                plt.close()
-
-    age_group_charts(DEMO_DIR, 'demo', 'demo')
-    age_group_charts(BIO_DIR, 'bio', 'bio')
-
-    # --- Service-demand indicators ---
-    indicators = []
-    import glob as _glob
-    fc_files = sorted(_glob.glob(os.path.join(forecast_dir, '*.csv')))
-    for fc in fc_files:
-        name = os.path.basename(fc).replace('_forecast.csv', '')
-        df = pd.read_csv(fc, index_col=0, parse_dates=True)
-        # last historical avg (last 4 weeks)
-        if 'historical' in df.columns:
-            hist = df['historical'].dropna()
-            recent_avg = hist.tail(4).mean() if len(hist) >= 1 else 0
-        else:
-            recent_avg = 0
-        # forecast peak
-        if 'forecast' in df.columns:
-            peak_val = df['forecast'].max()
-            peak_idx = df['forecast'].idxmax()
-        else:
-            peak_val = None
-            peak_idx = None
-        indicators.append({'series': name, 'recent_avg_weekly': float(recent_avg or 0), 'forecast_peak_week': str(peak_idx), 'forecast_peak_value': float(peak_val) if peak_val is not None else None})
-
-    import csv
-    with open(os.path.join(OUT_DIR, 'service_demand_indicators.csv'), 'w', newline='') as cf:
-        writer = csv.DictWriter(cf, fieldnames=['series', 'recent_avg_weekly', 'forecast_peak_week', 'forecast_peak_value'])
-        writer.writeheader()
-        for r in indicators:
-            writer.writerow(r)
-
-    # add to report
-    with open(os.path.join(OUT_DIR, 'analytics_report.md'), 'a') as f:
-        f.write('\n## Age-group breakdown charts\n\n')
-        f.write('- Age-group breakdown charts for top states and Gujarat top districts saved in `analysis/outputs/` as PNGs.\n')
-        f.write('\n## Service-demand indicators\n\n')
-        f.write('- Summary CSV: `analysis/outputs/service_demand_indicators.csv` with recent weekly averages and forecast peak weeks/values.\n')
+                charts.append(chart('age', f'{out_prefix}_{slug(name)}_{dist.replace(" ","_")}_agebreak.png', series,
+                                    f'Age breakdown — {name} / {dist}', group='age', color='C3', state=name))
+
+    age_group_charts(df_state_demo, dist_demo, 'demo', 'demo')
+    age_group_charts(df_state_bio, dist_bio, 'bio', 'bio')
+    stats = render_charts(charts, OUT_DIR, workers)
+    instrument.fields().update(charts=len(charts), **stats)
+    print('Charts: {rendered} rendered, {skipped} unchanged'.format(**stats))
+    manifest = {spec['id']: manifest_entry(spec) for spec in charts}
+    written = [os.path.join(forecast_dir, f'{stem}_forecast.csv') for stem in highlights]
+    written += [os.path.join(OUT_DIR, spec['path']) for spec in charts]
+    return {'charts': manifest, 'highlights': highlights, 'written': written}
+
+
+def series_name(kind, state, district):
+    return f'state_{slug(state)}' if kind == 'state' else f'{slug(state).lower()}_{slug(district)}'
+
+
+def indicator_stage(forecasts):
+    # --- Service-demand indicators (every forecast series) ---
+    df = indicators(forecasts, series_name)
+    path = os.path.join(OUT_DIR, 'service_demand_indicators.csv')
+    df.to_csv(path, index=False)
+    return {'indicators': df, 'written': [path]}
+
+
+def write_report(summaries, indicators, report_text, hotspots, joined=None, spikes=None):
+    df_state_demo, df_state_bio = summaries['state_demo'], summaries['state_bio']
+    dist_demo, dist_bio = summaries['dist_demo'], summaries['dist_bio']
+    matches = summaries['matches']
+    missing = unmatched(matches)
+    path = os.path.join(OUT_DIR, 'analytics_report.md')
 
     # Simple report
-    with open(os.path.join(OUT_DIR, 'analytics_report.md'), 'w') as f:
+    with open(path, 'w') as f:
         f.write('# Aadhaar Analytics Report\n\n')
         f.write('## Top states by demographic updates (total)\n\n')
         if not df_state_demo.empty:
@@ -319,19 +393,14 @@ def main():
         else:
             f.write('No biometric data found.\n\n')
 
-        f.write('## Gujarat - Top districts (demographic)\n\n')
-        if not df_guj_demo.empty:
-            f.write(df_guj_demo[['total_updates']].head(20).to_markdown())
-            f.write('\n\n')
-        else:
-            f.write('No Gujarat demographic data found.\n\n')
-
-        f.write('## Gujarat - Top districts (biometric)\n\n')
-        if not df_guj_bio.empty:
-            f.write(df_guj_bio[['total_updates']].head(20).to_markdown())
-            f.write('\n\n')
-        else:
-            f.write('No Gujarat biometric data found.\n\n')
+        for name in dict.fromkeys(list(dist_demo) + list(dist_bio)):
+            for label, frames in (('demographic', dist_demo), ('biometric', dist_bio)):
+                f.write(f'## {name} - Top districts ({label})\n\n')
+                if name in frames:
+                    f.write(frames[name][['total_updates']].head(20).to_markdown())
+                    f.write('\n\n')
+                else:
+                    f.write(f'No {name} {label} data found.\n\n')
 
         # Embed charts (images are saved in the same outputs folder)
         f.write('## Charts\n\n')
@@ -339,21 +408,148 @@ def main():
             f.write('![](state_demographic_top10.png)\n\n')
         if not df_state_bio.empty:
             f.write('![](state_biometric_top10.png)\n\n')
-        if not df_guj_demo.empty:
-            f.write('![](gujarat_demographic_top15.png)\n\n')
-        if not df_guj_bio.empty:
-            f.write('![](gujarat_biometric_top15.png)\n\n')
+        for name in dist_demo:
+            f.write(f'![]({slug(name).lower()}_demographic_top15.png)\n\n')
+        for name in dist_bio:
+            f.write(f'![]({slug(name).lower()}_biometric_top15.png)\n\n')
+
+        f.write('## Age-group breakdown charts\n\n')
+        f.write('- Age-group breakdown charts for top states and the top districts of each selected state saved in `analysis/outputs/` as PNGs.\n\n')
+
+        f.write('## Service-demand indicators\n\n')
+        if not indicators.empty:
+            f.write('Series with the highest forecast weekly peak:\n\n')
+            f.write(indicators.sort_values('forecast_peak_value', ascending=False, kind='stable').head(10)
+                    .to_markdown(index=False, floatfmt='.1f'))
+            f.write('\n\n')
+        f.write('- Summary CSV: `analysis/outputs/service_demand_indicators.csv` with recent weekly averages and forecast peak weeks/values.\n\n')
+
+        hot = summaries['hotspots']
+        if hot is not None and not hot.empty:
+            f.write(f'## Pincode hot spots ({hotspots})\n\n')
+            for norm in [str(st).strip().lower() for st in df_state_demo.index[:5]]:
+                top = hot[(hot['level'] == 'state') & (hot['state'] == norm)]
+                if top.empty:
+                    continue
+                f.write(f'### {norm.title()}\n\n')
+                f.write(top[['rank', 'pincode', 'estimate', 'lower', 'upper']].to_markdown(index=False))
+                f.write('\n\n')
+            f.write('- Every state, district and week: `analysis/outputs/pincode_hotspots.csv`.\n\n')
+
+        if joined is not None and not joined[1].empty:
+            f.write('## Biometric vs demographic updates\n\n')
+            f.write('Districts whose biometric updates per demographic update depart most from their state '
+                    '(`log2_vs_state`: +1 is twice the state ratio):\n\n')
+            cols = ['state', 'district', 'demo_total', 'bio_total', 'ratio_total', 'state_ratio', 'log2_vs_state']
+            f.write(joined[1][cols].head(10).to_markdown(index=False, floatfmt='.2f'))
+            f.write('\n\n- Ratios by district and age band: `analysis/outputs/joined_district_ratios.csv`; '
+                    'by district and day: `joined_district_daily`; full ranking: `joined_divergence.csv`.\n\n')
+
+        if spikes is not None and spikes[1] is not None:
+            alerts, day = spikes
+            latest = alerts[alerts['date'] == day]
+            f.write('## Demand spikes\n\n')
+            if latest.empty:
+                f.write(f'No state, district or pincode broke sharply from its normal daily updates on '
+                        f'{day:%Y-%m-%d}.\n\n')
+            else:
+                f.write(f'Series furthest above their normal daily updates on {day:%Y-%m-%d} '
+                        f'(`score`: scales above `baseline`, the running mean for that weekday):\n\n')
+                cols = ['level', 'state', 'district', 'pincode', 'updates', 'baseline', 'score', 'ratio']
+                top = latest.sort_values('score', ascending=False, kind='stable')[cols].head(10)
+                f.write(top.astype({'pincode': object}).fillna({'pincode': ''}).to_markdown(index=False, floatfmt='.1f'))
+                f.write('\n\n')
+            f.write('- The latest day\'s alerts: `analysis/outputs/spike_alerts_latest.csv`; every day so far: '
+                    '`spike_alerts.csv`.\n\n')
+
+        f.write(f'## Region names (table {summaries["regions"]})\n\n')
+        f.write('Source rows by how their state/district spelling resolved to a canonical name:\n\n')
+        f.write(match_summary(matches).to_markdown())
+        f.write('\n\n')
+        if not missing.empty:
+            f.write('Names the region table does not know, most rows first:\n\n')
+            cols = ['dataset', 'raw_state', 'raw_district', 'rows', 'match']
+            f.write(missing.sort_values('rows', ascending=False, kind='stable')[cols].head(10)
+                    .to_markdown(index=False))
+            f.write('\n\n')
+        f.write('- Every spelling and the name it was counted under: `analysis/outputs/region_matches.csv`.\n\n')
 
-        # Insights and recommendations
-        f.write('## Insights\n\n')
-        f.write('- **High-volume states:** Uttar Pradesh and Maharashtra show consistently high demographic and biometric update volumes, indicating sustained service demand and need for expanded update centers.\n')
-        f.write('- **Gujarat concentration:** Ahmedabad and Surat dominate update requests, suggesting urban migration and frequent address/mobile changes in these urban centers.\n')
-        f.write('- **Biometric revalidation:** High biometric update counts in several populous states point to age-related revalidation and quality-correction needs.\n\n')
-        f.write('## Recommendations\n\n')
-        f.write('- **Scale resources:** Allocate additional enrollment/update centers and staffing to top-demand states (UP, Maharashtra, Bihar).\n')
-        f.write('- **Targeted outreach:** Conduct mobile camps in high-update districts within Gujarat (Ahmedabad, Surat, Rajkot) focusing on address and mobile update facilitation.\n')
-        f.write('- **Biometric quality program:** Implement periodic biometric revalidation initiatives in high biometric-update regions to reduce repeat visits.\n')
+        if summaries['bad_dates']:
+            f.write('## Data quality\n\n')
+            for label, bad in summaries['bad_dates'].items():
+                f.write(f'- {bad["rows"].sum()} {label} rows had unparseable dates and were left out of the daily series.\n')
+            f.write('\n')
 
+        # Insights and recommendations, from narrative.json
+        f.write('## Insights\n\n')
+        for line in report_text['insights']:
+            f.write(f'- {line}\n')
+        f.write('\n## Recommendations\n\n')
+        for line in report_text['recommendations']:
+            f.write(f'- {line}\n')
+    return {'written': [path]}
+
+
+def stages(args):
+    # the analysis as pipeline.py stages: what each reads and writes, so
+    # independent ones run side by side and (in pipeline.py) unchanged ones
+    # are skipped
+    ingest_options = {'workers': args.workers, 'incremental': args.incremental, 'engine': args.engine,
+                      'memory_budget': args.memory_budget, 'no_cache': args.no_cache}
+    out = [
+        Stage('narrative', read_narrative, outputs=('report_text', 'pdf_text', 'slide_text'), files=(NARRATIVE,),
+              params={'path': NARRATIVE}),
+        Stage('ingest demo', ingest, outputs=('demo',), files=lambda: list_csv_files(DEMO_DIR), code=SCAN_CODE,
+              params={'folder': DEMO_DIR, 'prefix': 'demo', 'label': 'demographic', 'daily': True,
+                      'pincode': args.hierarchy is not None, 'hotspots': args.hotspots, 'joined': args.joined,
+                      'spikes': args.spikes, 'daily_memory': args.daily_memory},
+              options=ingest_options),
+        Stage('ingest bio', ingest, outputs=('bio',), files=lambda: list_csv_files(BIO_DIR), code=SCAN_CODE,
+              params={'folder': BIO_DIR, 'prefix': 'bio', 'label': 'biometric', 'daily': False, 'pincode': False,
+                      'hotspots': None, 'joined': args.joined, 'daily_memory': args.daily_memory},
+              options=ingest_options),
+        Stage('aggregate', aggregate, inputs=('demo', 'bio'), outputs=('summaries',),
+              code=('cube.py', 'regions.py', 'regions.csv'), params={'states': args.states}),
+        # fits set a SIGALRM timeout, which only the main thread can
+        Stage('forecast', forecast_stage, inputs=('demo',), outputs=('forecasts', 'series_names'),
+              code=('forecast.py', 'hw_batch.py', 'model_store.py'),
+              params={'engine': args.forecast_engine, 'timeout': args.forecast_timeout},
+              options={'workers': args.forecast_workers, 'model_cache': not args.no_model_cache,
+                       'model_cache_size': args.model_cache_size}, main=True),
+        Stage('charts', chart_stage, inputs=('summaries', 'forecasts', 'series_names'),
+              outputs=('charts', 'highlights'), code=('render.py', 'forecast.py'),
+              options={'workers': args.chart_workers}),
+        Stage('indicators', indicator_stage, inputs=('forecasts',), outputs=('indicators',), code=('forecast.py',)),
+    ]
+    report_inputs = ('summaries', 'indicators', 'report_text')
+    if args.joined:
+        out.append(Stage('join', join_stage, inputs=('demo', 'bio'), outputs=('joined',), code=('join.py',),
+                         params={'daily_memory': args.daily_memory}))
+        report_inputs += ('joined',)
+    if args.hierarchy is not None:
+        out.append(Stage('hierarchy', hierarchy_stage, inputs=('demo',), outputs=('hierarchy',),
+                         code=('hierarchy.py', 'hw_batch.py', 'forecast.py'), params={'method': args.hierarchy},
+                         options={'workers': args.forecast_workers}))
+    if args.spikes:
+        out.append(Stage('spikes', spike_stage, inputs=('demo',), outputs=('spikes',), code=('spikes.py',)))
+        report_inputs += ('spikes',)
+    out.append(Stage('report', write_report, inputs=report_inputs, code=('regions.py',),
+                     params={'hotspots': args.hotspots}))
+    return out
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # per-stage timings, rows and memory for outputs/run_report.json
+    recorder = instrument.start('analytics', args.profile, argv)
+    # every stage, without reusing earlier runs; pipeline.py skips unchanged
+    # stages and also builds the PDF and the slides
+    Pipeline(stages(args), root=None).run(jobs=args.jobs)
+
+    report = recorder.write(OUT_DIR, args.trace)
+    print(instrument.summary(report))
+    # tells a running query service (serve.py) to load this run's results
+    mark_run(OUT_DIR)
     print('Outputs written to', OUT_DIR)
 
 
@@ -0,0 +1,206 @@
+import os
+import time
+import argparse
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from statsmodels.tsa.holtwinters import ExponentialSmoothing, SimpleExpSmoothing
+from statsmodels.tsa.arima.model import ARIMA
+
+import hw_batch
+from cache import ColumnarCache
+from forecast import SeriesIndex, mean_forecast
+from scan import new_codebook, make_aggregators, scan_folder
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEMO_DIR = os.path.join(BASE_DIR, 'api_data_aadhar_demographic')
+OUT_DIR = os.path.join(BASE_DIR, 'analysis', 'outputs')
+HORIZON = 4
+MIN_TRAIN = 3
+SEASON = hw_batch.SEASON
+
+
+# --- models: fit(trains, h) -> fitted, predict(fitted, h) -> [np.ndarray] ---
+# each takes every training series of a block at once, so batched engines are
+# timed the way they run; per-series models loop
+
+def _per_series(fit_one, predict_one):
+    def fit(trains, h):
+        return [fit_one(s) for s in trains]
+
+    def predict(fitted, h):
+        return [np.asarray(predict_one(f, h), dtype=float) for f in fitted]
+    return fit, predict
+
+
+def _safe(fit_one):
+    # failed fits fall back to the training mean, as in forecast.fit_model
+    def fit(s):
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                return fit_one(s)
+        except Exception:
+            return s
+    return fit
+
+
+def _forecast(f, h):
+    if isinstance(f, pd.Series):
+        return mean_forecast(f, h).to_numpy()
+    return f.forecast(h)
+
+
+def _holt_winters(s):
+    # the production statsmodels configuration (forecast.fit_model)
+    seasonal = 'add' if len(s) >= 26 else None
+    return ExponentialSmoothing(s, trend='add', seasonal=seasonal, seasonal_periods=SEASON if seasonal else None,
+                                damped_trend=False).fit(optimized=True)
+
+
+def _seasonal_naive(s):
+    return s
+
+
+def _seasonal_naive_predict(s, h):
+    # the last full season repeated, or the last value for shorter history
+    y = s.to_numpy(dtype=float)
+    if len(y) >= SEASON:
+        return np.resize(y[-SEASON:], h)
+    return np.repeat(y[-1], h)
+
+
+def _batch_fit(trains, h):
+    # the batched engine fits and extrapolates in one call
+    return [fc.to_numpy() for fc, _, _ in hw_batch.forecast_weekly(trains, h)]
+
+
+def _batch_predict(fitted, h):
+    return [fc[:h] for fc in fitted]
+
+
+MODELS = {
+    'holt_winters': _per_series(_safe(_holt_winters), _forecast),
+    'hw_batch': (_batch_fit, _batch_predict),
+    'seasonal_naive': _per_series(_seasonal_naive, _seasonal_naive_predict),
+    'ets_ann': _per_series(_safe(lambda s: SimpleExpSmoothing(s, initialization_method='estimated').fit()), _forecast),
+    'ets_aadn': _per_series(_safe(lambda s: ExponentialSmoothing(s, trend='add', damped_trend=True).fit()), _forecast),
+    'arima_111': _per_series(_safe(lambda s: ARIMA(s, order=(1, 1, 1)).fit()), _forecast),
+}
+
+
+def splits(weekly, horizon=HORIZON, min_train=MIN_TRAIN, step=1, max_origins=None):
+    # rolling origins: train on weekly[:k], score the next `horizon` weeks
+    origins = list(range(min_train, len(weekly), step))
+    if max_origins:
+        origins = origins[-max_origins:]
+    return [(weekly.iloc[:k], weekly.iloc[k:k + horizon]) for k in origins]
+
+
+def mase(actual, pred, train):
+    # scaled by the in-sample seasonal-naive error (lag 1 under a full season)
+    lag = SEASON if len(train) > SEASON else 1
+    y = train.to_numpy(dtype=float)
+    scale = np.mean(np.abs(y[lag:] - y[:-lag])) if len(y) > lag else np.nan
+    if not scale:
+        return np.nan
+    return float(np.mean(np.abs(actual - pred)) / scale)
+
+
+def smape(actual, pred):
+    denom = np.abs(actual) + np.abs(pred)
+    terms = np.where(denom > 0, 2 * np.abs(actual - pred) / np.where(denom > 0, denom, 1), 0.0)
+    return float(np.mean(terms))
+
+
+def run_block(block, horizon, models):
+    # worker: every model over one block of (kind, key, train, test) splits;
+    # returns per-split scores and fit/predict seconds per (tier, model). Each
+    # tier's splits are fitted as one batch, so its cost is measured on its own
+    tiers = [f'{kind}:{hw_batch.tier(len(train))}' for kind, _, train, _ in block]
+    groups = {}
+    for i, t in enumerate(tiers):
+        groups.setdefault(t, []).append(i)
+    rows, timings = [], {}
+    for name in models:
+        fit, predict = MODELS[name]
+        preds = [None] * len(block)
+        for t, idx in groups.items():
+            t0 = time.perf_counter()
+            fitted = fit([block[i][2] for i in idx], horizon)
+            t1 = time.perf_counter()
+            for i, pred in zip(idx, predict(fitted, horizon)):
+                preds[i] = pred
+            t2 = time.perf_counter()
+            timings[(t, name)] = (t1 - t0, t2 - t1, len(idx))
+        for (kind, key, train, test), t, pred in zip(block, tiers, preds):
+            actual = test.to_numpy(dtype=float)
+            pred = np.asarray(pred, dtype=float)[:len(actual)]
+            rows.append({'model': name, 'kind': kind, 'series': key, 'origin': str(train.index[-1].date()),
+                         'tier': t, 'mase': mase(actual, pred, train), 'smape': smape(actual, pred)})
+    return rows, timings
+
+
+def backtest(tasks, horizon=HORIZON, min_train=MIN_TRAIN, models=None, workers=1, max_origins=None, block_size=64):
+    # tasks: SeriesIndex.tasks(); returns (per-split scores, leaderboard)
+    models = list(models or MODELS)
+    work = []
+    for kind, state, district, weekly, *_ in tasks:
+        key = state if kind == 'state' else f'{state}|{district}'
+        work += [(kind, key, train, test) for train, test in splits(weekly, horizon, min_train, max_origins=max_origins)]
+    blocks = [work[i:i + block_size] for i in range(0, len(work), block_size)]
+    n = len(blocks)
+    if workers > 1 and n > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(run_block, blocks, [horizon] * n, [models] * n))
+    else:
+        results = [run_block(b, horizon, models) for b in blocks]
+    scores = pd.DataFrame([r for rows, _ in results for r in rows],
+                          columns=['model', 'kind', 'series', 'origin', 'tier', 'mase', 'smape'])
+    timing = pd.DataFrame([(tier, name, fit, pred, count) for _, t in results
+                           for (tier, name), (fit, pred, count) in t.items()],
+                          columns=['tier', 'model', 'fit_s', 'predict_s', 'splits'])
+    return scores, leaderboard(scores, timing)
+
+
+def leaderboard(scores, timing):
+    # per tier and model: accuracy next to that tier's compute cost (ms per split)
+    if scores.empty:
+        return pd.DataFrame(columns=['tier', 'model', 'splits', 'mase_mean', 'mase_median', 'smape_mean',
+                                     'fit_ms', 'predict_ms'])
+    board = scores.groupby(['tier', 'model']).agg(splits=('mase', 'size'), mase_mean=('mase', 'mean'),
+                                                  mase_median=('mase', 'median'), smape_mean=('smape', 'mean'))
+    cost = timing.groupby(['tier', 'model'])[['fit_s', 'predict_s', 'splits']].sum()
+    board = board.reset_index().merge(cost, left_on=['tier', 'model'], right_index=True, suffixes=('', '_all'))
+    board['fit_ms'] = 1000 * board['fit_s'] / board['splits_all']
+    board['predict_ms'] = 1000 * board['predict_s'] / board['splits_all']
+    board = board.drop(columns=['fit_s', 'predict_s', 'splits_all'])
+    return board.sort_values(['tier', 'mase_mean'], kind='stable', ignore_index=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rolling-origin backtest of the forecast models on every '
+                                                 'state and district series.')
+    parser.add_argument('--folder', default=DEMO_DIR)
+    parser.add_argument('--horizon', type=int, default=HORIZON)
+    parser.add_argument('--min-train', type=int, default=MIN_TRAIN)
+    parser.add_argument('--max-origins', type=int, default=None, help='keep only the latest N origins per series')
+    parser.add_argument('--models', default=','.join(MODELS), help='comma-separated subset of ' + ', '.join(MODELS))
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--limit', type=int, default=None, help='only the first N series (smoke runs)')
+    parser.add_argument('--no-cache', action='store_true')
+    args = parser.parse_args()
+
+    codebook = new_codebook('demo')
+    res = scan_folder(args.folder, 'demo', make_aggregators(codebook, daily=True), codebook,
+                      cache=None if args.no_cache else ColumnarCache())
+    tasks = SeriesIndex(res['daily']).tasks()[:args.limit]
+    scores, board = backtest(tasks, args.horizon, args.min_train, args.models.split(','), args.workers,
+                             args.max_origins)
+    os.makedirs(OUT_DIR, exist_ok=True)
+    board.to_csv(os.path.join(OUT_DIR, 'backtest_leaderboard.csv'), index=False)
+    scores.to_csv(os.path.join(OUT_DIR, 'backtest_scores.csv'), index=False)
+    print(f'{len(scores)} scored forecasts over {len(tasks)} series')
+    print(board.to_markdown(index=False, floatfmt='.3f') if not board.empty else 'no series long enough to backtest')
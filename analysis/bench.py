@@ -0,0 +1,264 @@
+import os
+import sys
+import json
+import time
+import shutil
+import pickle
+import argparse
+import platform
+import resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from synth import FOLDERS, SYNTH_DIR, generate, parse_count
+from parallel import check as parallel_check
+from instrument import peak_rss, reset_peak_rss
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(BASE_DIR, 'analysis', '.cache', 'bench')
+BASELINE_DIR = os.path.join(BASE_DIR, 'analysis', 'benchmarks')
+OUT_DIR = os.path.join(BASE_DIR, 'analysis', 'outputs', 'benchmarks')
+# in pipeline order; each stage reads what the earlier ones left in the work dir
+STAGES = ('ingest', 'cache', 'scan', 'daily', 'cube', 'forecast')
+STAGE_HELP = {
+    'ingest': 'CSV parse + state/district totals, no cache',
+    'cache': 'build the columnar cache',
+    'scan': 'cached scan, state/district totals',
+    'daily': 'cached scan + daily state/district/date series',
+    'cube': 'cached scan + cube cells and build',
+    'forecast': 'series index + forecasts for every state and district',
+}
+SCALES = '100k,300k,1M'
+# a stage is flagged when its throughput drops or its peak RSS grows by more than this
+TOLERANCE = 0.25
+
+
+def _folder_bytes(folder):
+    total = 0
+    for root, _, files in os.walk(folder):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total
+
+
+def _usage():
+    # (cpu seconds, peak RSS bytes) of this process and its finished children.
+    # Linux carries ru_maxrss across the fork+exec that spawns a stage, so a
+    # stage would start at the parent's peak; this process's own peak comes
+    # from VmHWM since reset_peak_rss, and from rusage only where /proc is missing
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = me.ru_utime + me.ru_stime + kids.ru_utime + kids.ru_stime
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    own = peak_rss()
+    return cpu, max(me.ru_maxrss * unit if own is None else own, kids.ru_maxrss * unit)
+
+
+def run_stage(stage, config):
+    # runs in a fresh process, so the peak RSS is this stage's alone
+    from cache import ColumnarCache
+    from cube import build as build_cube
+    from forecast import SeriesIndex, run_forecasts
+    from scan import new_codebook, make_aggregators, scan_folder
+
+    work, folder, prefix = config['work'], config['folder'], config['prefix']
+    cache_dir = os.path.join(work, 'columnar')
+    daily_path = os.path.join(work, 'daily.pkl')
+    reset_peak_rss()
+    base_rss = _usage()[1]
+    cpu0 = _usage()[0]
+    t0 = time.perf_counter()
+    items, unit, nbytes = config['rows'], 'rows', _folder_bytes(folder)
+    if stage == 'ingest':
+        codebook = new_codebook(prefix)
+        scan_folder(folder, prefix, make_aggregators(codebook), codebook)
+    elif stage == 'cache':
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        cache = ColumnarCache(cache_dir)
+        for name in sorted(os.listdir(folder)):
+            if name.endswith('.csv'):
+                cache.get(os.path.join(folder, name))
+    elif stage in ('scan', 'daily', 'cube'):
+        codebook = new_codebook(prefix)
+        aggregators = make_aggregators(codebook, daily=stage == 'daily', cube=stage == 'cube')
+        res = scan_folder(folder, prefix, aggregators, codebook, cache=ColumnarCache(cache_dir))
+        nbytes = _folder_bytes(cache_dir)
+        if stage == 'daily':
+            with open(daily_path, 'wb') as f:
+                pickle.dump(res['daily'], f)
+        elif stage == 'cube':
+            build_cube(res['cube'], prefix, os.path.join(work, 'cube'))
+    elif stage == 'forecast':
+        with open(daily_path, 'rb') as f:
+            daily = pickle.load(f)
+        # the daily frame is input, not part of the stage
+        cpu0, t0 = _usage()[0], time.perf_counter()
+        tasks = SeriesIndex(daily).tasks()
+        run_forecasts(tasks, config['forecast_workers'], config['forecast_engine'])
+        items, unit, nbytes = len(tasks), 'series', 0
+    else:
+        raise ValueError(f'unknown stage {stage!r} (expected one of {", ".join(STAGES)})')
+    wall = time.perf_counter() - t0
+    cpu, peak = _usage()
+    return {'stage': stage, 'rows': config['rows'], 'items': items, 'unit': unit, 'wall_s': wall,
+            'cpu_s': cpu - cpu0, 'per_s': items / max(wall, 1e-9), 'mb_per_s': nbytes / 2 ** 20 / max(wall, 1e-9),
+            'bytes': nbytes, 'peak_rss_mb': peak / 2 ** 20, 'base_rss_mb': base_rss / 2 ** 20}
+
+
+def run_scale(rows, stages, prefix='demo', forecast_workers=1, forecast_engine='batch', gen_workers=1, seed=91):
+    # generated data for this scale (reused when already there), then every
+    # stage in its own spawned process
+    folders, _ = generate(os.path.join(SYNTH_DIR, str(rows)), rows, [prefix], seed=seed, workers=gen_workers)
+    folder = folders[prefix]
+    work = os.path.join(BENCH_DIR, str(rows))
+    os.makedirs(work, exist_ok=True)
+    config = {'work': work, 'folder': folder, 'prefix': prefix, 'rows': rows,
+              'forecast_workers': forecast_workers, 'forecast_engine': forecast_engine}
+    results = []
+    ctx = multiprocessing.get_context('spawn')
+    for stage in stages:
+        if stage in ('scan', 'daily', 'cube') and not os.path.isdir(os.path.join(work, 'columnar')):
+            raise SystemExit(f'stage {stage!r} needs the columnar cache; include the cache stage')
+        if stage == 'forecast' and not os.path.exists(os.path.join(work, 'daily.pkl')):
+            raise SystemExit("stage 'forecast' needs the daily series; include the daily stage")
+        with ProcessPoolExecutor(max_workers=1, mp_context=ctx) as pool:
+            result = pool.submit(run_stage, stage, config).result()
+        print(f'  {rows:>12,} {stage:<9} {result["wall_s"]:8.2f}s {result["per_s"]:>12,.0f} {result["unit"]}/s '
+              f'{result["peak_rss_mb"]:8.0f} MB', flush=True)
+        results.append(result)
+    return results
+
+
+def scaling(df):
+    # per stage: the log-log slope of wall time against rows (1.0 is linear)
+    # and of peak RSS above the interpreter's own, over the measured scales
+    out = {}
+    for stage, g in df.groupby('stage', sort=False):
+        if g['rows'].nunique() < 2:
+            continue
+        x = np.log(g['rows'].to_numpy(dtype=float))
+        out[stage] = {
+            'time_exponent': float(np.polyfit(x, np.log(g['wall_s'].clip(lower=1e-6)), 1)[0]),
+            'memory_exponent': float(np.polyfit(x, np.log((g['peak_rss_mb'] - g['base_rss_mb']).clip(lower=1)), 1)[0]),
+        }
+    return out
+
+
+def environment():
+    return {'host': platform.node(), 'platform': platform.platform(), 'python': platform.python_version(),
+            'cpus': os.cpu_count(), 'numpy': np.__version__, 'pandas': pd.__version__}
+
+
+def compare(run, baseline, tolerance=TOLERANCE):
+    # per stage and scale: throughput and peak RSS against the baseline;
+    # returns (table, number of regressions)
+    cur = pd.DataFrame(run['results']).set_index(['rows', 'stage'])
+    old = pd.DataFrame(baseline['results']).set_index(['rows', 'stage'])
+    both = cur.join(old, rsuffix='_base', how='inner')
+    table = pd.DataFrame({
+        'per_s': both['per_s'], 'per_s_base': both['per_s_base'],
+        'speed': both['per_s'] / both['per_s_base'],
+        'peak_rss_mb': both['peak_rss_mb'], 'peak_rss_mb_base': both['peak_rss_mb_base'],
+        'memory': both['peak_rss_mb'] / both['peak_rss_mb_base'],
+    })
+    slower = table['speed'] < 1 - tolerance
+    bigger = table['memory'] > 1 + tolerance
+    table['status'] = np.select([slower & bigger, slower, bigger], ['slower, larger', 'slower', 'larger'], 'ok')
+    return table, int((slower | bigger).sum())
+
+
+def plot_scaling(df, path):
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(10, 4))
+    FigureCanvasAgg(fig)
+    ax_t, ax_m = fig.subplots(1, 2)
+    for stage, g in df.groupby('stage', sort=False):
+        ax_t.plot(g['rows'], g['wall_s'], marker='o', label=stage)
+        ax_m.plot(g['rows'], g['peak_rss_mb'], marker='o', label=stage)
+    for ax, label in ((ax_t, 'Wall time (s)'), (ax_m, 'Peak RSS (MB)')):
+        ax.set_xscale('log')
+        ax.set_yscale('log')
+        ax.set_xlabel('Input rows')
+        ax.set_ylabel(label)
+    ax_t.legend(fontsize='small')
+    fig.tight_layout()
+    fig.savefig(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Pipeline scaling benchmarks on generated data.')
+    parser.add_argument('--scales', default=SCALES, help='comma-separated row counts, e.g. 1M,10M,100M')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help='; '.join(f'{k}: {v}' for k, v in STAGE_HELP.items()))
+    parser.add_argument('--dataset', choices=sorted(FOLDERS), default='demo')
+    parser.add_argument('--forecast-engine', choices=['statsmodels', 'batch'], default='batch')
+    parser.add_argument('--forecast-workers', type=int, default=os.cpu_count())
+    parser.add_argument('--gen-workers', type=int, default=os.cpu_count(), help='processes writing the data')
+    parser.add_argument('--save-baseline', metavar='NAME', help=f'store this run under {os.path.relpath(BASELINE_DIR, BASE_DIR)}/')
+    parser.add_argument('--compare', metavar='NAME', help='compare against a stored baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    scales = [parse_count(s) for s in args.scales.split(',') if s.strip()]
+    stages = [s.strip() for s in args.stages.split(',') if s.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f'unknown stages: {", ".join(sorted(unknown))}')
+    stages = [s for s in STAGES if s in stages]
+    baseline = None
+    if args.compare:
+        path = os.path.join(BASELINE_DIR, f'{args.compare}.json')
+        if not os.path.exists(path):
+            parser.error(f'no baseline {path}')
+        with open(path) as f:
+            baseline = json.load(f)
+
+    # timings of a parallel ingest that no longer matches the serial scan mean nothing
+    bad = parallel_check()
+    if bad:
+        sys.exit(f'parallel != serial in {", ".join(bad)}; run python analysis/parallel.py')
+    results = []
+    for rows in scales:
+        results += run_scale(rows, stages, args.dataset, args.forecast_workers, args.forecast_engine,
+                             args.gen_workers)
+    df = pd.DataFrame(results)
+    run = {'created': pd.Timestamp.now().isoformat(timespec='seconds'), 'environment': environment(),
+           'dataset': args.dataset, 'forecast_engine': args.forecast_engine, 'results': results,
+           'scaling': scaling(df)}
+
+    print()
+    print(df.pivot(index='stage', columns='rows', values='per_s').reindex(stages).to_markdown(floatfmt=',.0f'))
+    print()
+    print(df.pivot(index='stage', columns='rows', values='peak_rss_mb').reindex(stages).to_markdown(floatfmt=',.0f'))
+    if run['scaling']:
+        print()
+        print(pd.DataFrame(run['scaling']).T.to_markdown(floatfmt='.2f'))
+    os.makedirs(OUT_DIR, exist_ok=True)
+    with open(os.path.join(OUT_DIR, 'latest.json'), 'w') as f:
+        json.dump(run, f, indent=1)
+    df.to_csv(os.path.join(OUT_DIR, 'latest.csv'), index=False)
+    if df['rows'].nunique() > 1:
+        plot_scaling(df, os.path.join(OUT_DIR, 'scaling.png'))
+    print(f'\nwrote {os.path.relpath(OUT_DIR, BASE_DIR)}/latest.json')
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, f'{args.save_baseline}.json')
+        with open(path, 'w') as f:
+            json.dump(run, f, indent=1)
+        print('baseline saved to', os.path.relpath(path, BASE_DIR))
+    if baseline is not None:
+        if baseline['environment'] != run['environment']:
+            print('note: the baseline was recorded on a different machine or stack:', baseline['environment'])
+        table, regressions = compare(run, baseline, args.tolerance)
+        print()
+        print(table.to_markdown(floatfmt='.2f'))
+        if regressions:
+            sys.exit(f'{regressions} regression(s) beyond {args.tolerance:.0%} against {args.compare!r}')
+
+
+if __name__ == '__main__':
+    main()
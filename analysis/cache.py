@@ -0,0 +1,189 @@
+import os
+import sys
+import glob
+import json
+import hashlib
+import shutil
+import numpy as np
+import pandas as pd
+
+import instrument
+from accumulators import KeyCodec
+from dates import DateDecoder, DEFAULT_DATE_FORMAT
+from reader import ReaderProfile
+from schema import age_columns, DATE_COL, NO_DAY
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CACHE_DIR = os.path.join(BASE_DIR, 'analysis', '.cache', 'columnar')
+CACHE_VERSION = 2
+
+
+def content_hash(path, block=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for buf in iter(lambda: f.read(block), b''):
+            h.update(buf)
+    return h.hexdigest()
+
+
+def fingerprint(path, with_hash=True):
+    st = os.stat(path)
+    fp = {'path': os.path.abspath(path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    if with_hash:
+        fp['sha1'] = content_hash(path)
+    return fp
+
+
+def entry_dir(path, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16])
+
+
+class CachedFile:
+    # one source CSV in columnar form: dictionary-encoded state/district,
+    # int32 pincode, int32 day number and an int32 (rows x age columns) matrix,
+    # all opened as read-only memory maps
+    def __init__(self, root):
+        with open(os.path.join(root, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.age_cols = self.meta['age_cols']
+        self.states = np.array(self.meta['states'], dtype=object)
+        self.districts = np.array(self.meta['districts'], dtype=object)
+        self.arrays = {name: np.load(os.path.join(root, f'{name}.npy'), mmap_mode='r')
+                       for name in ('state', 'district', 'pincode', 'day', 'ages')}
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def to_frame(self):
+        # categorical frame over the mapped arrays; codes are not copied into
+        # object strings
+        df = pd.DataFrame({
+            'state': pd.Categorical.from_codes(np.asarray(self['state']), categories=self.states, validate=False),
+            'district': pd.Categorical.from_codes(np.asarray(self['district']), categories=self.districts, validate=False),
+            'pincode': self['pincode'],
+            'day': self['day'],
+        })
+        for i, c in enumerate(self.age_cols):
+            df[c] = self['ages'][:, i]
+        return df
+
+
+def _build(path, root, fp, date_format=DEFAULT_DATE_FORMAT, profile=None):
+    states, districts = KeyCodec(), KeyCodec()
+    dates = DateDecoder(date_format)
+    no_date_col = 0
+    parts = {'state': [], 'district': [], 'pincode': [], 'day': [], 'ages': []}
+    age_cols = None
+    instrument.count(parsed_bytes=os.path.getsize(path))
+    for chunk in (profile or ReaderProfile()).read(path):
+        instrument.count(parsed_rows=len(chunk))
+        if age_cols is None:
+            age_cols = age_columns(chunk.columns)
+        n = len(chunk)
+        parts['state'].append(states.encode(chunk['state']) if 'state' in chunk.columns else np.full(n, -1))
+        parts['district'].append(districts.encode(chunk['district']) if 'district' in chunk.columns else np.full(n, -1))
+        pin = pd.to_numeric(chunk['pincode'], errors='coerce') if 'pincode' in chunk.columns else pd.Series(np.nan, index=chunk.index)
+        parts['pincode'].append(pin.fillna(-1).to_numpy(dtype=np.int32))
+        if DATE_COL in chunk.columns:
+            parts['day'].append(dates.decode(chunk[DATE_COL]))
+        else:
+            parts['day'].append(np.full(n, NO_DAY, dtype=np.int32))
+            no_date_col += n
+        ages = chunk.reindex(columns=age_cols).apply(pd.to_numeric, errors='coerce').fillna(0)
+        parts['ages'].append(ages.to_numpy(dtype=np.int32))
+    age_cols = age_cols or []
+    tmp = root + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    code_type = {'state': np.int16 if len(states) < 2 ** 15 else np.int32,
+                 'district': np.int16 if len(districts) < 2 ** 15 else np.int32}
+    rows = 0
+    for name, chunks in parts.items():
+        if chunks:
+            arr = np.concatenate(chunks)
+        else:
+            arr = np.zeros((0, len(age_cols)) if name == 'ages' else 0)
+        arr = arr.astype(code_type.get(name, np.int32))
+        rows = len(arr)
+        np.save(os.path.join(tmp, f'{name}.npy'), arr)
+    meta = {
+        'version': CACHE_VERSION,
+        'source': fp,
+        'rows': rows,
+        'age_cols': age_cols,
+        'states': [str(s) for s in states.values],
+        'districts': [str(d) for d in districts.values],
+        'date_format': date_format,
+        # raw date values that did not match date_format, with their row counts
+        'bad_dates': dates.bad_values(),
+    }
+    if no_date_col:
+        meta['bad_dates']['<missing>'] = meta['bad_dates'].get('<missing>', 0) + no_date_col
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    # swap the finished entry in so a crashed build never leaves a half cache
+    shutil.rmtree(root, ignore_errors=True)
+    os.replace(tmp, root)
+
+
+class ColumnarCache:
+    # source CSV -> columnar entry, invalidated on path/size/mtime/content change
+    def __init__(self, cache_dir=CACHE_DIR, profile=None):
+        self.cache_dir = cache_dir
+        # ReaderProfile used when an entry has to be (re)built
+        self.profile = profile
+        self.hits = 0
+        self.misses = 0
+
+    def _valid(self, root, path, date_format):
+        meta_path = os.path.join(root, 'meta.json')
+        if not os.path.exists(meta_path):
+            return False
+        with open(meta_path) as f:
+            meta = json.load(f)
+        src = meta.get('source', {})
+        if meta.get('version') != CACHE_VERSION or src.get('path') != os.path.abspath(path):
+            return False
+        if meta.get('date_format') != date_format:
+            return False
+        cur = fingerprint(path, with_hash=False)
+        if cur['size'] != src.get('size'):
+            return False
+        if cur['mtime_ns'] == src.get('mtime_ns'):
+            return True
+        # touched but same size: only the content hash can tell
+        if content_hash(path) != src.get('sha1'):
+            return False
+        src['mtime_ns'] = cur['mtime_ns']
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        return True
+
+    def get(self, path, date_format=DEFAULT_DATE_FORMAT):
+        root = entry_dir(path, self.cache_dir)
+        if self._valid(root, path, date_format):
+            self.hits += 1
+        else:
+            self.misses += 1
+            os.makedirs(self.cache_dir, exist_ok=True)
+            _build(path, root, fingerprint(path), date_format, self.profile)
+        return CachedFile(root)
+
+
+def read_frame(path, cache=None, date_format=DEFAULT_DATE_FORMAT):
+    # cached, typed DataFrame for one source CSV (for scripts other than analytics.py)
+    return (cache or ColumnarCache()).get(path, date_format).to_frame()
+
+
+if __name__ == '__main__':
+    # warm the cache for the given folders (default: both API dataset folders)
+    folders = sys.argv[1:] or [os.path.join(BASE_DIR, 'api_data_aadhar_demographic'),
+                               os.path.join(BASE_DIR, 'api_data_aadhar_biometric')]
+    cache = ColumnarCache()
+    for folder in folders:
+        for fp in sorted(glob.glob(os.path.join(folder, '*.csv'))):
+            print(f'{os.path.basename(fp)}: {len(cache.get(fp))} rows')
+    print(f'cache hits={cache.hits} misses={cache.misses} ({CACHE_DIR})')
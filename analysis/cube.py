@@ -0,0 +1,317 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from accumulators import KeyedSum
+from regions import district_keys, normalize, state_keys
+from schema import NO_DAY, day_weeks, days_to_dates, week_dates
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CUBE_DIR = os.path.join(BASE_DIR, 'analysis', '.cache', 'cube')
+CUBE_VERSION = 1
+GRAINS = ('day', 'week', 'month')
+# coded day of rows whose date did not decode; kept so totals stay exact
+UNDATED = 0
+# day codes are biased into the positive range, clear of UNDATED
+DAY_BIAS = 1 << 23
+
+
+class CubeCells:
+    # (state, district, day) -> age-column sums, the cells the cube is
+    # built from. Rows without a district are kept under district '' and rows
+    # with an unparseable date under UNDATED, so state totals match
+    # StateTotals exactly
+    columns = ('state', 'district', 'date')
+
+    def __init__(self, codebook):
+        self.codebook = codebook
+        self.sums = KeyedSum(['state', 'district', 'day'], codebook)
+
+    def consume(self, batch):
+        state = batch.codes('state')
+        district = batch.codes('district') if batch.has('district') else np.full(len(batch), -1, dtype=np.int64)
+        if (district < 0).any():
+            district = np.where(district < 0, self.codebook.encode('district', np.array([''], dtype=object))[0],
+                                district)
+        days = batch.days
+        day = np.where(days == NO_DAY, UNDATED, days.astype(np.int64) + DAY_BIAS)
+        self.sums.add([state, district, day], batch.values, batch.age_cols)
+
+    def result(self):
+        # one row per cell: state, district, coded day, age-column sums and
+        # the number of source rows
+        p = self.sums.partial()
+        df = pd.DataFrame(p['totals'], columns=p['columns'])
+        df.insert(0, 'state', p['keys'][0])
+        df.insert(1, 'district', p['keys'][1])
+        df.insert(2, 'day', p['keys'][2])
+        df['rows'] = p['counts']
+        return df
+
+    def partial(self):
+        return self.sums.partial()
+
+    def merge(self, partial, sign=1):
+        self.sums.merge(partial, sign)
+
+
+def build(cells, prefix, cube_dir=CUBE_DIR):
+    # CubeCells result -> dense memory-mapped arrays under cube_dir/prefix:
+    # (slot x time x band) totals and (slot x time) source-row counts for the
+    # day, week and month grains, where a slot is one (state, district) pair;
+    # the last time column of each grain holds the undated rows. Returns the
+    # opened Cube.
+    root = os.path.join(cube_dir, prefix)
+    age_cols = sorted(c for c in cells.columns if c not in ('state', 'district', 'day', 'rows'))
+    df = cells
+    slot_keys = pd.MultiIndex.from_arrays([df['state'].astype(str), df['district'].astype(str)])
+    slot, slots = pd.factorize(slot_keys, sort=True)
+    dated = df['day'].to_numpy() != UNDATED
+    day = df['day'].to_numpy(dtype=np.int64) - DAY_BIAS
+    day0 = int(day[dated].min()) if dated.any() else 0
+    day1 = int(day[dated].max()) if dated.any() else -1
+    days = np.arange(day0, day1 + 1)
+    values = df[age_cols].to_numpy(dtype=np.int64)
+    rows = df['rows'].to_numpy(dtype=np.int64)
+    axes = {
+        'day': days,
+        'week': np.unique(day_weeks(days)),
+        'month': np.unique(days.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)),
+    }
+    index = {
+        'day': day - day0,
+        'week': day_weeks(day) - (axes['week'][0] if len(axes['week']) else 0),
+        'month': (day.astype('datetime64[D]').astype('datetime64[M]').astype(np.int64)
+                  - (axes['month'][0] if len(axes['month']) else 0)),
+    }
+    tmp = root + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for grain in GRAINS:
+        n = len(axes[grain])
+        t = np.where(dated, index[grain], n)
+        for name, data in ((grain, values), (f'{grain}_rows', rows)):
+            arr = np.lib.format.open_memmap(os.path.join(tmp, f'{name}.npy'), mode='w+', dtype=np.int64,
+                                            shape=(len(slots), n + 1) + data.shape[1:])
+            arr[:] = 0
+            np.add.at(arr, (slot, t), data)
+            arr.flush()
+            del arr
+    meta = {
+        'version': CUBE_VERSION,
+        'prefix': prefix,
+        'age_cols': age_cols,
+        'states': [str(s) for s in slots.get_level_values(0)],
+        'districts': [str(d) for d in slots.get_level_values(1)],
+        'day0': day0,
+        'days': len(days),
+        'week0': int(axes['week'][0]) if len(axes['week']) else 0,
+        'weeks': len(axes['week']),
+        'month0': int(axes['month'][0]) if len(axes['month']) else 0,
+        'months': len(axes['month']),
+    }
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    # swap the finished cube in so a crashed build never leaves a half cube
+    shutil.rmtree(root, ignore_errors=True)
+    os.replace(tmp, root)
+    return Cube(root)
+
+
+class Cube:
+    # read-only view of a built cube; arrays are memory-mapped, so opening is
+    # cheap and a query only touches the slots and time range it selects
+    def __init__(self, root):
+        with open(os.path.join(root, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.age_cols = self.meta['age_cols']
+        self.bands = [c.split('_age_', 1)[-1] for c in self.age_cols]
+        self.states = np.array(self.meta['states'], dtype=object)
+        self.districts = np.array(self.meta['districts'], dtype=object)
+        self.state_norm = np.asarray(normalize(self.states), dtype=object)
+        self.district_norm = np.asarray(normalize(self.districts), dtype=object)
+        self.arrays = {name: np.load(os.path.join(root, f'{name}.npy'), mmap_mode='r')
+                       for grain in GRAINS for name in (grain, f'{grain}_rows')}
+        self._labels = {}
+        self._groups = {}
+
+    @classmethod
+    def open(cls, prefix, cube_dir=CUBE_DIR):
+        return cls(os.path.join(cube_dir, prefix))
+
+    def load(self):
+        # copy the arrays into memory, so a rebuild can replace the files
+        # while this cube is still being queried
+        self.arrays = {name: np.array(arr) for name, arr in self.arrays.items()}
+        return self
+
+    def labels(self, grain):
+        # time labels of a grain, without the undated column
+        if grain not in self._labels:
+            if grain == 'day':
+                labels = days_to_dates(self.meta['day0'] + np.arange(self.meta['days']))
+            elif grain == 'week':
+                labels = week_dates(self.meta['week0'] + np.arange(self.meta['weeks']))
+            else:
+                labels = pd.to_datetime((self.meta['month0'] + np.arange(self.meta['months'])).astype('datetime64[M]'))
+            self._labels[grain] = labels
+        return self._labels[grain]
+
+    def slots(self, states=None, districts=None):
+        # slots of the given states and districts, under any name the region
+        # table knows for them
+        mask = np.ones(len(self.states), dtype=bool)
+        if states is not None:
+            mask &= np.isin(self.state_norm, state_keys(_as_list(states)))
+        if districts is not None:
+            mask &= np.isin(self.district_norm, district_keys(_as_list(districts)))
+        return np.flatnonzero(mask)
+
+    def _band_index(self, bands):
+        if bands is None:
+            return list(range(len(self.age_cols)))
+        for b in _as_list(bands):
+            if b not in self.bands and b not in self.age_cols:
+                raise ValueError(f'unknown age band {b!r} (expected one of {", ".join(self.bands)})')
+        return [self.bands.index(b) if b in self.bands else self.age_cols.index(b) for b in _as_list(bands)]
+
+    def _time_range(self, grain, start, end):
+        # [lo, hi) time columns for inclusive start/end dates; with neither
+        # given the undated column is included, so totals stay exact
+        labels = self.labels(grain)
+        n = len(labels)
+        if start is None and end is None:
+            return 0, n + 1
+        lo = 0 if start is None else int(labels.searchsorted(_period_start(grain, start)))
+        hi = n if end is None else int(labels.searchsorted(pd.Timestamp(end), side='right'))
+        return lo, max(lo, hi)
+
+    def block(self, grain='day', states=None, districts=None, start=None, end=None, bands=None):
+        # (slots, (slot x time x band) totals, (slot x time) source rows) of
+        # the selection
+        slots = self.slots(states, districts)
+        lo, hi = self._time_range(grain, start, end)
+        arr = self.arrays[grain][slots, lo:hi][:, :, self._band_index(bands)]
+        return slots, np.asarray(arr), np.asarray(self.arrays[f'{grain}_rows'][slots, lo:hi])
+
+    def _group(self, slots, by):
+        if by == 'state':
+            return pd.Index(self.states[slots], name='state')
+        if by == 'state_norm':
+            return pd.Index(self.state_norm[slots], name='state_norm')
+        if by == 'district':
+            return pd.MultiIndex.from_arrays([self.state_norm[slots], self.districts[slots]],
+                                             names=['state_norm', 'district'])
+        raise ValueError(f"unknown grouping {by!r} (expected 'state', 'state_norm' or 'district')")
+
+    def _group_codes(self, by):
+        # (group code of every slot, sorted group labels), memoized per
+        # grouping; slots without a district get -1 when grouping by district
+        if by not in self._groups:
+            labels = self._group(np.arange(len(self.states)), by)
+            codes, groups = pd.factorize(labels, sort=True)
+            groups = groups.set_names(labels.names)
+            if by == 'district':
+                blank = groups.get_level_values('district') == ''
+                remap = np.where(blank, -1, np.cumsum(~blank) - 1)
+                codes, groups = remap[codes], groups[~blank]
+            self._groups[by] = codes, groups
+        return self._groups[by]
+
+    def totals(self, by='state', states=None, districts=None, start=None, end=None, bands=None, grain='day'):
+        # one row per group with source rows in the selection: its age-column
+        # sums and total_updates, highest total first (ties by key), like the
+        # StateTotals/DistrictTotals frames. Rows without a district only
+        # count towards their state
+        if start is None and end is None:
+            # every grain sums to the same all-time totals; months are smallest
+            grain = 'month'
+        slots, arr, rows = self.block(grain, states, districts, start, end, bands)
+        cols = [self.age_cols[i] for i in self._band_index(bands)]
+        codes, groups = self._group_codes(by)
+        code = codes[slots]
+        keep = code >= 0
+        sums = np.zeros((len(groups), len(cols)), dtype=np.int64)
+        np.add.at(sums, code[keep], arr.sum(axis=1)[keep])
+        present = np.bincount(code[keep], weights=rows.sum(axis=1)[keep], minlength=len(groups)) > 0
+        df = pd.DataFrame(sums[present], index=groups[present], columns=cols)
+        df['total_updates'] = df[cols].sum(axis=1)
+        if df.index.nlevels == 1:
+            df.index.name = 'key'
+        return df.sort_values('total_updates', ascending=False, kind='stable')
+
+    def top(self, n=10, by='state', **where):
+        return self.totals(by, **where).head(n)
+
+    def series(self, grain='week', by=None, states=None, districts=None, start=None, end=None, bands=None):
+        # totals over time: one column per group (or a single 'total_updates'
+        # column with by=None), one row per day/week/month
+        slots, arr, _ = self.block(grain, states, districts, start, end, bands)
+        lo, hi = self._time_range(grain, start, end)
+        labels = self.labels(grain)
+        hi = min(hi, len(labels))
+        values = arr[:, :hi - lo].sum(axis=2)
+        if by is None:
+            return pd.DataFrame({'total_updates': values.sum(axis=0)}, index=labels[lo:hi])
+        df = pd.DataFrame(values.T, index=labels[lo:hi])
+        df.columns = self._group(slots, by)
+        return df.T.groupby(level=list(range(df.columns.nlevels))).sum().T
+
+    def share(self, band, by='state', **where):
+        # each group's share of updates in one age band
+        df = self.totals(by, **where)
+        col = self.age_cols[self._band_index(band)[0]]
+        return (df[col] / df['total_updates']).rename(f'share_{self.bands[self.age_cols.index(col)]}')
+
+
+def _as_list(values):
+    return [values] if isinstance(values, str) else list(values)
+
+
+def _period_start(grain, value):
+    # first day label a start date falls into (weeks are labelled by Sunday)
+    ts = pd.Timestamp(value)
+    if grain == 'week':
+        return week_dates(day_weeks([(ts - pd.Timestamp(0)).days]))[0]
+    if grain == 'month':
+        return ts.to_period('M').to_timestamp()
+    return ts
+
+
+if __name__ == '__main__':
+    # query a built cube from the command line
+    parser = argparse.ArgumentParser(description='Query the pre-aggregated update cube.')
+    parser.add_argument('prefix', nargs='?', default='demo')
+    parser.add_argument('--by', default='state', help="'state', 'state_norm', 'district' or 'none' (series only)")
+    parser.add_argument('--grain', choices=GRAINS, default=None, help='print a time series at this grain')
+    parser.add_argument('--state', default=None, help='comma-separated states')
+    parser.add_argument('--district', default=None, help='comma-separated districts')
+    parser.add_argument('--start', default=None)
+    parser.add_argument('--end', default=None)
+    parser.add_argument('--band', default=None, help="age band, e.g. '5_17'")
+    parser.add_argument('--share', action='store_true', help="each group's share of updates in --band")
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+    if not os.path.exists(os.path.join(CUBE_DIR, args.prefix, 'meta.json')):
+        sys.exit(f'no cube for {args.prefix!r}; run analysis/analytics.py first')
+    t0 = time.perf_counter()
+    cube = Cube.open(args.prefix)
+    where = {'states': args.state.split(',') if args.state else None,
+             'districts': args.district.split(',') if args.district else None,
+             'start': args.start, 'end': args.end}
+    by = None if args.by == 'none' else args.by
+    if args.grain:
+        out = cube.series(args.grain, by, bands=args.band, **where)
+    elif args.share:
+        out = cube.share(args.band, by, **where).sort_values(ascending=False).head(args.top)
+    else:
+        out = cube.top(args.top, by, bands=args.band, **where)
+    elapsed = time.perf_counter() - t0
+    print(out.to_markdown())
+    print(f'({elapsed * 1000:.1f} ms)')
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+
+from accumulators import KeyCodec
+from schema import NO_DAY
+
+DEFAULT_DATE_FORMAT = '%d-%m-%Y'
+# per-dataset date formats of the API files
+DATE_FORMATS = {'demo': DEFAULT_DATE_FORMAT, 'bio': DEFAULT_DATE_FORMAT}
+
+
+def date_format(prefix):
+    return DATE_FORMATS.get(prefix, DEFAULT_DATE_FORMAT)
+
+
+class DateDecoder:
+    # date strings -> int32 days since 1970-01-01 with one explicit format; a
+    # column holds a few hundred distinct dates over millions of rows, so each
+    # distinct string is parsed once and memoized across chunks and files, and
+    # rows are mapped by code lookup
+    def __init__(self, fmt=DEFAULT_DATE_FORMAT):
+        self.fmt = fmt
+        self.memo = KeyCodec()
+        self.days = np.zeros(0, dtype=np.int32)
+        # rows per memo code that failed to parse, plus rows with no date at all
+        self.bad_counts = np.zeros(0, dtype=np.int64)
+        self.missing = 0
+
+    def decode(self, values):
+        codes = self.memo.encode(values)
+        done = len(self.days)
+        if done < len(self.memo):
+            new = pd.Series(self.memo.values[done:], dtype=object).astype(str).str.strip()
+            parsed = pd.to_datetime(new, format=self.fmt, errors='coerce')
+            days = np.full(len(new), NO_DAY, dtype=np.int32)
+            ok = parsed.notna().to_numpy()
+            days[ok] = parsed[ok].to_numpy().astype('datetime64[D]').astype(np.int64)
+            self.days = np.concatenate([self.days, days])
+            self.bad_counts = np.concatenate([self.bad_counts, np.zeros(len(new), dtype=np.int64)])
+        out = np.append(self.days, NO_DAY)[codes]
+        bad = (out == NO_DAY) & (codes >= 0)
+        if bad.any():
+            np.add.at(self.bad_counts, codes[bad], 1)
+        self.missing += int((codes < 0).sum())
+        return out
+
+    def bad_values(self):
+        # {raw value: rows} for every string that did not match the format
+        idx = np.flatnonzero(self.bad_counts)
+        out = {str(v): int(n) for v, n in zip(self.memo.values[idx], self.bad_counts[idx])}
+        if self.missing:
+            out['<missing>'] = self.missing
+        return out
+
+    def take_bad_values(self):
+        # bad values seen since the last call
+        out = self.bad_values()
+        self.bad_counts[:] = 0
+        self.missing = 0
+        return out
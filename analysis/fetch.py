@@ -0,0 +1,659 @@
+import os
+import re
+import sys
+import ssl
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from urllib.request import urlopen
+
+import numpy as np
+
+from cache import ColumnarCache, CACHE_DIR
+from dates import date_format
+from synth import FOLDERS, DATASET_SEEDS, Geography, STATES, day_counts, chunk_lines, header, parse_count
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGE_ROWS = 100_000
+CONCURRENCY = 4
+# requests started per second, over all datasets
+RATE = 5.0
+RETRIES = 6
+# backoff before retry n is uniform in [0, min(BACKOFF_CAP, BACKOFF * 2 ** n)]
+BACKOFF = 0.5
+BACKOFF_CAP = 30.0
+# seconds without a byte from the server before a request is given up
+READ_TIMEOUT = 60.0
+BLOCK = 1 << 16
+RETRY_STATUS = {429, 500, 502, 503, 504}
+STAND_IN_PORT = 8092
+
+
+class FetchError(Exception):
+    pass
+
+
+def page_ranges(folder):
+    # (start, end) record ranges of the pages already on disk, from the
+    # <folder>_<start>_<end>.csv names; pages are only renamed to these
+    # names once complete
+    pattern = re.compile(re.escape(os.path.basename(folder)) + r'_(\d+)_(\d+)\.csv$')
+    ranges = []
+    if os.path.isdir(folder):
+        for name in os.listdir(folder):
+            m = pattern.match(name)
+            if m:
+                ranges.append((int(m.group(1)), int(m.group(2))))
+    return sorted(ranges)
+
+
+class PagePlan:
+    # offsets still to fetch: the gaps between the pages on disk, then pages
+    # past the last one until a page comes back short. The source grows
+    # over time, so the tail is probed again on every run
+    def __init__(self, done, page_rows, max_rows=None):
+        self.page_rows = page_rows
+        self.pages = []
+        tail = 0
+        for start, end in done:
+            for lo in range(tail, start, page_rows):
+                self.pages.append((lo, min(page_rows, start - lo)))
+            tail = max(tail, end)
+        self.pages.reverse()
+        self.tail = tail
+        # pages from here on are new; a short one marks the end of the source
+        self.open_from = tail
+        self.end = max_rows
+
+    def next(self):
+        # (offset, limit), or None when nothing is left
+        if self.pages:
+            return self.pages.pop()
+        if self.end is not None and self.tail >= self.end:
+            return None
+        lo = self.tail
+        limit = self.page_rows if self.end is None else min(self.page_rows, self.end - lo)
+        self.tail += limit
+        return lo, limit
+
+    def finish(self, offset, limit, rows):
+        if rows < limit and offset >= self.open_from:
+            self.end = offset + rows if self.end is None else min(self.end, offset + rows)
+
+
+class RateLimiter:
+    # token bucket shared by every request; a 429 pauses all of them
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.t = time.monotonic()
+        self.not_before = 0.0
+
+    def pause(self, seconds):
+        self.not_before = max(self.not_before, time.monotonic() + seconds)
+
+    async def wait(self):
+        while True:
+            now = time.monotonic()
+            if now < self.not_before:
+                await asyncio.sleep(self.not_before - now)
+                continue
+            self.tokens = min(self.burst, self.tokens + (now - self.t) * self.rate)
+            self.t = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Response:
+    def __init__(self, pool, conn, status, headers):
+        self.pool = pool
+        self.conn = conn
+        self.status = status
+        self.headers = headers
+        self.complete = False
+
+    async def _read(self, n):
+        data = await asyncio.wait_for(self.conn[0].read(n), READ_TIMEOUT)
+        if not data and n:
+            raise asyncio.IncompleteReadError(b'', n)
+        return data
+
+    async def body(self):
+        # the body in blocks of at most BLOCK bytes, as they arrive
+        reader = self.conn[0]
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                line = await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+                size = int(line.split(b';')[0], 16)
+                if size == 0:
+                    # trailers, up to the blank line
+                    while (await asyncio.wait_for(reader.readline(), READ_TIMEOUT)).strip():
+                        pass
+                    break
+                while size:
+                    data = await self._read(min(BLOCK, size))
+                    size -= len(data)
+                    yield data
+                await asyncio.wait_for(reader.readexactly(2), READ_TIMEOUT)
+        elif 'content-length' in self.headers:
+            left = int(self.headers['content-length'])
+            while left:
+                data = await self._read(min(BLOCK, left))
+                left -= len(data)
+                yield data
+        else:
+            # delimited by the server closing the connection
+            self.headers['connection'] = 'close'
+            while True:
+                data = await asyncio.wait_for(reader.read(BLOCK), READ_TIMEOUT)
+                if not data:
+                    break
+                yield data
+        self.complete = True
+
+    async def read(self):
+        return b''.join([data async for data in self.body()])
+
+    def release(self):
+        # a fully read keep-alive connection goes back to the pool
+        keep = self.complete and self.headers.get('connection', '').lower() != 'close'
+        self.pool.release(self.conn, keep)
+
+
+class ConnectionPool:
+    # keep-alive HTTP/1.1 connections to one host, at most `size` in use; a
+    # connection goes back to the pool only once its response was read to the end
+    def __init__(self, url, size):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.https = parts.scheme == 'https'
+        self.port = parts.port or (443 if self.https else 80)
+        self.netloc = parts.netloc
+        self.idle = []
+        self.slots = asyncio.Semaphore(size)
+        self.opened = 0
+
+    async def _open(self):
+        self.opened += 1
+        return await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=ssl.create_default_context() if self.https else None),
+            READ_TIMEOUT)
+
+    async def request(self, target):
+        # GET target -> Response; the caller reads it and calls release()
+        await self.slots.acquire()
+        try:
+            while True:
+                reused = bool(self.idle)
+                conn = self.idle.pop() if reused else await self._open()
+                try:
+                    conn[1].write(f'GET {target} HTTP/1.1\r\nHost: {self.netloc}\r\nUser-Agent: uidai-fetch\r\n'
+                                  f'Accept: text/csv\r\nAccept-Encoding: identity\r\n\r\n'.encode())
+                    await conn[1].drain()
+                    head = await asyncio.wait_for(conn[0].readuntil(b'\r\n\r\n'), READ_TIMEOUT)
+                    break
+                except (OSError, asyncio.IncompleteReadError):
+                    conn[1].close()
+                    # the server may have dropped an idle connection: one
+                    # more try on a fresh one; errors on a fresh one are real
+                    if not reused:
+                        raise
+            lines = head.decode('latin-1').split('\r\n')
+            status = int(lines[0].split()[1])
+            headers = {}
+            for line in lines[1:]:
+                if ':' in line:
+                    k, v = line.split(':', 1)
+                    headers[k.strip().lower()] = v.strip()
+            return Response(self, conn, status, headers)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def release(self, conn, keep):
+        if keep:
+            self.idle.append(conn)
+        else:
+            conn[1].close()
+        self.slots.release()
+
+    def close(self):
+        for conn in self.idle:
+            conn[1].close()
+        self.idle = []
+
+
+def page_url(template, folder, prefix, offset, limit, api_key=None):
+    # {offset}, {limit}, {folder} and {prefix} are filled in; without an
+    # {offset} field they are added as query parameters
+    fields = {'offset': offset, 'limit': limit, 'folder': folder, 'prefix': prefix}
+    url = template.format(**fields)
+    query = {} if '{offset}' in template else {'offset': offset, 'limit': limit}
+    if api_key:
+        query['api-key'] = api_key
+    if query:
+        url += ('&' if urlsplit(url).query else '?') + urlencode(query)
+    return url
+
+
+async def fetch_page(pool, limiter, url, folder, offset, stats, retries=RETRIES):
+    # GET one page and stream it into <folder>_<offset>_<end>.csv, renamed
+    # into place when complete; returns the number of rows (0: past the end)
+    parts = urlsplit(url)
+    target = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+    name = os.path.basename(folder)
+    tmp = os.path.join(folder, f'.{name}_{offset}.part')
+    for attempt in range(retries + 1):
+        await limiter.wait()
+        retry_after = None
+        try:
+            resp = await pool.request(target)
+            try:
+                if resp.status == 200:
+                    rows, size, first, last = 0, 0, None, b'\n'
+                    with open(tmp, 'wb') as f:
+                        async for data in resp.body():
+                            if first is None:
+                                first = data
+                            elif len(first) < 256:
+                                first += data
+                            f.write(data)
+                            rows += data.count(b'\n')
+                            size += len(data)
+                            last = data[-1:]
+                        if last != b'\n':
+                            f.write(b'\n')
+                            rows += 1
+                    head = (first or b'').split(b'\n', 1)[0]
+                    if b'state' not in head.split(b','):
+                        # an error document served as a page (bad key, quota)
+                        os.remove(tmp)
+                        raise FetchError(f'{url}: not a CSV page: {head[:200]!r}')
+                    rows -= 1
+                    stats['bytes'] += size
+                    if rows <= 0:
+                        os.remove(tmp)
+                        return 0
+                    os.replace(tmp, os.path.join(folder, f'{name}_{offset}_{offset + rows}.csv'))
+                    return rows
+                body = await resp.read()
+                if resp.status not in RETRY_STATUS:
+                    raise FetchError(f'{url}: HTTP {resp.status}: {body[:200]!r}')
+                stats[f'http_{resp.status}'] += 1
+                retry_after = resp.headers.get('retry-after')
+            finally:
+                resp.release()
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError) as e:
+            # dropped connections, truncated bodies, timeouts, garbled heads
+            stats['errors'] += 1
+            last_error = e
+        else:
+            last_error = f'HTTP {resp.status}'
+        if attempt == retries:
+            break
+        stats['retries'] += 1
+        if retry_after is not None and retry_after.isdigit():
+            delay = float(retry_after)
+            limiter.pause(delay)
+        else:
+            delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF * 2 ** attempt))
+        await asyncio.sleep(delay)
+    raise FetchError(f'{url}: gave up after {retries + 1} attempts ({last_error})')
+
+
+def _cache_page(path, prefix, cache_dir):
+    # worker: build the columnar cache entry of a finished page
+    return len(ColumnarCache(cache_dir).get(path, date_format(prefix)))
+
+
+async def fetch_dataset(prefix, template, out_dir, pool, limiter, page_rows=PAGE_ROWS, concurrency=CONCURRENCY,
+                        retries=RETRIES, max_rows=None, api_key=None, cache_pool=None, cache_dir=CACHE_DIR):
+    # every page of one dataset not yet on disk, `concurrency` at a time
+    folder = os.path.join(out_dir, FOLDERS[prefix])
+    os.makedirs(folder, exist_ok=True)
+    for name in os.listdir(folder):
+        if name.endswith('.part'):
+            # left by an interrupted run
+            os.remove(os.path.join(folder, name))
+    done = page_ranges(folder)
+    plan = PagePlan(done, page_rows, max_rows)
+    stats = {'dataset': prefix, 'on_disk': len(done), 'pages': 0, 'rows': 0, 'bytes': 0, 'retries': 0,
+             'errors': 0, 'cached': 0}
+    counters = {k: 0 for k in ('retries', 'errors', 'bytes')}
+    counters.update({f'http_{s}': 0 for s in RETRY_STATUS})
+    cached = []
+    loop = asyncio.get_running_loop()
+
+    async def worker():
+        while True:
+            page = plan.next()
+            if page is None:
+                return
+            offset, limit = page
+            url = page_url(template, FOLDERS[prefix], prefix, offset, limit, api_key)
+            rows = await fetch_page(pool, limiter, url, folder, offset, counters, retries)
+            plan.finish(offset, limit, rows)
+            if rows:
+                stats['pages'] += 1
+                stats['rows'] += rows
+                if cache_pool is not None:
+                    path = os.path.join(folder, f'{FOLDERS[prefix]}_{offset}_{offset + rows}.csv')
+                    cached.append(loop.run_in_executor(cache_pool, _cache_page, path, prefix, cache_dir))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    stats['cached'] = sum(await asyncio.gather(*cached))
+    stats.update({k: v for k, v in counters.items() if v or not k.startswith('http_')})
+    stats['end'] = plan.end
+    return stats
+
+
+async def fetch_all(template, datasets=('demo', 'bio'), out_dir=BASE_DIR, page_rows=PAGE_ROWS,
+                    concurrency=CONCURRENCY, rate=RATE, retries=RETRIES, max_rows=None, api_key=None,
+                    cache=False, cache_dir=CACHE_DIR):
+    # the datasets are fetched side by side over one connection pool per
+    # host and one rate limit; returns {prefix: stats}
+    limiter = RateLimiter(rate, burst=concurrency)
+    urls = {prefix: page_url(template, FOLDERS[prefix], prefix, 0, 1) for prefix in datasets}
+    hosts = [urlsplit(url).netloc for url in urls.values()]
+    pools = {}
+    for url, netloc in zip(urls.values(), hosts):
+        if netloc not in pools:
+            pools[netloc] = ConnectionPool(url, concurrency * hosts.count(netloc))
+    dataset_pool = {prefix: pools[netloc] for prefix, netloc in zip(urls, hosts)}
+    cache_pool = ProcessPoolExecutor(max_workers=os.cpu_count()) if cache else None
+    t0 = time.perf_counter()
+    try:
+        results = await asyncio.gather(*(
+            fetch_dataset(prefix, template, out_dir, dataset_pool[prefix], limiter, page_rows, concurrency, retries,
+                          max_rows, api_key, cache_pool, cache_dir)
+            for prefix in datasets))
+    finally:
+        for pool in pools.values():
+            pool.close()
+        if cache_pool is not None:
+            cache_pool.shutdown(cancel_futures=True)
+    elapsed = time.perf_counter() - t0
+    for stats in results:
+        stats['seconds'] = round(elapsed, 3)
+        stats['connections'] = sum(p.opened for p in pools.values())
+    return {stats['dataset']: stats for stats in results}
+
+
+class StandIn:
+    # generated API pages: rows [offset, offset + limit) of a synth dataset.
+    # Rows are built in fixed blocks, so the same offset always holds the
+    # same row whatever the page size
+    BLOCK_ROWS = 50_000
+
+    def __init__(self, rows=1_000_000, seed=91, start='2025-03-01', days=300, states=len(STATES), dirty=0.001):
+        self.rows = int(rows)
+        self.dirty = dirty
+        self.geo = Geography(seed, states)
+        self.series = {}
+        for prefix in FOLDERS:
+            dseed = seed + DATASET_SEEDS[prefix]
+            dates, counts = day_counts(self.rows, start, days, dseed)
+            self.series[prefix] = (dates, np.cumsum(counts), dseed)
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _block(self, prefix, b):
+        key = (prefix, b)
+        with self.lock:
+            if key in self.blocks:
+                self.blocks.move_to_end(key)
+                return self.blocks[key]
+        dates, cum, seed = self.series[prefix]
+        lo = b * self.BLOCK_ROWS
+        lines = chunk_lines(self.geo, prefix, dates, cum, lo, min(self.rows, lo + self.BLOCK_ROWS), seed, self.dirty)
+        with self.lock:
+            self.blocks[key] = lines
+            while len(self.blocks) > 16:
+                self.blocks.popitem(last=False)
+        return lines
+
+    def page(self, prefix, offset, limit):
+        stop = min(self.rows, offset + limit)
+        lines = []
+        for b in range(offset // self.BLOCK_ROWS, (stop - 1) // self.BLOCK_ROWS + 1 if stop > offset else 0):
+            lo = b * self.BLOCK_ROWS
+            lines += self._block(prefix, b)[max(offset - lo, 0):stop - lo]
+        return (header(prefix) + ''.join(line + '\n' for line in lines)).encode()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # GET /<API folder>?offset=..&limit=.. -> CSV page. With probability
+    # fail_rate a request gets a 429 (Retry-After), a 503, or a body cut
+    # off halfway, so clients exercise their retries
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        prefixes = {folder: prefix for prefix, folder in FOLDERS.items()}
+        if url.path == '/':
+            self._send(200, b'ok\n', 'text/plain')
+            return
+        prefix = prefixes.get(url.path.strip('/'))
+        if prefix is None:
+            self._send(404, b'{"error": "unknown resource"}', 'application/json')
+            return
+        params = dict(parse_qsl(url.query))
+        try:
+            offset, limit = int(params.get('offset', 0)), int(params.get('limit', PAGE_ROWS))
+        except ValueError:
+            self._send(400, b'{"error": "bad offset or limit"}', 'application/json')
+            return
+        fault = self.server.fault()
+        if fault == 429:
+            self._send(429, b'{"error": "rate limited"}', 'application/json', {'Retry-After': '1'})
+            return
+        if fault == 503:
+            self._send(503, b'{"error": "unavailable"}', 'application/json')
+            return
+        body = self.server.stand_in.page(prefix, offset, limit)
+        if fault == 'cut':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/csv')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.close_connection = True
+            self._write(body[:len(body) // 2])
+            return
+        self._send(200, body, 'text/csv')
+
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self._write(body)
+
+    def _write(self, body):
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client gave up on the request (a cancelled run)
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_stand_in(host='127.0.0.1', port=STAND_IN_PORT, rows=1_000_000, seed=91, fail_rate=0.0, quiet=False):
+    server = ThreadingHTTPServer((host, port), StandInHandler)
+    server.daemon_threads = True
+    server.stand_in = StandIn(rows, seed)
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    def fault():
+        with lock:
+            if rng.random() >= fail_rate:
+                return None
+            return rng.choice([429, 503, 'cut'])
+
+    server.fault = fault
+    if not quiet:
+        print(f'stand-in API: {rows:,} rows per dataset on http://{host}:{server.server_port}/'
+              f'<{"|".join(FOLDERS.values())}>?offset=..&limit=..', flush=True)
+    server.serve_forever()
+
+
+def stand_in_url(port=STAND_IN_PORT):
+    return f'http://127.0.0.1:{port}/{{folder}}?offset={{offset}}&limit={{limit}}'
+
+
+def start_stand_in(port=STAND_IN_PORT, rows=1_000_000, seed=91, fail_rate=0.0):
+    # stand-in API in its own process, so it does not share the client's interpreter
+    server = multiprocessing.Process(target=serve_stand_in, args=('127.0.0.1', port, rows, seed, fail_rate, True),
+                                     daemon=True)
+    server.start()
+    for _ in range(100):
+        try:
+            urlopen(f'http://127.0.0.1:{port}/').read()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.terminate()
+    raise FetchError(f'stand-in API did not start on port {port}')
+
+
+def folder_digest(folder):
+    # sha1 of the rows of every page on disk, in offset order, headers left out
+    digest = hashlib.sha1()
+    rows = 0
+    for start, end in page_ranges(folder):
+        with open(os.path.join(folder, f'{os.path.basename(folder)}_{start}_{end}.csv'), 'rb') as f:
+            f.readline()
+            for data in iter(lambda: f.read(BLOCK), b''):
+                digest.update(data)
+                rows += data.count(b'\n')
+    return rows, digest.hexdigest()
+
+
+def check(rows=300_000, page_rows=20_000, concurrency=CONCURRENCY, rate=50.0, fail_rate=0.05, seed=91):
+    # fetch from a faulty stand-in, interrupt the first run halfway, resume,
+    # and compare what is on disk (and in the cache) with the source rows
+    port = STAND_IN_PORT + 1
+    server = start_stand_in(port, rows, seed, fail_rate)
+    template = stand_in_url(port)
+    ok = True
+    try:
+        with tempfile.TemporaryDirectory() as root:
+            cache_dir = os.path.join(root, 'cache')
+
+            async def interrupted():
+                task = asyncio.ensure_future(fetch_all(template, out_dir=root, page_rows=page_rows,
+                                                       concurrency=concurrency, rate=rate))
+                half = rows // page_rows
+                while not task.done() and sum(len(page_ranges(os.path.join(root, f))) for f in FOLDERS.values()) < half:
+                    await asyncio.sleep(0.02)
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+
+            t0 = time.perf_counter()
+            asyncio.run(interrupted())
+            first = {p: len(page_ranges(os.path.join(root, f))) for p, f in FOLDERS.items()}
+            print(f'interrupted after {time.perf_counter() - t0:.1f}s with pages on disk: {first}')
+            # the resumed run also fills the columnar cache as pages land
+            results = asyncio.run(fetch_all(template, out_dir=root, page_rows=page_rows, concurrency=concurrency,
+                                            rate=rate, cache=True, cache_dir=cache_dir))
+            stand_in = StandIn(rows, seed)
+            for prefix, stats in results.items():
+                print(json.dumps(stats))
+                got = folder_digest(os.path.join(root, FOLDERS[prefix]))
+                source = stand_in.page(prefix, 0, rows)
+                want = (rows, hashlib.sha1(source[len(header(prefix)):]).hexdigest())
+                if got != want:
+                    ok = False
+                    print(f'{prefix}: {got[0]:,} rows on disk differ from the {rows:,} source rows')
+                elif stats['on_disk'] != first[prefix] or stats['cached'] != stats['rows']:
+                    ok = False
+                    print(f'{prefix}: did not resume from the {first[prefix]} pages on disk, or cached '
+                          f'{stats["cached"]:,} of {stats["rows"]:,} rows')
+    finally:
+        server.terminate()
+    print('fetched == source' if ok else 'fetched != source')
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Fetch Aadhaar API pages concurrently, resuming from the pages on disk.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('fetch', help='fetch every page not yet on disk')
+    p.add_argument('--url', default=os.environ.get('AADHAAR_API_URL'),
+                   help='page URL template with {offset}, {limit}, {folder} and {prefix} fields '
+                        '(default: $AADHAAR_API_URL); offset/limit are appended when the template has no {offset}')
+    p.add_argument('--stand-in', action='store_true', help='fetch from a local stand-in API serving generated pages')
+    p.add_argument('--datasets', default='demo,bio')
+    p.add_argument('--out', default=BASE_DIR, help='directory holding the API folders')
+    p.add_argument('--page-rows', type=parse_count, default=PAGE_ROWS)
+    p.add_argument('--concurrency', type=int, default=CONCURRENCY, help='requests in flight per dataset')
+    p.add_argument('--rate', type=float, default=RATE, help='requests started per second')
+    p.add_argument('--retries', type=int, default=RETRIES)
+    p.add_argument('--max-rows', type=parse_count, default=None, help='stop at this record offset')
+    p.add_argument('--cache', action='store_true', help='build the columnar cache of each page as it lands')
+    p.add_argument('--rows', type=parse_count, default=1_000_000, help='stand-in rows per dataset')
+    p = sub.add_parser('stand-in', help='serve generated API pages')
+    p.add_argument('--port', type=int, default=STAND_IN_PORT)
+    p.add_argument('--rows', type=parse_count, default=1_000_000, help='rows per dataset')
+    p.add_argument('--seed', type=int, default=91)
+    p.add_argument('--fail-rate', type=float, default=0.0, help='share of requests answered 429/503 or cut short')
+    p = sub.add_parser('check', help='interrupted and resumed fetch from a faulty stand-in, checked row for row')
+    p.add_argument('--rows', type=parse_count, default=300_000)
+    p.add_argument('--page-rows', type=parse_count, default=20_000)
+    p.add_argument('--concurrency', type=int, default=CONCURRENCY)
+    p.add_argument('--rate', type=float, default=50.0)
+    p.add_argument('--fail-rate', type=float, default=0.05)
+    args = parser.parse_args(argv)
+
+    if args.command == 'stand-in':
+        serve_stand_in(port=args.port, rows=args.rows, seed=args.seed, fail_rate=args.fail_rate)
+    elif args.command == 'check':
+        if not check(args.rows, args.page_rows, args.concurrency, args.rate, args.fail_rate):
+            sys.exit(1)
+    else:
+        datasets = [d.strip() for d in args.datasets.split(',') if d.strip()]
+        unknown = set(datasets) - set(FOLDERS)
+        if unknown:
+            sys.exit(f'unknown datasets: {", ".join(sorted(unknown))} (expected demo, bio)')
+        server = None
+        if args.stand_in:
+            server = start_stand_in(rows=args.rows)
+            args.url = stand_in_url()
+        if not args.url:
+            sys.exit('no page URL: pass --url, set AADHAAR_API_URL, or use --stand-in')
+        try:
+            results = asyncio.run(fetch_all(args.url, datasets, args.out, args.page_rows, args.concurrency, args.rate,
+                                            args.retries, args.max_rows, os.environ.get('DATA_GOV_API_KEY'),
+                                            args.cache))
+        finally:
+            if server is not None:
+                server.terminate()
+        for prefix, s in results.items():
+            print(f'{prefix}: {s["pages"]} pages, {s["rows"]:,} rows, {s["bytes"] / 2 ** 20:.1f} MB in {s["seconds"]:.1f}s '
+                  f'({s["rows"] / max(s["seconds"], 1e-9):,.0f} rows/s); {s["on_disk"]} pages already on disk, '
+                  f'{s["retries"]} retries')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+import os
+import signal
+import warnings
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from statsmodels.tsa.holtwinters import ExponentialSmoothing
+
+import hw_batch
+from regions import normalize
+
+try:
+    import pyarrow  # noqa: F401  (optional: enables the Parquet output)
+except ImportError:
+    pyarrow = None
+
+HORIZON_WEEKS = 12  # ~3 months
+# seconds one series may spend fitting before it falls back to the mean
+SERIES_TIMEOUT = 30
+FORECAST_COLUMNS = ['kind', 'state', 'district', 'week', 'historical', 'forecast', 'method']
+# 'statsmodels' fits one model per series; 'batch' fits them all at once with
+# hw_batch (forecasts within hw_batch.TOLERANCE_* of statsmodels)
+ENGINES = ('statsmodels', 'batch')
+# bump when model fitting changes, so stored models are not reused
+MODEL_VERSION = 1
+
+
+def display_spellings(keys, raw, totals):
+    # normalized key -> highest-volume raw spelling
+    df = pd.DataFrame({'key': keys, 'raw': raw, 'total': totals})
+    df = df.groupby(['key', 'raw'])['total'].sum().sort_values(ascending=False, kind='stable').reset_index()
+    return df.drop_duplicates('key').set_index('key')['raw'].to_dict()
+
+
+class SeriesIndex:
+    # the daily state/district/date frame grouped once by normalized state and
+    # district; each series is a slice of a sorted index, not a filter over
+    # every row of the frame
+    def __init__(self, daily):
+        state = normalize(daily['state'])
+        district = normalize(daily['district'])
+        totals = daily['total_updates'].to_numpy()
+        frame = pd.DataFrame({'state': state, 'district': district,
+                              'date': pd.to_datetime(daily['date']), 'total_updates': totals})
+        self.districts = frame.groupby(['state', 'district', 'date'])['total_updates'].sum().sort_index()
+        self.states = self.districts.groupby(level=['state', 'date']).sum().sort_index()
+        self.state_names = display_spellings(state, daily['state'].to_numpy(), totals)
+        self.district_names = display_spellings(list(zip(state, district)), daily['district'].to_numpy(), totals)
+
+    def state_keys(self):
+        return list(self.states.index.unique(level='state'))
+
+    def district_keys(self):
+        return list(self.districts.index.droplevel('date').unique())
+
+    def state_series(self, state):
+        return self.states.xs(state, level='state')
+
+    def district_series(self, state, district):
+        return self.districts.xs((state, district), level=['state', 'district'])
+
+    def tasks(self, periods=HORIZON_WEEKS, timeout=SERIES_TIMEOUT):
+        # one picklable task per state and per district series, holding the
+        # weekly series and (filled in by run_forecasts) warm-start parameters
+        out = [('state', s, '', weekly(self.state_series(s)), periods, timeout, None) for s in self.state_keys()]
+        out += [('district', s, d, weekly(self.district_series(s, d)), periods, timeout, None)
+                for s, d in self.district_keys()]
+        return out
+
+
+def weekly(series):
+    # weekly totals; resampling is idempotent, so the fits may resample again
+    return series.resample('W').sum()
+
+
+def fit_and_forecast(series, periods):
+    return fit_model(series, periods)[:3]
+
+
+def fit_model(series, periods, start=None):
+    # start: parameters of an earlier fit of the same series, used as the
+    # optimizer's starting point (no brute-force grid) when the model shape
+    # still matches; returns (weekly, forecast, method, params)
+    # resample weekly to reduce noise
+    s = series.resample('W').sum()
+    # choose seasonal if enough data
+    seasonal = None
+    sp = None
+    if len(s) >= 26:
+        # assume yearly seasonality on weekly data (~52)
+        seasonal = 'add'
+        sp = 52
+    try:
+        model = ExponentialSmoothing(s, trend='add', seasonal=seasonal, seasonal_periods=sp, damped_trend=False)
+        fit = None
+        if start is not None and start.get('tier') == hw_batch.tier(len(s)):
+            x0 = [start['alpha'], start['beta']] + ([start['gamma']] if seasonal else [])
+            x0 += [start['level'], start['trend']] + (list(start['season0']) if seasonal else [])
+            try:
+                fit = model.fit(optimized=True, start_params=x0, use_brute=False)
+            except Exception:
+                fit = None
+        if fit is None:
+            fit = model.fit(optimized=True)
+        p = fit.params
+        params = {'tier': hw_batch.tier(len(s)), 'alpha': float(p['smoothing_level']),
+                  'beta': float(p['smoothing_trend']), 'gamma': float(p['smoothing_seasonal'] or 0.0),
+                  'level': float(p['initial_level']), 'trend': float(p['initial_trend']),
+                  'season0': [float(v) for v in p['initial_seasons']] if seasonal else None}
+        return s, fit.forecast(periods), 'holt_winters', params
+    except Exception:
+        # fallback: simple last-value repeat
+        return s, mean_forecast(s, periods), 'mean', None
+
+
+def mean_forecast(s, periods):
+    return pd.Series([s.mean()] * periods,
+                     index=pd.date_range(s.index[-1] + pd.Timedelta(weeks=1), periods=periods, freq='W'))
+
+
+class FitTimeout(BaseException):
+    # BaseException so the broad fallback in fit_model does not swallow it
+    pass
+
+
+def _alarm(signum, frame):
+    raise FitTimeout()
+
+
+def forecast_series(task):
+    # worker: one series -> (long-format rows of its weekly history and
+    # forecast, fitted parameters); a fit running past the timeout is
+    # interrupted and replaced by the mean
+    kind, state, district, series, periods, timeout, start = task
+    # signal handlers can only be set from the main thread
+    use_alarm = (bool(timeout) and hasattr(signal, 'SIGALRM')
+                 and threading.current_thread() is threading.main_thread())
+    if use_alarm:
+        previous = signal.signal(signal.SIGALRM, _alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            hist, fc, method, params = fit_model(series, periods, start)
+    except FitTimeout:
+        hist = series.resample('W').sum()
+        fc, method, params = mean_forecast(hist, periods), 'timeout', None
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+    return _series_rows(kind, state, district, hist, fc, method), params
+
+
+def forecast_batch(tasks):
+    # worker: a block of series fitted together by the batched engine
+    if not tasks:
+        return []
+    hists = [t[3] for t in tasks]
+    fitted = hw_batch.forecast_weekly(hists, tasks[0][4], [t[6] for t in tasks])
+    return [(_series_rows(kind, state, district, hist, fc, method), params)
+            for (kind, state, district, *_), hist, (fc, method, params) in zip(tasks, hists, fitted)]
+
+
+def _series_rows(kind, state, district, hist, fc, method):
+    df = pd.concat([hist.rename('historical'), fc.rename('forecast')], axis=1)
+    df.index.name = 'week'
+    df = df.reset_index()
+    df.insert(0, 'kind', kind)
+    df.insert(1, 'state', state)
+    df.insert(2, 'district', district)
+    df['method'] = method
+    return df
+
+
+def run_forecasts(tasks, workers=1, engine='statsmodels', store=None):
+    # every series over a process pool; results keep task order. With a
+    # model_store.ModelStore, unchanged series are served from it, extended
+    # ones are refit from their stored parameters, and new fits are stored.
+    if not tasks:
+        return pd.DataFrame(columns=FORECAST_COLUMNS)
+    config = f'{engine}:{tasks[0][4]}:v{MODEL_VERSION}'
+    frames = [None] * len(tasks)
+    todo = []
+    for i, task in enumerate(tasks):
+        status, found = store.lookup(series_key(task), task[3], config) if store is not None else ('miss', None)
+        if status == 'hit':
+            frames[i] = _series_rows(*task[:4], found['forecast'], found['method'])
+        else:
+            todo.append((i, task[:6] + (found,)))
+    fitted = _fit_tasks([t for _, t in todo], workers, engine)
+    for (i, task), (df, params) in zip(todo, fitted):
+        frames[i] = df
+        method = df['method'].iloc[0]
+        if store is not None and method != 'timeout':
+            fc = df.set_index('week')['forecast'].dropna()
+            store.put(series_key(task), task[3], config, fc, method, params)
+    if store is not None:
+        store.save()
+    return pd.concat(frames, ignore_index=True)[FORECAST_COLUMNS]
+
+
+def series_key(task):
+    return '|'.join(task[:3])
+
+
+def _fit_tasks(tasks, workers, engine):
+    # [(rows, params)] in task order
+    if engine == 'batch':
+        # one block per worker, each block fitted as a single batch
+        size = max(1, -(-len(tasks) // max(workers, 1)))
+        blocks = [tasks[i:i + size] for i in range(0, len(tasks), size)]
+        if workers > 1 and len(blocks) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                return [r for block in pool.map(forecast_batch, blocks) for r in block]
+        return [r for block in blocks for r in forecast_batch(block)]
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(forecast_series, tasks, chunksize=max(1, len(tasks) // (workers * 8))))
+    return [forecast_series(t) for t in tasks]
+
+
+def with_display_names(df, index):
+    # normalized keys -> highest-volume raw spellings
+    out = df.copy()
+    keys = list(zip(df['state'], df['district']))
+    out['district'] = [index.district_names.get(k, d) if d else '' for k, d in zip(keys, df['district'])]
+    out['state'] = df['state'].map(index.state_names).fillna(df['state'])
+    return out
+
+
+def write_forecasts(df, out_dir, name='forecasts'):
+    # one consolidated table: Parquet when pyarrow is available, else CSV
+    if pyarrow is not None:
+        path = os.path.join(out_dir, f'{name}.parquet')
+        df.to_parquet(path, index=False)
+    else:
+        path = os.path.join(out_dir, f'{name}.csv')
+        df.to_csv(path, index=False)
+    return path
+
+
+def read_forecasts(out_dir):
+    path = os.path.join(out_dir, 'forecasts.parquet')
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+    return pd.read_csv(os.path.join(out_dir, 'forecasts.csv'), parse_dates=['week'], keep_default_na=False,
+                       na_values={'historical': [''], 'forecast': ['']})
+
+
+def series_frame(df, kind, state, district=''):
+    # historical/forecast columns by week for one series, as in the per-series CSVs
+    sel = df[(df['kind'] == kind) & (df['state'] == state) & (df['district'] == district)]
+    out = sel.set_index('week')[['historical', 'forecast']]
+    out.index.name = None
+    return out
+
+
+def indicators(df, name):
+    # per series: mean of the last 4 historical weeks and the forecast peak;
+    # name(kind, state, district) gives the series label
+    rows = []
+    for (kind, state, district), g in df.groupby(['kind', 'state', 'district'], sort=False):
+        hist = g['historical'].dropna()
+        fc = g.set_index('week')['forecast'].dropna()
+        rows.append({
+            'series': name(kind, state, district),
+            'recent_avg_weekly': float(hist.tail(4).mean() if len(hist) else 0),
+            'forecast_peak_week': str(fc.idxmax()) if len(fc) else None,
+            'forecast_peak_value': float(fc.max()) if len(fc) else None,
+        })
+    out = pd.DataFrame(rows, columns=['series', 'recent_avg_weekly', 'forecast_peak_week', 'forecast_peak_value'])
+    return out.sort_values('series', kind='stable', ignore_index=True)
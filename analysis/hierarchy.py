@@ -0,0 +1,257 @@
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.linalg import splu
+
+import hw_batch
+from cache import ColumnarCache
+from forecast import HORIZON_WEEKS, display_spellings, write_forecasts
+from regions import normalize
+from scan import new_codebook, make_aggregators, scan_folder
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEMO_DIR = os.path.join(BASE_DIR, 'api_data_aadhar_demographic')
+OUT_DIR = os.path.join(BASE_DIR, 'analysis', 'outputs', 'forecasts')
+LEVELS = ('total', 'state', 'district', 'pincode')
+RECONCILERS = ('bottom_up', 'top_down', 'ols', 'wls', 'mint')
+HIERARCHY_COLUMNS = ['level', 'state', 'district', 'pincode', 'week', 'base', 'forecast', 'method']
+# base-forecast rows fitted per batch
+FIT_BLOCK = 4096
+
+
+class Hierarchy:
+    # India -> state -> district -> pincode. Nodes are ordered total, states,
+    # districts, pincodes, so the first n_agg nodes are the aggregates and the
+    # rest are the leaves. S is the sparse (nodes x leaves) summing matrix and
+    # C the (aggregates x nodes) constraint matrix: each aggregate minus the
+    # sum of its children, so C @ y == 0 exactly when y is coherent.
+    def __init__(self, leaves):
+        # leaves: frame of normalized state, district and pincode, one row per leaf
+        leaves = leaves[['state', 'district', 'pincode']].reset_index(drop=True)
+        m = len(leaves)
+        state_code, states = pd.factorize(leaves['state'], sort=True)
+        pairs = pd.MultiIndex.from_frame(leaves[['state', 'district']])
+        district_code, districts = pd.factorize(pairs, sort=True)
+        ns, nd = len(states), len(districts)
+        self.n_agg = 1 + ns + nd
+        self.n = self.n_agg + m
+        self.leaves = leaves
+        district_state = pd.Index(states).get_indexer(districts.get_level_values(0))
+        self.nodes = pd.DataFrame({
+            'level': np.repeat(LEVELS, [1, ns, nd, m]),
+            'state': np.concatenate([[''], states, districts.get_level_values(0), leaves['state']]),
+            'district': np.concatenate([[''] * (1 + ns), districts.get_level_values(1), leaves['district']]),
+            'pincode': np.concatenate([[''] * self.n_agg, leaves['pincode'].astype(str)]),
+        })
+        # parent node of every node but the total
+        self.parent = np.concatenate([[-1], np.zeros(ns, dtype=np.int64), 1 + district_state,
+                                      1 + ns + district_code]).astype(np.int64)
+        leaf = np.arange(m)
+        rows = np.concatenate([np.zeros(m, dtype=np.int64), 1 + state_code, 1 + ns + district_code, self.n_agg + leaf])
+        self.S = sparse.csr_matrix((np.ones(4 * m), (rows, np.tile(leaf, 4))), shape=(self.n, m))
+        child = np.arange(1, self.n)
+        self.C = sparse.csr_matrix(
+            (np.concatenate([np.ones(self.n_agg), -np.ones(self.n - 1)]),
+             (np.concatenate([np.arange(self.n_agg), self.parent[1:]]), np.concatenate([np.arange(self.n_agg), child]))),
+            shape=(self.n_agg, self.n))
+
+    def __len__(self):
+        return self.n
+
+    def aggregate(self, leaf_values):
+        # (leaves x k) -> (nodes x k); sparse inputs stay sparse
+        return self.S @ leaf_values
+
+    def incoherence(self, values):
+        # largest |aggregate - sum of its children| over every column
+        return float(np.abs(self.C @ values).max()) if len(values) else 0.0
+
+
+def leaf_matrix(pincode_weekly):
+    # PincodeWeekly result -> (normalized leaves frame, week index, dense
+    # (leaves x weeks) totals with zeros for weeks a leaf had no rows)
+    df = pincode_weekly
+    keys = pd.DataFrame({'state': normalize(df['state']), 'district': normalize(df['district']),
+                         'pincode': pd.Index(df['pincode']).astype(str)})
+    leaf, leaves = pd.factorize(pd.MultiIndex.from_frame(keys), sort=True)
+    weeks = pd.date_range(df['week'].min(), df['week'].max(), freq='W')
+    col = weeks.get_indexer(df['week'])
+    Y = sparse.coo_matrix((df['total_updates'].to_numpy(dtype=float), (leaf, col)),
+                          shape=(len(leaves), len(weeks))).toarray()
+    return leaves.set_names(['state', 'district', 'pincode']).to_frame(index=False), weeks, Y
+
+
+def _fit_block(Y, n, periods):
+    # worker: base forecasts, in-sample variance and one-step errors of one
+    # block of nodes
+    Y = np.asarray(Y, dtype=float)
+    fc, method, sse, _, err = hw_batch.fit_forecast(Y, n, periods, errors=True)
+    # mean-fallback rows have no SSE; their spread around the mean stands in
+    var = np.where(np.isnan(sse), (err ** 2).sum(axis=1), sse) / np.maximum(n, 1)
+    return fc, method, var, err
+
+
+def _shrinkage(resid):
+    # Schafer-Strimmer shrinkage of the residual correlations towards the
+    # identity. resid is (nodes x weeks), calendar-aligned and zero where a
+    # node had no history yet. Every sum over node pairs goes through the
+    # (weeks x weeks) Gram matrix, so nothing nodes x nodes is ever formed.
+    # Returns (residuals scaled to unit mean square, shrinkage intensity)
+    T = resid.shape[1]
+    scale = np.sqrt((resid ** 2).sum(axis=1) / max(T, 1))
+    live = scale > 0
+    X = np.divide(resid, scale[:, None], out=np.zeros_like(resid), where=live[:, None])
+    if T < 2 or live.sum() < 2:
+        return X, 1.0
+    gram = X.T @ X
+    sq = X ** 2
+    # off-diagonal sums of r_ij^2 and of the estimated Var(r_ij)
+    cross = (gram ** 2).sum() - live.sum() * T ** 2
+    fourth = (sq.sum(axis=0) ** 2).sum() - (sq ** 2).sum()
+    spread = (fourth - cross / T) / (T * (T - 1))
+    if cross <= 0:
+        return X, 1.0
+    return X, float(np.clip(spread / (cross / T ** 2), 0.0, 1.0))
+
+
+def base_forecasts(Y, periods=HORIZON_WEEKS, workers=1):
+    # every node fitted independently by the batched engine. Series start at
+    # their first non-zero week (as the flat runner slices them) and all end
+    # on the last week, so every forecast covers the same weeks. Returns
+    # (forecasts (nodes x periods), method per node, in-sample variance,
+    # (nodes x weeks) one-step errors aligned to the calendar weeks)
+    T = Y.shape[1]
+    first = np.where((Y != 0).any(axis=1), (Y != 0).argmax(axis=1), 0)
+    n = (T - first).astype(np.int64)
+    take = np.minimum(first[:, None] + np.arange(T)[None, :], T - 1)
+    aligned = np.where(np.arange(T)[None, :] < n[:, None], np.take_along_axis(Y, take, axis=1), 0.0)
+    blocks = [(aligned[i:i + FIT_BLOCK], n[i:i + FIT_BLOCK]) for i in range(0, len(Y), FIT_BLOCK)]
+    if workers > 1 and len(blocks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            fitted = list(pool.map(_fit_block, *zip(*blocks), [periods] * len(blocks)))
+    else:
+        fitted = [_fit_block(y, k, periods) for y, k in blocks]
+    if not fitted:
+        return np.zeros((0, periods)), np.zeros(0, dtype=object), np.zeros(0), np.zeros((0, T))
+    fc, method, var, err = (np.concatenate(parts) for parts in zip(*fitted))
+    # back from each node's first week to the shared calendar
+    back = np.arange(T)[None, :] - first[:, None]
+    resid = np.where(back >= 0, np.take_along_axis(err, np.maximum(back, 0), axis=1), 0.0)
+    return fc, method, var, resid
+
+
+def reconcile(hierarchy, base, method='mint', variance=None, history=None, residuals=None):
+    # coherent forecasts for every node from the (nodes x periods) base
+    # forecasts:
+    #   bottom_up  sums the leaf forecasts
+    #   top_down   splits the total by each leaf's share of the history
+    #              (history: (leaves x weeks) or leaf totals)
+    #   ols, wls   the minimum-trace projection with a diagonal W: the
+    #              identity, or the number of leaves under each node
+    #              (structural scaling)
+    #   mint       MinT with the shrinkage covariance: the base fits'
+    #              in-sample variance (variance) on the diagonal, and the
+    #              correlations of their one-step errors (residuals, nodes x
+    #              weeks) shrunk towards zero
+    # The projections solve y - W C' (C W C')^-1 C y. C W C' is aggregates x
+    # aggregates and as sparse as the tree, so the cost follows the number of
+    # districts, not the number of pincode leaves. The MinT covariance is
+    # never formed: it is lambda D + V V' with V (nodes x weeks), and the
+    # low-rank part goes through the Woodbury identity.
+    h = hierarchy
+    if method == 'bottom_up':
+        return np.asarray(h.aggregate(base[h.n_agg:]))
+    if method == 'top_down':
+        totals = np.asarray(history, dtype=float)
+        totals = totals.sum(axis=1) if totals.ndim == 2 else totals
+        share = totals / totals.sum() if totals.sum() else np.full(len(totals), 1.0 / max(len(totals), 1))
+        return np.asarray(h.aggregate(share[:, None] * base[:1]))
+    shrink = 1.0
+    if method == 'ols':
+        w = np.ones(h.n)
+    elif method == 'wls':
+        w = np.asarray(h.S.sum(axis=1)).ravel()
+    elif method == 'mint':
+        if variance is None or residuals is None:
+            raise ValueError('mint reconciliation needs the base forecasts\' in-sample variance and errors')
+        w = np.nan_to_num(np.asarray(variance, dtype=float))
+        X, shrink = _shrinkage(np.asarray(residuals, dtype=float))
+    else:
+        raise ValueError(f'unknown reconciliation method {method!r} (expected one of {", ".join(RECONCILERS)})')
+    # a zero weight would pin a node; keep every weight strictly positive
+    w = np.maximum(w, max(float(w.max()), 1.0) * 1e-9)
+    WCt = sparse.diags(shrink * w) @ h.C.T
+    solve = splu((h.C @ WCt).tocsc()).solve
+    lam = solve(np.asarray(h.C @ base))
+    if shrink >= 1.0:
+        return base - WCt @ lam
+    V = np.sqrt((1.0 - shrink) * w / X.shape[1])[:, None] * X
+    B = np.asarray(h.C @ V)
+    AB = solve(B)
+    lam = lam - AB @ np.linalg.solve(np.eye(B.shape[1]) + B.T @ AB, B.T @ lam)
+    return base - WCt @ lam - V @ (B.T @ lam)
+
+
+def hierarchical_forecasts(pincode_weekly, method='mint', periods=HORIZON_WEEKS, workers=1):
+    # PincodeWeekly result -> (Hierarchy, long table of base and reconciled
+    # forecasts per node and week, timings in seconds)
+    timing = {}
+    t0 = time.perf_counter()
+    leaves, weeks, Y = leaf_matrix(pincode_weekly)
+    h = Hierarchy(leaves)
+    history = np.asarray(h.aggregate(Y))
+    timing['build'] = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    base, fit_method, var, resid = base_forecasts(history, periods, workers)
+    timing['fit'] = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    rec = reconcile(h, base, method, var, Y, resid)
+    timing['reconcile'] = time.perf_counter() - t0
+    fc_weeks = pd.date_range(weeks[-1] + pd.Timedelta(weeks=1), periods=periods, freq='W')
+    nodes = h.nodes.loc[h.nodes.index.repeat(periods)].reset_index(drop=True)
+    nodes['week'] = np.tile(fc_weeks, h.n)
+    nodes['base'] = base.ravel()
+    nodes['forecast'] = rec.ravel()
+    nodes['method'] = np.repeat(fit_method, periods)
+    return h, nodes[HIERARCHY_COLUMNS], timing
+
+
+def display_names(df, pincode_weekly):
+    # normalized state/district keys -> highest-volume raw spellings
+    state = normalize(pincode_weekly['state'])
+    district = normalize(pincode_weekly['district'])
+    totals = pincode_weekly['total_updates'].to_numpy()
+    state_names = display_spellings(state, pincode_weekly['state'].to_numpy(), totals)
+    district_names = display_spellings(list(zip(state, district)), pincode_weekly['district'].to_numpy(), totals)
+    out = df.copy()
+    out['district'] = [district_names.get(k, k[1]) if k[1] else '' for k in zip(df['state'], df['district'])]
+    out['state'] = df['state'].map(state_names).fillna(df['state'])
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Coherent India/state/district/pincode forecasts.')
+    parser.add_argument('--folder', default=DEMO_DIR)
+    parser.add_argument('--method', choices=RECONCILERS, default='mint')
+    parser.add_argument('--periods', type=int, default=HORIZON_WEEKS)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--no-cache', action='store_true')
+    args = parser.parse_args()
+
+    codebook = new_codebook('demo')
+    res = scan_folder(args.folder, 'demo', make_aggregators(codebook, pincode=True), codebook,
+                      cache=None if args.no_cache else ColumnarCache())
+    h, df, timing = hierarchical_forecasts(res['pincode'], args.method, args.periods, args.workers)
+    counts = h.nodes['level'].value_counts()
+    print(', '.join(f'{counts.get(level, 0)} {level}' for level in LEVELS) + ' nodes')
+    print('build {build:.2f}s, base fits {fit:.2f}s, reconcile {reconcile:.2f}s'.format(**timing))
+    values = df['forecast'].to_numpy().reshape(h.n, args.periods)
+    base = df['base'].to_numpy().reshape(h.n, args.periods)
+    print(f'incoherence: base {h.incoherence(base):.3g}, {args.method} {h.incoherence(values):.3g}')
+    os.makedirs(OUT_DIR, exist_ok=True)
+    print('wrote', write_forecasts(display_names(df, res['pincode']), OUT_DIR, 'hierarchy_forecasts'))
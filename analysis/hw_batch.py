@@ -0,0 +1,390 @@
+import sys
+import time
+import argparse
+import warnings
+
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+
+SEASON = 52
+# fit_and_forecast goes seasonal from 26 weeks, but statsmodels cannot
+# initialize a 52-week season from fewer than two full cycles and falls back
+# to the mean; the batch engine keeps the same tiers
+MIN_SEASONAL_WEEKS = 26
+MIN_SEASON_CYCLES = 2
+# shared coarse grids (the seasonal one is coarser: three parameters and
+# longer series), refined per series by a pattern search that starts at
+# REFINE_STEP (a quarter of it from a fitted season) and stops after
+# REFINE_ROUNDS halvings (two fewer from a fitted season)
+GRID = np.linspace(0.0, 1.0, 11)
+SEASONAL_GRID = np.linspace(0.0, 1.0, 6)
+REFINE_STEP = 0.1
+REFINE_ROUNDS = 7
+# at most this many alternations of full initial-state estimation and
+# parameter refinement; a series leaves once its parameters settle
+SEASON_ROUNDS = 8
+WARM_SEASON_ROUNDS = 2
+# float cells per vectorized pass (candidates x series x season) kept in memory
+CELL_BUDGET = 4_000_000
+# relative tolerance on 12-week forecast totals against statsmodels, checked by
+# the self-check below (median over series, and the 90th percentile)
+TOLERANCE_MEDIAN = 0.02
+TOLERANCE_P90 = 0.10
+
+
+def _smooth(y, alpha, beta, gamma, level, trend, season, n=None):
+    # additive-trend (and additive-season) Holt-Winters over left-aligned rows
+    # y: (..., T); parameters and states broadcast against y[..., 0]; season is
+    # (..., m) or None. Returns the one-step errors and, given the row lengths
+    # n, the states at each row's last observation.
+    T = y.shape[-1]
+    m = season.shape[-1] if season is not None else 0
+    lead = np.broadcast(y[..., 0], level, alpha).shape
+    # time- and phase-major copies, so each step reads and writes contiguous slices
+    ys = np.ascontiguousarray(np.moveaxis(y, -1, 0))
+    err = np.zeros((T,) + lead)
+    if m:
+        season = np.array(np.moveaxis(np.broadcast_to(season, lead + (m,)), -1, 0), dtype=float)
+    level = np.array(np.broadcast_to(level, lead), dtype=float)
+    trend = np.array(np.broadcast_to(trend, lead), dtype=float)
+    final = [level.copy(), trend.copy(), season.copy() if m else None]
+    # the level moves by alpha*e past level + trend, so the trend update
+    # beta*(new level - level - trend) is alpha*beta*e; every step is a few
+    # in-place passes with no temporaries
+    ab = np.asarray(alpha * beta)
+    lt, step = np.empty(lead), np.empty(lead)
+    for t in range(T):
+        e = err[t]
+        np.add(level, trend, out=lt)
+        np.subtract(ys[t], lt, out=e)
+        if m:
+            s_prev = season[t % m]
+            e -= s_prev
+            np.multiply(gamma, e, out=step)
+            s_prev += step
+        np.multiply(alpha, e, out=level)
+        level += lt
+        np.multiply(ab, e, out=step)
+        trend += step
+        if n is not None:
+            last = t == n - 1
+            if last.any():
+                final = [np.where(last, level, final[0]), np.where(last, trend, final[1]),
+                         np.where(last, season, final[2]) if m else None]
+    if m and n is not None:
+        final[2] = np.moveaxis(final[2], 0, -1)
+    return np.moveaxis(err, 0, -1), final
+
+
+def _initial_season(Y, m):
+    # classic two-cycle heuristic: per-phase mean of the de-meaned first cycles
+    cycles = Y[:, :MIN_SEASON_CYCLES * m].reshape(len(Y), MIN_SEASON_CYCLES, m)
+    return (cycles - cycles.mean(axis=-1, keepdims=True)).mean(axis=1)
+
+
+def _dot(u, v):
+    # sums of products over the last axis, without the product array
+    return np.einsum('...t,...t->...', u, v)
+
+
+def _fit_initial(Y, n, alpha, beta, gamma, s0):
+    # initial level and trend minimizing the SSE for the given parameters. The
+    # recursion is linear in them, so the errors are the data run (zero level
+    # and trend) plus a multiple of each unit-impulse run, and a 2x2 least
+    # squares is solved per row. Impulse runs depend only on the parameters,
+    # so a grid shared by all rows runs them once per candidate.
+    # Returns (sse, level0, trend0).
+    T = Y.shape[-1]
+    lead = np.broadcast(alpha, beta, gamma, Y[..., 0]).shape
+    imp = np.broadcast(alpha, beta, gamma).shape
+    mask = np.arange(T) < np.asarray(n)[:, None]
+    e0, _ = _smooth(Y, alpha, beta, gamma, np.zeros(lead), np.zeros(lead), s0)
+    m = s0.shape[-1] if s0 is not None else 0
+    ones, zeros = np.ones(imp), np.zeros(imp)
+    err, _ = _smooth(np.zeros((2,) + imp + (T,)), alpha, beta, gamma, np.stack([ones, zeros]),
+                     np.stack([zeros, ones]), np.zeros((2,) + imp + (m,)) if m else None)
+    e0 *= mask
+    el, eb = err[0], err[1]
+    if err.shape[1:] == e0.shape:
+        err *= mask
+        a, b, c = _dot(el, el), _dot(el, eb), _dot(eb, eb)
+    else:
+        # impulse runs shared by every row (grid candidates): each row's sums
+        # are running sums read at its length
+        cum = np.cumsum(np.stack([el * el, el * eb, eb * eb]), axis=-1)
+        a, b, c = np.take(cum, np.maximum(np.asarray(n) - 1, 0), axis=-1)[..., 0, :]
+    # e0 is zero past each row's length, so the cross sums need no mask
+    p, q = -_dot(el, e0), -_dot(eb, e0)
+    det = a * c - b * b
+    ok = np.abs(det) > 1e-9 * np.maximum(a * c, 1e-300)
+    safe = np.where(ok, det, 1.0)
+    l0 = np.where(ok, (c * p - b * q) / safe, np.where(a > 0, p / np.maximum(a, 1e-300), 0.0))
+    b0 = np.where(ok, (a * q - b * p) / safe, 0.0)
+    # |e0 + l0 el + b0 eb|^2, expanded
+    sse = _dot(e0, e0) + l0 * l0 * a + b0 * b0 * c + 2 * (l0 * b0 * b - l0 * p - b0 * q)
+    return np.maximum(sse, 0.0), l0, b0
+
+
+def _fit_states(Y, n, alpha, beta, gamma, m):
+    # all initial states (level, trend and the m seasonal values) minimizing the
+    # SSE for per-row parameters: impulse runs, then a batched least squares.
+    # The recursion only rotates which seasonal value it reads, so the response
+    # to seasonal value j is the response to value 0 delayed by j weeks: three
+    # impulse runs stand in for m + 2. Returns (level0, trend0, season0).
+    rows, T = Y.shape
+    mask = np.arange(T) < n[:, None]
+    unit = np.zeros((3, rows, m))
+    unit[2, :, 0] = 1.0
+    err, _ = _smooth(np.zeros((3, rows, T)), alpha, beta, gamma, np.eye(3)[:, 0, None] + np.zeros((3, rows)),
+                     np.eye(3)[:, 1, None] + np.zeros((3, rows)), unit)
+    e0, _ = _smooth(Y, alpha, beta, gamma, np.zeros(rows), np.zeros(rows), np.zeros((rows, m)))
+    X = np.empty((rows, T, m + 2))  # rows x T x states
+    X[..., 0], X[..., 1] = err[0], err[1]
+    # X[:, t, 2 + j] = err[2][:, t - j], zero before week j
+    padded = np.concatenate([np.zeros((rows, m - 1)), err[2]], axis=1)
+    X[..., 2:] = sliding_window_view(padded, m, axis=1)[..., ::-1]
+    X *= mask[..., None]
+    e0 *= mask
+    Xt = X.transpose(0, 2, 1)
+    G = Xt @ X
+    rhs = -(Xt @ e0[..., None])[..., 0]
+    # raising the level and lowering every seasonal value by the same amount
+    # changes nothing, so G is singular; a tiny ridge picks the smallest-norm
+    # solution, as a pseudo-inverse would, at the cost of a plain solve
+    k = G.shape[-1]
+    ridge = 1e-10 * np.maximum(np.trace(G, axis1=1, axis2=2), 1e-12) / k
+    x = np.linalg.solve(G + ridge[:, None, None] * np.eye(k), rhs[..., None])[..., 0]
+    return x[:, 0], x[:, 1], x[:, 2:]
+
+
+def _grid(Y, n, s0):
+    # a shared coarse grid evaluated for every row at once; returns each row's
+    # best (alpha, beta, gamma)
+    seasonal = s0 is not None
+    axis = SEASONAL_GRID if seasonal else GRID
+    grid = [(a, b, g) for a in axis for b in axis for g in (axis if seasonal else [0.0])
+            if not seasonal or g <= 1 - a + 1e-12]
+    grid = np.array(grid)
+    rows = len(Y)
+    best_sse = np.full(rows, np.inf)
+    best = np.zeros((rows, 3))
+    per = max(1, CELL_BUDGET // max(1, rows * max(Y.shape[-1], s0.shape[-1] if seasonal else 1)))
+    for lo in range(0, len(grid), per):
+        cand = grid[lo:lo + per]
+        alpha, beta, gamma = (cand[:, i, None] for i in range(3))
+        sse, _, _ = _fit_initial(Y, n, alpha, beta, gamma, s0)
+        idx = sse.argmin(axis=0)
+        sse = sse[idx, np.arange(rows)]
+        better = sse < best_sse
+        best_sse = np.where(better, sse, best_sse)
+        best[better] = cand[idx[better]]
+    return best
+
+
+def _sse(Y, n, alpha, beta, gamma, level, trend, season):
+    # in-sample SSE from fixed initial states: one run, no impulse responses
+    e, _ = _smooth(Y, alpha, beta, gamma, level, trend, season)
+    e *= np.arange(Y.shape[-1]) < np.asarray(n)[:, None]
+    return _dot(e, e)
+
+
+def _refine(Y, n, s0, best, step=REFINE_STEP, rounds=REFINE_ROUNDS, states=None):
+    # pattern search around each row's current parameters. Each pass scores
+    # every move (one parameter up or down a step) of every active row at
+    # once and takes each row's best improving move; a row with no improving
+    # move halves its step, and is done after `rounds` halvings. states:
+    # fitted (level0, trend0) held fixed with s0, so a candidate costs one run
+    # instead of three
+    seasonal = s0 is not None
+    best = best.copy()
+
+    def score(idx, alpha, beta, gamma):
+        if states is None:
+            return _fit_initial(Y[idx], n[idx], alpha, beta, gamma, None if s0 is None else s0[idx])[0]
+        return _sse(Y[idx], n[idx], alpha, beta, gamma, states[0][idx], states[1][idx], s0[idx])
+
+    active = np.arange(len(Y))
+    best_sse = score(active, best[:, 0], best[:, 1], best[:, 2])
+    moves = np.array([sign * np.eye(3)[d] for d in range(3 if seasonal else 2) for sign in (-1, 1)])
+    step = np.full(len(Y), float(step))
+    halvings = np.zeros(len(Y), dtype=int)
+    # improving moves keep a row going at the same step; cap the passes
+    for _ in range(4 * rounds):
+        trial = np.clip(best[active][None] + moves[:, None, :] * step[active][None, :, None], 0.0, 1.0)
+        if seasonal:
+            trial[..., 2] = np.minimum(trial[..., 2], 1.0 - trial[..., 0])
+        sse = score(active, trial[..., 0], trial[..., 1], trial[..., 2])
+        pick = sse.argmin(axis=0)
+        sse = sse[pick, np.arange(len(active))]
+        better = sse < best_sse[active] - 1e-12 * np.abs(best_sse[active])
+        won = active[better]
+        best_sse[won] = sse[better]
+        best[won] = trial[pick[better], np.flatnonzero(better)]
+        lost = active[~better]
+        step[lost] /= 2
+        halvings[lost] += 1
+        active = active[halvings[active] < rounds]
+        if not len(active):
+            break
+    return best
+
+
+def tier(weeks, season=SEASON):
+    # model used for a series of this many weeks, same rules as statsmodels
+    if weeks >= MIN_SEASON_CYCLES * season:
+        return 'seasonal'
+    if 2 <= weeks < MIN_SEASONAL_WEEKS:
+        return 'trend'
+    return 'mean'
+
+
+def fit_forecast(Y, n, periods, season=SEASON, start=None, errors=False):
+    # Y: (series x weeks) left-aligned weekly totals, n: weeks per series;
+    # start: optional per-series parameter dicts from an earlier fit of the
+    # same series (warm start: no grid, a short local search, and for seasonal
+    # series the stored initial season and fewer alternation rounds).
+    # Returns (forecasts (series x periods), method per series, in-sample SSE
+    # per series, parameter dict per series); the SSE is NaN and the
+    # parameters None where the mean fallback was used. errors=True appends
+    # the (series x weeks) one-step in-sample errors, left-aligned like Y and
+    # zero past each row's length (deviations from the mean for the fallback).
+    Y = np.asarray(Y, dtype=float)
+    n = np.asarray(n)
+    out = np.zeros((len(Y), periods))
+    method = np.full(len(Y), 'mean', dtype=object)
+    sse = np.full(len(Y), np.nan)
+    fitted = [None] * len(Y)
+    means = np.array([Y[i, :k].mean() if k else np.nan for i, k in enumerate(n)])
+    out[:] = means[:, None]
+    observed = np.arange(Y.shape[1])[None, :] < n[:, None]
+    err = np.where(observed, Y - np.nan_to_num(means)[:, None], 0.0) if errors else None
+    tiers = np.array([tier(k, season) for k in n])
+    h = np.arange(1, periods + 1)
+    for name, m in (('trend', 0), ('seasonal', season)):
+        rows = np.flatnonzero(tiers == name)
+        if not len(rows):
+            continue
+        width = int(n[rows].max())
+        y, k = Y[rows, :width], n[rows]
+        s0 = _initial_season(y, m) if m else None
+        # seasonal rows are refined in the alternation rounds below, against
+        # fitted initial states
+        if start is None:
+            params = _grid(y, k, s0)
+            if not m:
+                params = _refine(y, k, s0, params)
+            rounds = SEASON_ROUNDS
+        else:
+            params = np.array([[start[r]['alpha'], start[r]['beta'], start[r]['gamma']] for r in rows])
+            if m:
+                s0 = np.array([start[r]['season0'] for r in rows])
+            else:
+                params = _refine(y, k, s0, params, REFINE_STEP / 4, REFINE_ROUNDS - 2)
+            rounds = WARM_SEASON_ROUNDS
+        active = np.arange(len(rows))
+        for _ in range(rounds if m else 0):
+            # re-estimate the whole initial season at the current parameters,
+            # then refine the parameters against it; a row whose parameters
+            # no longer move has settled (the same states and search follow)
+            p = params[active]
+            l0, b0, s_fit = _fit_states(y[active], k[active], p[:, 0], p[:, 1], p[:, 2], m)
+            s0[active] = s_fit
+            params[active] = _refine(y[active], k[active], s_fit, p, REFINE_STEP / 4, REFINE_ROUNDS - 2,
+                                     states=(l0, b0))
+            active = active[(params[active] != p).any(axis=1)]
+            if not len(active):
+                break
+        alpha, beta, gamma = params[:, 0], params[:, 1], params[:, 2]
+        fit_sse, l0, b0 = _fit_initial(y, k, alpha, beta, gamma, s0)
+        e, (level, trend, s) = _smooth(y, alpha, beta, gamma, l0, b0, s0, n=k)
+        if errors:
+            err[rows, :width] = np.where(observed[rows, :width], e, 0.0)
+        fc = level[:, None] + h[None, :] * trend[:, None]
+        if m:
+            phase = (k[:, None] - 1 + h[None, :]) % m
+            fc = fc + np.take_along_axis(s, phase, axis=1)
+        out[rows] = fc
+        method[rows] = 'hw_batch'
+        sse[rows] = fit_sse
+        for i, r in enumerate(rows):
+            fitted[r] = {'tier': name, 'alpha': float(alpha[i]), 'beta': float(beta[i]), 'gamma': float(gamma[i]),
+                         'level': float(l0[i]), 'trend': float(b0[i]),
+                         'season0': s0[i].tolist() if m else None}
+    if errors:
+        return out, method, sse, fitted, err
+    return out, method, sse, fitted
+
+
+def forecast_weekly(weekly, periods, starts=None):
+    # list of weekly pd.Series -> list of (forecast pd.Series, method, params),
+    # the same shape of result as forecast.fit_model; starts holds a previous
+    # parameter dict (or None) per series, used when its tier still applies
+    starts = starts or [None] * len(weekly)
+    usable = [st is not None and st.get('tier') == tier(len(s)) for s, st in zip(weekly, starts)]
+    out = [None] * len(weekly)
+    for warm in (False, True):
+        idx = [i for i, u in enumerate(usable) if u == warm]
+        if not idx:
+            continue
+        n = np.array([len(weekly[i]) for i in idx], dtype=np.int64)
+        Y = np.zeros((len(idx), max(int(n.max()), 1)))
+        for j, i in enumerate(idx):
+            Y[j, :n[j]] = weekly[i].to_numpy(dtype=float)
+        fc, method, _, params = fit_forecast(Y, n, periods, start=[starts[i] for i in idx] if warm else None)
+        steps = np.arange(1, periods + 1) * np.timedelta64(7, 'D')
+        # series ending on the same week share one forecast index
+        indexes = {}
+        for j, i in enumerate(idx):
+            last = weekly[i].index[-1]
+            if last not in indexes:
+                indexes[last] = pd.DatetimeIndex(last.to_datetime64() + steps)
+            out[i] = (pd.Series(fc[j], index=indexes[last], copy=False), method[j], params[j])
+    return out
+
+
+def synthetic_weekly(count, seed=0):
+    # mixed short and multi-year weekly series with trend, season and noise
+    rng = np.random.default_rng(seed)
+    out = []
+    for i in range(count):
+        weeks = int(rng.integers(2, 26)) if i % 2 else int(rng.integers(104, 160))
+        t = np.arange(weeks)
+        base = rng.uniform(100, 5000)
+        y = base + rng.normal(0, base * 0.002) * t + base * 0.2 * np.sin(2 * np.pi * t / SEASON + rng.uniform(0, 6))
+        y = np.maximum(y + rng.normal(0, base * 0.05, weeks), 0).round()
+        out.append(pd.Series(y, index=pd.date_range('2023-01-01', periods=weeks, freq='W')))
+    return out
+
+
+if __name__ == '__main__':
+    # agreement with the statsmodels engine and throughput on synthetic series
+    from forecast import fit_and_forecast
+    parser = argparse.ArgumentParser(description='Compare the batched Holt-Winters engine with statsmodels.')
+    parser.add_argument('--series', type=int, default=200)
+    parser.add_argument('--periods', type=int, default=12)
+    args = parser.parse_args()
+    weekly = synthetic_weekly(args.series)
+    rel = []
+    # timed per tier: the seasonal fits dominate both engines
+    for name in ('trend', 'seasonal'):
+        group = [s for s in weekly if tier(len(s)) == name]
+        if not group:
+            continue
+        t0 = time.perf_counter()
+        batch = forecast_weekly(group, args.periods)
+        t_batch = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            ref = [fit_and_forecast(s, args.periods) for s in group]
+        t_ref = time.perf_counter() - t0
+        both = [(f.sum(), r[1].sum()) for (f, how, _), r in zip(batch, ref) if r[2] != 'mean' and how != 'mean']
+        rel += [abs(a - b) / max(abs(b), 1.0) for a, b in both]
+        print(f'{name}: {len(group)} series, statsmodels {t_ref * 1000 / len(group):.1f} ms/series, '
+              f'batch {t_batch * 1000 / len(group):.2f} ms/series ({t_ref / max(t_batch, 1e-9):.0f}x)')
+    rel = np.array(rel)
+    med, p90 = (float(np.median(rel)), float(np.quantile(rel, 0.9))) if len(rel) else (0.0, 0.0)
+    print(f'12-week total relative difference: median {med:.4f}, p90 {p90:.4f} '
+          f'(tolerance {TOLERANCE_MEDIAN}, {TOLERANCE_P90})')
+    sys.exit(0 if med <= TOLERANCE_MEDIAN and p90 <= TOLERANCE_P90 else 1)
@@ -0,0 +1,151 @@
+import os
+import json
+import pickle
+import hashlib
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import instrument
+from cache import CACHE_DIR, content_hash, fingerprint
+from dates import date_format
+from parallel import run_unit
+from regions import default as regions_default
+from scan import list_csv_files, new_codebook, make_aggregators, finish
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATE_DIR = os.path.join(BASE_DIR, 'analysis', '.cache', 'state')
+STATE_VERSION = 5
+
+
+def _dump(obj, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+def _load(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+class IncrementalStore:
+    # persisted aggregate state for one dataset folder plus a manifest of the
+    # files folded into it; each run merges only new or changed files and
+    # retracts the stored contribution of changed or removed ones. Every run
+    # writes its aggregate and per-file partials under new names of its own
+    # generation, and the manifest's os.replace is the single commit point
+    # that names them: a run interrupted before it leaves the previous state
+    # whole, and the files it did write are swept by the next commit
+    def __init__(self, name, prefix, agg_kwargs=None, state_dir=STATE_DIR):
+        self.name = name
+        self.prefix = prefix
+        self.agg_kwargs = dict(agg_kwargs or {})
+        self.root = os.path.join(state_dir, name)
+        self.manifest_path = os.path.join(self.root, 'manifest.json')
+        self.stats = {}
+
+    def _config(self):
+        # the daily memory cap changes how state is held, not what it holds;
+        # state keyed by canonical names is stale once the region table changes
+        aggregators = {k: v for k, v in self.agg_kwargs.items() if k != 'daily_memory'}
+        return {'version': STATE_VERSION, 'prefix': self.prefix, 'aggregators': aggregators,
+                'date_format': date_format(self.prefix), 'regions': regions_default().version}
+
+    def _partial_name(self, path, generation):
+        return os.path.join('files', f'{hashlib.sha1(path.encode()).hexdigest()[:16]}-{generation}.pkl')
+
+    def _load_manifest(self):
+        # (files, aggregate state name, generation) of the last committed run
+        if not os.path.exists(self.manifest_path):
+            return {}, None, 0
+        with open(self.manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get('config') != self._config() or not os.path.exists(os.path.join(self.root, manifest['state'])):
+            # different aggregators or layout: start over
+            return {}, None, 0
+        return manifest['files'], manifest['state'], manifest['generation']
+
+    def _sweep(self, keep):
+        # removes what no committed manifest names: superseded state and
+        # partials, and whatever an interrupted run left behind
+        for sub in ('', 'files'):
+            for name in os.listdir(os.path.join(self.root, sub)):
+                rel = os.path.join(sub, name) if sub else name
+                if rel not in keep and rel != 'manifest.json' and os.path.isfile(os.path.join(self.root, rel)):
+                    os.remove(os.path.join(self.root, rel))
+
+    def _unchanged(self, path, old):
+        cur = fingerprint(path, with_hash=False)
+        if cur['size'] != old['size']:
+            return False
+        if cur['mtime_ns'] == old['mtime_ns']:
+            return True
+        if content_hash(path) != old['sha1']:
+            return False
+        old['mtime_ns'] = cur['mtime_ns']
+        return True
+
+    def update(self, folder, cache=None, workers=1, profile=None):
+        files, state, generation = self._load_manifest()
+        if state is None:
+            shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(os.path.join(self.root, 'files'), exist_ok=True)
+        generation += 1
+
+        codebook = new_codebook(self.prefix)
+        aggregators = make_aggregators(codebook, **self.agg_kwargs)
+        if state is not None:
+            for name, partial in _load(os.path.join(self.root, state)).items():
+                aggregators[name].merge(partial)
+
+        current = [os.path.abspath(fp) for fp in list_csv_files(folder)]
+        removed = [fp for fp in files if fp not in current]
+        changed, new = [], []
+        for fp in current:
+            if fp not in files:
+                new.append(fp)
+            elif not self._unchanged(fp, files[fp]):
+                changed.append(fp)
+
+        # retract what changed or disappeared, using the stored per-file partials
+        for fp in removed + changed:
+            old = _load(os.path.join(self.root, files.pop(fp)['partial']))
+            for name, agg in aggregators.items():
+                agg.merge(old[name], sign=-1)
+
+        todo = changed + new
+        fps = {fp: fingerprint(fp) for fp in todo}
+        units = []
+        for fp in todo:
+            if cache is not None:
+                units.append(('cache', fp, 0, len(cache.get(fp, date_format(self.prefix)))))
+            else:
+                units.append(('csv', fp, 0, fps[fp]['size']))
+        cache_dir = cache.cache_dir if cache is not None else CACHE_DIR
+        n = len(units)
+        args = (units, [self.prefix] * n, [self.agg_kwargs] * n, [profile] * n, [cache_dir] * n)
+        if workers > 1 and n > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                partials = list(pool.map(run_unit, *args))
+        else:
+            partials = list(map(run_unit, *args))
+        for fp, partial in zip(todo, partials):
+            instrument.absorb(partial.pop(instrument.READ_KEY))
+            for name, agg in aggregators.items():
+                agg.merge(partial[name])
+            files[fp] = dict(fps[fp], partial=self._partial_name(fp, generation))
+            _dump(partial, os.path.join(self.root, files[fp]['partial']))
+
+        state = f'aggregate-{generation}.pkl'
+        _dump({name: agg.partial() for name, agg in aggregators.items()}, os.path.join(self.root, state))
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'config': self._config(), 'generation': generation, 'state': state, 'files': files}, f,
+                      indent=1)
+        os.replace(tmp, self.manifest_path)
+        self._sweep({state} | {entry['partial'] for entry in files.values()})
+
+        self.stats = {'new': len(new), 'changed': len(changed), 'removed': len(removed),
+                      'unchanged': len(current) - len(new) - len(changed)}
+        return finish(aggregators, self.prefix)
@@ -0,0 +1,280 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import platform
+import resource
+import threading
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OUT_DIR = os.path.join(BASE_DIR, 'analysis', 'outputs')
+REPORT = 'run_report.json'
+# one line per run, for tracking throughput over time
+HISTORY = 'run_history.jsonl'
+REPORT_VERSION = 1
+# key under which a worker's read counters travel with its partials
+READ_KEY = '_read'
+HOTSPOTS = 25
+
+# rows, chunks and bytes read by this process (and CSV rows and bytes parsed
+# into the columnar cache), whether or not a stage is open
+COUNTERS = Counter()
+_recorder = None
+_lock = threading.Lock()
+# the same counts per thread, so stages running side by side (pipeline.py)
+# each see only their own reads
+_local = threading.local()
+
+
+def _counters():
+    counters = getattr(_local, 'counters', None)
+    if counters is None:
+        counters = _local.counters = Counter()
+    return counters
+
+
+def count(**amounts):
+    with _lock:
+        COUNTERS.update(amounts)
+    _counters().update(amounts)
+
+
+def collected(before):
+    # counters added since `before` (a copy of COUNTERS), tagged with this process
+    delta = dict(COUNTERS - before)
+    delta['pid'] = os.getpid()
+    return delta
+
+
+def absorb(read):
+    # a worker's counters; units run in this process were counted already
+    if read and read.get('pid') != os.getpid():
+        count(**{k: v for k, v in read.items() if k != 'pid'})
+
+
+def peak_rss():
+    # peak RSS of this process in bytes since the last reset_peak_rss, or None
+    # where /proc does not report it
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _rusage():
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return (me.ru_utime + me.ru_stime, kids.ru_utime + kids.ru_stime, me.ru_maxrss * unit, kids.ru_maxrss * unit)
+
+
+class Recorder:
+    # per-stage wall and CPU time, read counters and peak RSS for one run,
+    # written as a JSON run report (and optionally a Chrome trace). Stages
+    # nest; a stage's numbers include its children. Stages may also run in
+    # several threads at once, each with its own nesting. A stage's CPU time is
+    # its thread's; worker processes that finished while it ran are counted
+    # apart (they may be another thread's). The high-water mark is only reset while no other thread has a stage open, and
+    # stages that overlap another thread's report the process peak instead
+    # (peak_rss_scope). With profile=True the whole run also goes through
+    # cProfile and tracemalloc
+    def __init__(self, name='analytics', profile=False, argv=None):
+        self.name = name
+        self.argv = list(sys.argv[1:] if argv is None else argv)
+        self.started = pd.Timestamp.now().isoformat(timespec='seconds')
+        self.t0 = time.perf_counter()
+        self.stages = []
+        self._local = threading.local()
+        self._threads = {}
+        # stages open in any thread
+        self._open = []
+        # per-stage peaks need a resettable high-water mark (Linux)
+        self.per_stage_rss = peak_rss() is not None and reset_peak_rss()
+        self.profiler = None
+        if profile:
+            tracemalloc.start()
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    @property
+    def open(self):
+        # stages open in the calling thread, outermost first
+        if not hasattr(self._local, 'open'):
+            self._local.open = []
+            # threads are numbered from 1 in the order they open a stage
+            with _lock:
+                self._threads[threading.get_ident()] = len(self._threads) + 1
+        return self._local.open
+
+    @contextmanager
+    def stage(self, name, **fields):
+        # yields the stage's field dict; callers may add to it (e.g. items)
+        now = peak_rss() if self.per_stage_rss else None
+        for s in self.open:
+            s['_peak'] = max(s['_peak'], now or 0)
+        _, kids_cpu, _, _ = _rusage()
+        rec = {'name': name, 'depth': len(self.open), 'start_s': time.perf_counter() - self.t0,
+               'thread': self._threads[threading.get_ident()], '_cpu': time.thread_time(), '_kids_cpu': kids_cpu,
+               '_counters': _counters().copy(), '_peak': 0, '_shared': not self.per_stage_rss, 'fields': fields}
+        with _lock:
+            others = [s for s in self._open if s['thread'] != rec['thread']]
+            if others:
+                # the high-water mark is the process's while another thread
+                # has a stage open: leave it, and mark every open peak as such
+                for s in self._open:
+                    s['_shared'] = True
+                rec['_shared'] = True
+            elif self.per_stage_rss:
+                reset_peak_rss()
+            self._open.append(rec)
+        if self.profiler is not None:
+            tracemalloc.reset_peak()
+        self.open.append(rec)
+        try:
+            yield fields
+        finally:
+            self.open.pop()
+            self._close(rec)
+
+    def _close(self, rec):
+        cpu = time.thread_time()
+        _, kids_cpu, self_max, kids_max = _rusage()
+        with _lock:
+            self._open = [s for s in self._open if s is not rec]
+        wall = time.perf_counter() - self.t0 - rec['start_s']
+        peak = peak_rss() if self.per_stage_rss else self_max
+        peak = max(rec.pop('_peak'), peak or 0)
+        for s in self.open:
+            s['_peak'] = max(s['_peak'], peak)
+            s['_shared'] = s['_shared'] or rec['_shared']
+        read = dict(_counters() - rec.pop('_counters'))
+        out = {'name': rec['name'], 'depth': rec['depth'], 'thread': rec['thread'], 'start_s': round(rec['start_s'], 4),
+               'wall_s': round(wall, 4), 'cpu_s': round(cpu - rec.pop('_cpu'), 4),
+               'workers_cpu_s': round(kids_cpu - rec.pop('_kids_cpu'), 4),
+               'rows': read.get('rows', 0), 'chunks': read.get('chunks', 0), 'bytes_read': read.get('bytes', 0),
+               'peak_rss_mb': round(peak / 2 ** 20, 1), 'peak_rss_scope': 'process' if rec['_shared'] else 'stage',
+               'workers_peak_rss_mb': round(kids_max / 2 ** 20, 1)}
+        out['rows_per_s'] = round(out['rows'] / wall, 1) if out['rows'] and wall > 0 else None
+        # anything else counted, e.g. CSV rows parsed into the columnar cache
+        out.update({k: v for k, v in read.items() if k not in ('rows', 'chunks', 'bytes')})
+        if self.profiler is not None:
+            out['py_alloc_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+        out.update(rec['fields'])
+        with _lock:
+            self.stages.append(out)
+
+    def _hotspots(self):
+        # top functions by cumulative time and allocation sites by size
+        stats = pstats.Stats(self.profiler)
+        rows = sorted(stats.stats.items(), key=lambda kv: kv[1][3], reverse=True)[:HOTSPOTS]
+        functions = [{'function': f'{os.path.relpath(f, BASE_DIR) if f.startswith(BASE_DIR) else f}:{line}({fn})',
+                      'calls': nc, 'tottime_s': round(tt, 4), 'cumtime_s': round(ct, 4)}
+                     for (f, line, fn), (cc, nc, tt, ct, _) in rows]
+        snapshot = tracemalloc.take_snapshot()
+        allocations = [{'site': str(stat.traceback[0]), 'mb': round(stat.size / 2 ** 20, 2), 'blocks': stat.count}
+                       for stat in snapshot.statistics('lineno')[:HOTSPOTS]]
+        return {'functions': functions, 'allocations': allocations}
+
+    def report(self):
+        cpu, kids_cpu, self_max, kids_max = _rusage()
+        report = {
+            'version': REPORT_VERSION, 'name': self.name, 'argv': self.argv, 'started': self.started,
+            'wall_s': round(time.perf_counter() - self.t0, 4), 'cpu_s': round(cpu + kids_cpu, 4),
+            'peak_rss_mb': round(self_max / 2 ** 20, 1), 'workers_peak_rss_mb': round(kids_max / 2 ** 20, 1),
+            'peak_rss_scope': 'stage' if self.per_stage_rss else 'process',
+            'environment': {'host': platform.node(), 'python': platform.python_version(), 'cpus': os.cpu_count()},
+            # in start order, so children follow their parent
+            'stages': sorted(self.stages, key=lambda s: (s['start_s'], s['depth'])),
+        }
+        if self.profiler is not None:
+            self.profiler.disable()
+            report['hotspots'] = self._hotspots()
+            tracemalloc.stop()
+        return report
+
+    def write(self, out_dir=OUT_DIR, trace=None):
+        # run report, one history line, and the profile/trace files asked for;
+        # returns the report
+        report = self.report()
+        os.makedirs(out_dir, exist_ok=True)
+        path = os.path.join(out_dir, REPORT)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(report, f, indent=1)
+        os.replace(path + '.tmp', path)
+        line = {k: report[k] for k in ('started', 'argv', 'wall_s', 'cpu_s', 'peak_rss_mb')}
+        line['stages'] = {s['name']: {'wall_s': s['wall_s'], 'rows_per_s': s['rows_per_s']}
+                          for s in report['stages'] if s['depth'] == 0}
+        with open(os.path.join(out_dir, HISTORY), 'a') as f:
+            f.write(json.dumps(line) + '\n')
+        if self.profiler is not None:
+            self.profiler.dump_stats(os.path.join(out_dir, 'run_profile.pstats'))
+        if trace:
+            write_trace(report, trace)
+        return report
+
+
+def write_trace(report, path):
+    # Chrome trace-event JSON (chrome://tracing, Perfetto): one complete
+    # event per stage, nested by time, with the stage's numbers as args
+    events = [{'name': s['name'], 'ph': 'X', 'pid': 1, 'tid': s.get('thread', 1), 'ts': round(s['start_s'] * 1e6),
+               'dur': round(s['wall_s'] * 1e6), 'args': {k: v for k, v in s.items() if k not in ('name', 'start_s')}}
+              for s in report['stages']]
+    events.append({'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': report['name']}})
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def summary(report):
+    # markdown table of the stages; nested stages are marked by depth
+    rows = [{'stage': '- ' * s['depth'] + s['name'], 'wall s': f"{s['wall_s']:.2f}", 'cpu s': f"{s['cpu_s']:.2f}",
+             'worker cpu s': f"{s['workers_cpu_s']:.2f}" if s.get('workers_cpu_s') else '',
+             'rows/s': f"{s['rows_per_s']:,.0f}" if s['rows_per_s'] else '',
+             'MB read': f"{s['bytes_read'] / 2 ** 20:.1f}" if s['bytes_read'] else '',
+             'chunks': s['chunks'] or '', 'peak RSS MB': f"{s['peak_rss_mb']:.0f}"} for s in report['stages']]
+    return pd.DataFrame(rows).to_markdown(index=False, disable_numparse=True)
+
+
+def start(name='analytics', profile=False, argv=None):
+    # make a recorder the active one for stage()
+    global _recorder
+    _recorder = Recorder(name, profile, argv)
+    return _recorder
+
+
+@contextmanager
+def stage(name, **fields):
+    # a stage of the active recorder; without one, only yields the fields
+    if _recorder is None:
+        yield fields
+    else:
+        with _recorder.stage(name, **fields) as f:
+            yield f
+
+
+def fields():
+    # the field dict of the innermost stage open in this thread, for a stage
+    # body that does not open it itself (pipeline.py); a spare dict otherwise
+    if _recorder is None or not _recorder.open:
+        return {}
+    return _recorder.open[-1]['fields']
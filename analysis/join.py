@@ -0,0 +1,420 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from accumulators import KEY_BITS, KeyCodec, pack_keys, unpack_keys
+from cube import DAY_BIAS
+from forecast import write_forecasts
+from regions import default as regions_default, normalize, state_keys
+from reader import ReaderProfile, parse_size
+from schema import NO_DAY, days_to_dates
+from spill import SpillingReducer, MEMORY_CAP, MERGE_BLOCK, reduce_sorted
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JOINED_DIR = os.path.join(BASE_DIR, 'analysis', '.cache', 'joined')
+OUT_DIR = os.path.join(BASE_DIR, 'analysis', 'outputs')
+# age bands shared by the demographic and biometric update datasets
+BANDS = ('5_17', '17_')
+SIDES = ('demo', 'bio')
+# join key: (pincode + 1, biased day, place). Pincode and day mean the same
+# in both datasets, so a side's key order only depends on its own place codes
+# in the lowest bits; a place is one (state, district) pair
+JOIN_DIMS = ('pin', 'day', 'place')
+PLACE_DIMS = ('state', 'district')
+PLACE_BITS = KEY_BITS['place']
+# districts below this many updates on either side are left out of the divergence ranking
+MIN_VOLUME = 100
+# bytes a merge step holds per block row, over both sides' reads, sorts and
+# the joined columns (measured); the block follows from the memory cap
+STEP_ROW_BYTES = 1024
+MIN_BLOCK = 10_000
+
+
+class JoinCells:
+    # one side of the joined view: (state, district, pincode, day) -> age-band
+    # sums and source rows, held in a spilling reducer so memory stays under
+    # memory_cap at any scale. Rows without a district are kept under '' and
+    # rows without a pincode under pincode -1; rows with no date cannot be
+    # joined and are only counted
+    columns = ('state', 'district', 'pincode', 'date')
+
+    def __init__(self, codebook, memory_cap=None):
+        self.codebook = codebook
+        self.places = KeyCodec(dtype=np.int64)
+        self.sums = SpillingReducer(len(BANDS) + 1, memory_cap or MEMORY_CAP)
+        self.undated = 0
+        self._pins = np.zeros(0, dtype=np.int64)
+
+    def _pin_values(self, codes):
+        # pincode codes -> pincode + 1, with 0 for missing or malformed ones
+        codec = self.codebook['pincode']
+        if len(self._pins) < len(codec):
+            values = pd.to_numeric(pd.Series(codec.values, dtype=object), errors='coerce').to_numpy()
+            ok = (values >= 100000) & (values <= 999999)
+            self._pins = np.where(ok, np.nan_to_num(values) + 1, 0).astype(np.int64)
+        return np.append(self._pins, 0)[codes]
+
+    def _add(self, state, district, pin, day, values, rows):
+        place = self.places.encode(pack_keys(PLACE_DIMS, [state, district]))
+        key = pack_keys(JOIN_DIMS, [pin, day + DAY_BIAS, place])
+        self.sums.add(key, np.column_stack([values, rows]))
+
+    def consume(self, batch):
+        bands = [c.split('_age_', 1)[-1] for c in batch.age_cols]
+        unknown = set(bands) - set(BANDS)
+        if unknown:
+            raise ValueError(f'age bands {sorted(unknown)} are not in the joined view (expected {", ".join(BANDS)})')
+        state = batch.codes('state')
+        district = batch.codes('district') if batch.has('district') else np.full(len(batch), -1, dtype=np.int64)
+        if (district < 0).any():
+            district = np.where(district < 0, self.codebook.encode('district', np.array([''], dtype=object))[0],
+                                district)
+        pin = self._pin_values(batch.codes('pincode')) if batch.has('pincode') else np.zeros(len(batch), dtype=np.int64)
+        days = batch.days
+        dated = days != NO_DAY
+        ok = (state >= 0) & dated
+        self.undated += int(((state >= 0) & ~dated).sum())
+        values = np.zeros((int(ok.sum()), len(BANDS)), dtype=np.int64)
+        values[:, [BANDS.index(b) for b in bands]] = batch.values[ok]
+        self._add(state[ok], district[ok], pin[ok], days[ok].astype(np.int64), values,
+                  np.ones(len(values), dtype=np.int64))
+
+    def partial(self):
+        keys, values = self.sums.reduced()
+        # keys whose every source row was retracted disappear
+        keep = values[:, -1] != 0
+        pin, day, place = unpack_keys(JOIN_DIMS, keys[keep])
+        state, district = unpack_keys(PLACE_DIMS, self.places.decode(place).astype(np.int64))
+        return {
+            'state': self.codebook['state'].decode(state),
+            'district': self.codebook['district'].decode(district),
+            'pin': pin,
+            'day': (day - DAY_BIAS).astype(np.int32),
+            'values': values[keep],
+            'undated': self.undated,
+        }
+
+    def merge(self, partial, sign=1):
+        state = self.codebook.encode('state', partial['state'])
+        district = self.codebook.encode('district', partial['district'])
+        values = sign * np.asarray(partial['values'], dtype=np.int64)
+        self._add(state, district, np.asarray(partial['pin'], dtype=np.int64),
+                  np.asarray(partial['day'], dtype=np.int64), values[:, :-1], values[:, -1])
+        self.undated += sign * partial['undated']
+
+    def result(self):
+        # the side itself: sorted blocks are streamed by join(), so the cells
+        # are never materialized as one frame
+        return self
+
+    def place_names(self):
+        # normalized (state, district) of every local place code
+        state, district = unpack_keys(PLACE_DIMS, self.places.values.astype(np.int64))
+        return (np.asarray(normalize(self.codebook['state'].decode(state)), dtype=object),
+                np.asarray(normalize(self.codebook['district'].decode(district)), dtype=object))
+
+    def blocks(self, remap, block=MERGE_BLOCK):
+        # sorted, reduced (keys, values) blocks of about `block` rows with
+        # places recoded through remap. Recoding only reorders keys within one
+        # (pincode, day), so a block is cut before its last (pincode, day)
+        # group, which may go on in the next block, and re-sorted
+        mask = (1 << PLACE_BITS) - 1
+        # each merge step reads from every spilled run and the in-memory part
+        block = max(1, block // (len(self.sums.runs) + 1))
+        carry_k = np.zeros(0, dtype=np.int64)
+        carry_v = np.zeros((0, len(BANDS) + 1), dtype=np.int64)
+        for keys, values in self.sums.blocks(block):
+            keep = values[:, -1] != 0
+            keys = np.concatenate([carry_k, (keys[keep] & ~mask) | remap[keys[keep] & mask]])
+            values = np.concatenate([carry_v, values[keep]])
+            if len(keys) == 0:
+                continue
+            head = keys >> PLACE_BITS
+            cut = int(np.searchsorted(head, head[-1], side='left'))
+            carry_k, carry_v = keys[cut:], values[cut:]
+            if cut:
+                order = np.argsort(keys[:cut], kind='stable')
+                yield reduce_sorted(keys[:cut][order], values[:cut][order])
+        if len(carry_k):
+            order = np.argsort(carry_k, kind='stable')
+            yield reduce_sorted(carry_k[order], carry_v[order])
+
+
+def merge_join(left, right):
+    # full outer sort-merge join of two streams of sorted, unique-key blocks;
+    # yields (keys, left values, right values) with zero rows for the side a
+    # key is missing from. Only the current block of each side is in memory
+    left, right = iter(left), iter(right)
+    lk, lv = next(left, (None, None))
+    rk, rv = next(right, (None, None))
+    while lk is not None or rk is not None:
+        if lk is None:
+            bound = rk[-1]
+        elif rk is None:
+            bound = lk[-1]
+        else:
+            bound = min(lk[-1], rk[-1])
+        li = 0 if lk is None else int(np.searchsorted(lk, bound, side='right'))
+        ri = 0 if rk is None else int(np.searchsorted(rk, bound, side='right'))
+        lkeys = lk[:li] if lk is not None else np.zeros(0, dtype=np.int64)
+        rkeys = rk[:ri] if rk is not None else np.zeros(0, dtype=np.int64)
+        keys = np.union1d(lkeys, rkeys)
+        width = (lv if lv is not None else rv).shape[1]
+        lout = np.zeros((len(keys), width), dtype=np.int64)
+        rout = np.zeros((len(keys), width), dtype=np.int64)
+        if li:
+            lout[np.searchsorted(keys, lkeys)] = lv[:li]
+        if ri:
+            rout[np.searchsorted(keys, rkeys)] = rv[:ri]
+        yield keys, lout, rout
+        if lk is not None:
+            lk, lv = lk[li:], lv[li:]
+            if len(lk) == 0:
+                lk, lv = next(left, (None, None))
+        if rk is not None:
+            rk, rv = rk[ri:], rv[ri:]
+            if len(rk) == 0:
+                rk, rv = next(right, (None, None))
+
+
+def _place_dictionary(demo, bio):
+    # shared place codes over both sides, in (state, district) order, and
+    # each side's local -> shared lookup
+    names = [side.place_names() for side in (demo, bio)]
+    keys = [pd.MultiIndex.from_arrays([s, d]) for s, d in names]
+    shared = keys[0].append(keys[1]).unique().sort_values()
+    if len(shared) >= 1 << PLACE_BITS:
+        raise ValueError(f'too many (state, district) pairs to join ({len(shared)})')
+    remaps = [np.asarray(shared.get_indexer(k), dtype=np.int64) for k in keys]
+    return shared, remaps
+
+
+def join(demo, bio, joined_dir=JOINED_DIR, block=None, memory_cap=None):
+    # demographic x biometric cells on (state, district, pincode, day), full
+    # outer join, written column by column under joined_dir while the
+    # per-district and per-district-day totals for the reports are summed.
+    # Returns (district totals, district-day totals, summary)
+    memory_cap = memory_cap or MEMORY_CAP
+    block = block or max(MIN_BLOCK, memory_cap // STEP_ROW_BYTES)
+    shared, (demo_remap, bio_remap) = _place_dictionary(demo, bio)
+    n_places = len(shared)
+    width = len(BANDS) + 1
+    tmp = joined_dir + '.tmp'
+    os.makedirs(tmp, exist_ok=True)
+    files = {name: open(os.path.join(tmp, f'{name}.bin'), 'wb') for name in ('pincode', 'day', 'place', 'demo', 'bio')}
+    # per place: demo bands+rows, bio bands+rows, then keys in both / demo only / bio only,
+    # and the demo and bio updates at keys the other side lacks
+    places = np.zeros((n_places, 2 * width + 5), dtype=np.int64)
+    daily = SpillingReducer(2 * width, memory_cap)
+    rows = 0
+    for keys, left, right in merge_join(demo.blocks(demo_remap, block), bio.blocks(bio_remap, block)):
+        pin, day, place = unpack_keys(JOIN_DIMS, keys)
+        files['pincode'].write((pin - 1).astype(np.int32).tobytes())
+        files['day'].write((day - DAY_BIAS).astype(np.int32).tobytes())
+        files['place'].write(place.astype(np.int32).tobytes())
+        files['demo'].write(left.astype(np.int32).tobytes())
+        files['bio'].write(right.astype(np.int32).tobytes())
+        rows += len(keys)
+        in_demo, in_bio = left[:, -1] > 0, right[:, -1] > 0
+        cols = np.column_stack([left, right, in_demo & in_bio, in_demo & ~in_bio, in_bio & ~in_demo,
+                                np.where(in_bio, 0, left[:, :-1].sum(axis=1)),
+                                np.where(in_demo, 0, right[:, :-1].sum(axis=1))])
+        for c in range(cols.shape[1]):
+            places[:, c] += np.bincount(place, weights=cols[:, c], minlength=n_places).astype(np.int64)
+        daily.add(pack_keys(('place', 'day'), [place, day]), np.column_stack([left, right]))
+    for f in files.values():
+        f.close()
+    meta = {'rows': rows, 'bands': list(BANDS), 'places': [list(p) for p in shared],
+            'columns': {'pincode': 1, 'day': 1, 'place': 1, 'demo': width, 'bio': width},
+            'undated': {'demo': demo.undated, 'bio': bio.undated}}
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    _replace_dir(tmp, joined_dir)
+
+    value_cols = [f'{side}_{b}' for side in SIDES for b in BANDS + ('rows',)]
+    state = np.array([p[0] for p in shared], dtype=object)
+    district = np.array([p[1] for p in shared], dtype=object)
+    totals = pd.DataFrame(places, columns=value_cols + ['keys_both', 'keys_demo_only', 'keys_bio_only',
+                                                        'demo_unmatched', 'bio_unmatched'])
+    totals.insert(0, 'state', state)
+    totals.insert(1, 'district', district)
+    keys, values = daily.reduced()
+    place, day = unpack_keys(('place', 'day'), keys)
+    by_day = pd.DataFrame(values, columns=value_cols)
+    by_day.insert(0, 'state', state[place])
+    by_day.insert(1, 'district', district[place])
+    by_day.insert(2, 'date', days_to_dates(day - DAY_BIAS))
+    summary = {'rows': rows, 'places': n_places, 'undated': meta['undated'],
+               'keys_both': int(places[:, -5].sum()), 'keys_demo_only': int(places[:, -4].sum()),
+               'keys_bio_only': int(places[:, -3].sum())}
+    return totals, by_day, summary
+
+
+def _replace_dir(tmp, root):
+    # swap a finished directory in, so readers never see half a join
+    shutil.rmtree(root, ignore_errors=True)
+    os.replace(tmp, root)
+
+
+def read_joined(joined_dir=JOINED_DIR, states=None):
+    # the joined cells as a frame, optionally for some (normalized) states;
+    # columns are memory-mapped, so a state slice only reads its rows
+    with open(os.path.join(joined_dir, 'meta.json')) as f:
+        meta = json.load(f)
+    n = meta['rows']
+    cols = {name: np.memmap(os.path.join(joined_dir, f'{name}.bin'), dtype=np.int32, mode='r',
+                            shape=(n, width) if width > 1 else (n,))
+            for name, width in meta['columns'].items()}
+    places = pd.DataFrame(meta['places'], columns=['state', 'district'])
+    sel = slice(None)
+    if states is not None:
+        wanted = np.flatnonzero(places['state'].isin(state_keys(states)).to_numpy())
+        sel = np.flatnonzero(np.isin(np.asarray(cols['place']), wanted))
+    place = np.asarray(cols['place'][sel])
+    df = pd.DataFrame({'state': places['state'].to_numpy()[place], 'district': places['district'].to_numpy()[place],
+                       'pincode': np.asarray(cols['pincode'][sel]), 'date': days_to_dates(cols['day'][sel])})
+    for side in SIDES:
+        values = np.asarray(cols[side][sel])
+        for i, band in enumerate(meta['bands'] + ['rows']):
+            df[f'{side}_{band}'] = values[:, i]
+    return df
+
+
+def _ratio(num, den):
+    num, den = np.asarray(num, dtype=float), np.asarray(den, dtype=float)
+    return np.divide(num, den, out=np.full(len(num), np.nan), where=den > 0)
+
+
+def with_ratios(df):
+    # biometric updates per demographic update, by band and overall
+    df = df.copy()
+    for band in BANDS:
+        df[f'ratio_{band}'] = _ratio(df[f'bio_{band}'], df[f'demo_{band}'])
+    df['demo_total'] = df[[f'demo_{b}' for b in BANDS]].sum(axis=1)
+    df['bio_total'] = df[[f'bio_{b}' for b in BANDS]].sum(axis=1)
+    df['ratio_total'] = _ratio(df['bio_total'], df['demo_total'])
+    return df
+
+
+def divergence(totals, by_day, min_volume=MIN_VOLUME):
+    # districts whose biometric/demographic mix departs from their state's:
+    # log2 of the district ratio over the state ratio, how unevenly the two
+    # streams cover the district's pincode-days, and how often the daily ratio
+    # swings more than 2x off the district's own
+    df = with_ratios(totals)
+    state = df.groupby('state')[['demo_total', 'bio_total']].transform('sum')
+    df['state_ratio'] = _ratio(state['bio_total'], state['demo_total'])
+    df = df[(df['demo_total'] >= min_volume) & (df['bio_total'] >= min_volume)].copy()
+    df['log2_vs_state'] = np.log2(_ratio(df['ratio_total'], df['state_ratio']))
+    keys = df[['keys_both', 'keys_demo_only', 'keys_bio_only']].sum(axis=1)
+    df['matched_key_share'] = _ratio(df['keys_both'], keys)
+    df['demo_unmatched_share'] = _ratio(df['demo_unmatched'], df['demo_total'])
+    df['bio_unmatched_share'] = _ratio(df['bio_unmatched'], df['bio_total'])
+    daily = with_ratios(by_day)
+    daily = daily[(daily['demo_total'] > 0) & (daily['bio_total'] > 0)]
+    own = df.set_index(['state', 'district'])['ratio_total']
+    swing = np.abs(np.log2(daily['ratio_total'].to_numpy() /
+                           own.reindex(pd.MultiIndex.from_frame(daily[['state', 'district']])).to_numpy())) > 1
+    df = df.merge(pd.DataFrame({'state': daily['state'], 'district': daily['district'], 'swing': swing})
+                  .groupby(['state', 'district'], as_index=False)['swing'].mean()
+                  .rename(columns={'swing': 'swing_day_share'}), on=['state', 'district'], how='left')
+    df = df.assign(abs_log2=df['log2_vs_state'].abs()).sort_values('abs_log2', ascending=False, ignore_index=True)
+    cols = ['state', 'district', 'demo_total', 'bio_total', 'ratio_total', 'state_ratio', 'log2_vs_state',
+            'matched_key_share', 'demo_unmatched_share', 'bio_unmatched_share', 'swing_day_share']
+    return df[cols]
+
+
+def write_reports(totals, by_day, out_dir=OUT_DIR):
+    # district ratios, district-day ratios and the divergence ranking; returns
+    # (ratios, divergence) frames and the paths written
+    ratios = with_ratios(totals).sort_values(['state', 'district'], ignore_index=True)
+    cols = ['state', 'district'] + [f'{s}_{b}' for s in SIDES for b in BANDS] + \
+           [f'ratio_{b}' for b in BANDS] + ['ratio_total', 'demo_rows', 'bio_rows']
+    ratios = ratios[cols]
+    div = divergence(totals, by_day)
+    paths = [os.path.join(out_dir, 'joined_district_ratios.csv'), os.path.join(out_dir, 'joined_divergence.csv')]
+    ratios.to_csv(paths[0], index=False)
+    div.to_csv(paths[1], index=False)
+    daily = with_ratios(by_day).drop(columns=['demo_rows', 'bio_rows'])
+    paths.append(write_forecasts(daily, out_dir, 'joined_district_daily'))
+    return ratios, div, paths
+
+
+def _pandas_join(demo_folder, bio_folder):
+    # reference: both datasets fully read and outer-merged with pandas
+    frames = []
+    for side, folder in zip(SIDES, (demo_folder, bio_folder)):
+        df = pd.concat([pd.read_csv(os.path.join(folder, f), dtype=str) for f in sorted(os.listdir(folder))
+                        if f.endswith('.csv')], ignore_index=True)
+        state, district, _ = regions_default().canonicalize(df['state'], df['district'])
+        df['state'] = normalize(pd.Series(state, dtype=object).fillna(''))
+        df['district'] = normalize(pd.Series(district, dtype=object).fillna(''))
+        pin = pd.to_numeric(df['pincode'], errors='coerce')
+        df['pincode'] = pin.where((pin >= 100000) & (pin <= 999999), -1).fillna(-1).astype(int)
+        df['date'] = pd.to_datetime(df['date'], format='%d-%m-%Y', errors='coerce')
+        df = df.dropna(subset=['date'])
+        for b in BANDS:
+            col = f'{side}_age_{b}'
+            df[f'{side}_{b}'] = pd.to_numeric(df[col], errors='coerce').fillna(0).astype(int) if col in df else 0
+        df[f'{side}_rows'] = 1
+        frames.append(df.groupby(['state', 'district', 'pincode', 'date'], as_index=False)
+                      [[f'{side}_{b}' for b in BANDS + ('rows',)]].sum())
+    out = frames[0].merge(frames[1], on=['state', 'district', 'pincode', 'date'], how='outer').fillna(0)
+    return out.astype({c: int for c in out.columns if c.startswith(SIDES)})
+
+
+def main(argv=None):
+    from scan import new_codebook, make_aggregators, scan_folder
+    from cache import ColumnarCache
+
+    parser = argparse.ArgumentParser(description='Join demographic and biometric cells on (state, district, '
+                                                 'pincode, day) and write ratio and divergence reports.')
+    parser.add_argument('--demo', default=os.path.join(BASE_DIR, 'api_data_aadhar_demographic'))
+    parser.add_argument('--bio', default=os.path.join(BASE_DIR, 'api_data_aadhar_biometric'))
+    parser.add_argument('--memory', type=parse_size, default=MEMORY_CAP,
+                        help='memory cap of each side before it spills sorted runs, e.g. 256M')
+    parser.add_argument('--block', type=parse_size, default=None,
+                        help='rows per merge step (default: from --memory)')
+    parser.add_argument('--out', default=OUT_DIR)
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--check', action='store_true',
+                        help='also compare the joined cells with a pandas merge of both datasets')
+    args = parser.parse_args(argv)
+
+    t0 = time.perf_counter()
+    cache = None if args.no_cache else ColumnarCache()
+    sides = []
+    for prefix, folder in zip(SIDES, (args.demo, args.bio)):
+        codebook = new_codebook(prefix)
+        aggregators = make_aggregators(codebook, joined=True, daily_memory=args.memory)
+        aggregators = {'joined': aggregators['joined']}
+        sides.append(scan_folder(folder, prefix, aggregators, codebook, ReaderProfile(), cache)['joined'])
+    totals, by_day, summary = join(*sides, block=args.block and int(args.block), memory_cap=args.memory)
+    os.makedirs(args.out, exist_ok=True)
+    ratios, div, paths = write_reports(totals, by_day, args.out)
+    summary['seconds'] = round(time.perf_counter() - t0, 2)
+    summary['spilled_runs'] = {side: len(s.sums.runs) for side, s in zip(SIDES, sides)}
+    print(json.dumps(summary))
+    print(div.head(10).to_markdown(index=False, floatfmt='.3f'))
+    for path in paths:
+        print('wrote', os.path.relpath(path, BASE_DIR))
+    if args.check:
+        got = read_joined().sort_values(['state', 'district', 'pincode', 'date'], ignore_index=True)
+        want = _pandas_join(args.demo, args.bio).sort_values(['state', 'district', 'pincode', 'date'],
+                                                            ignore_index=True)
+        try:
+            pd.testing.assert_frame_equal(got, want[got.columns], check_dtype=False)
+        except AssertionError as e:
+            print('merge join != pandas merge\n' + str(e)[:500])
+            sys.exit(1)
+        print(f'merge join == pandas merge ({len(got):,} cells)')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,6 +4,11 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib import colors
 from reportlab.lib.units import inch
 import os
+import json
+import pandas as pd
+
+from pipeline import Stage
+from render import load_manifest, chart_file, state_charts
 
 BASE = os.path.dirname(os.path.abspath(__file__))
 OUTDIR = os.path.join(BASE, 'outputs')
@@ -17,33 +22,48 @@ if 'SectionHeading' not in styles:
 if 'Code' not in styles:
     styles.add(ParagraphStyle(name='Code', fontName='Courier', fontSize=8))
 
-# Exact executive summary paragraph requested
-EXEC_SUMMARY = ("States such as Uttar Pradesh and Maharashtra consistently generate the highest Aadhaar update volumes across both demographic and biometric datasets, "
-               "indicating persistent service demand that warrants additional update centers or temporary camps. Within Gujarat, Ahmedabad and Surat dominate district-level "
-               "update requests, pointing to urban concentration and frequent address or mobile changes. Short-term forecasts (12-week horizon) show continued elevated demand "
-               "in these regions; operational actions — targeted mobile camps, temporary staffing increases during forecasted peak weeks, and biometric quality revalidation programs "
-               "— will mitigate service delays and improve efficiency.")
-
-# Files to embed
-IMG_STATE_DEMO = os.path.join(OUTDIR, 'state_demographic_top10.png')
-IMG_STATE_BIO = os.path.join(OUTDIR, 'state_biometric_top10.png')
-IMG_GUJ_DEMO = os.path.join(OUTDIR, 'gujarat_demographic_top15.png')
-IMG_GUJ_BIO = os.path.join(OUTDIR, 'gujarat_biometric_top15.png')
-FORECAST_CSV = os.path.join(OUTDIR, 'forecasts', 'state_Uttar_Pradesh_forecast.csv')
-
-
-def read_csv_preview(path, max_lines=200):
-    if not os.path.exists(path):
-        return 'Forecast CSV not found: ' + path
-    with open(path, 'r') as f:
-        lines = f.readlines()
+NARRATIVE = os.path.join(BASE, 'narrative.json')
+# the forecast series previewed in the forecasting section
+PREVIEW = 'state_Uttar_Pradesh'
+
+
+def csv_preview(df, max_lines=200):
+    if df is None:
+        return f'Forecast series not found: {PREVIEW}'
+    lines = df.to_csv().splitlines(keepends=True)
     if len(lines) > max_lines:
         lines = lines[:max_lines]
         lines.append('\n... (truncated)')
     return ''.join(lines)
 
 
-def build():
+def state_sections(charts):
+    # the district charts the run drew for each selected state
+    story = []
+    for state, groups in state_charts(charts).items():
+        if not groups.get('districts'):
+            continue
+        story.append(Paragraph(f'District‑level analysis — {state}', styles['SectionHeading']))
+        for chart_id in groups['districts']:
+            img = chart_file(charts, chart_id, OUTDIR)
+            if os.path.exists(img):
+                story.append(Image(img, width=6.5*inch, height=3.6*inch))
+                story.append(Paragraph(f"Figure: {charts[chart_id]['title']} (see analysis/outputs/{charts[chart_id]['path']})", styles['Normal']))
+            else:
+                story.append(Paragraph('Figure missing: ' + img, styles['Normal']))
+            story.append(Spacer(1, 12))
+        story.append(Paragraph(f'Explanation: the districts of {state} with the highest update volumes are where added capacity and outreach matter most.', styles['Justify']))
+        stem = state.replace(' ', '_').lower()
+        story.append(Paragraph(f'Relevant CSVs: `analysis/outputs/{stem}_demographic_by_district.csv`, `analysis/outputs/{stem}_biometric_by_district.csv`', styles['Normal']))
+        story.append(PageBreak())
+    return story
+
+
+def build(text, charts, preview):
+    # text: the 'pdf' part of narrative.json; charts: the chart manifest;
+    # preview: the PREVIEW forecast series, or None
+    img_state_demo = chart_file(charts, 'state_demographic_top10', OUTDIR)
+    img_state_bio = chart_file(charts, 'state_biometric_top10', OUTDIR)
     doc = SimpleDocTemplate(PDF_PATH, pagesize=A4,
                             rightMargin=36, leftMargin=36,
                             topMargin=36, bottomMargin=36)
@@ -62,7 +82,7 @@ def build():
 
     # Executive summary
     story.append(Paragraph('Executive summary', styles['SectionHeading']))
-    story.append(Paragraph(EXEC_SUMMARY, styles['Justify']))
+    story.append(Paragraph(text['summary'], styles['Justify']))
     story.append(PageBreak())
 
     # Problem statement
@@ -107,40 +127,26 @@ def build():
 
     # State-level analysis
     story.append(Paragraph('State‑level analysis', styles['SectionHeading']))
-    if os.path.exists(IMG_STATE_DEMO):
-        story.append(Image(IMG_STATE_DEMO, width=6.5*inch, height=3.6*inch))
+    if os.path.exists(img_state_demo):
+        story.append(Image(img_state_demo, width=6.5*inch, height=3.6*inch))
         story.append(Paragraph('Figure: Top states by demographic updates (see analysis/outputs/state_demographic_top10.png)', styles['Normal']))
     else:
-        story.append(Paragraph('Figure missing: ' + IMG_STATE_DEMO, styles['Normal']))
+        story.append(Paragraph('Figure missing: ' + img_state_demo, styles['Normal']))
     story.append(Spacer(1, 6))
     story.append(Paragraph('Explanation: Top states by demographic updates; regions with highest update volumes (e.g., Uttar Pradesh, Maharashtra) indicate priority need for resource allocation and service scaling.', styles['Justify']))
     story.append(Spacer(1, 12))
-    if os.path.exists(IMG_STATE_BIO):
-        story.append(Image(IMG_STATE_BIO, width=6.5*inch, height=3.6*inch))
+    if os.path.exists(img_state_bio):
+        story.append(Image(img_state_bio, width=6.5*inch, height=3.6*inch))
         story.append(Paragraph('Figure: Top states by biometric updates (see analysis/outputs/state_biometric_top10.png)', styles['Normal']))
     else:
-        story.append(Paragraph('Figure missing: ' + IMG_STATE_BIO, styles['Normal']))
+        story.append(Paragraph('Figure missing: ' + img_state_bio, styles['Normal']))
     story.append(Paragraph('Explanation: Biometric revalidation pressure; age‑transition and revalidation needs may be concentrated in the top states shown.', styles['Justify']))
     story.append(Spacer(1, 12))
     story.append(Paragraph('Relevant CSVs: `analysis/outputs/state_summary_demographic.csv`, `analysis/outputs/state_summary_biometric.csv`', styles['Normal']))
     story.append(PageBreak())
 
-    # District level (Gujarat)
-    story.append(Paragraph('District‑level analysis — Gujarat focus', styles['SectionHeading']))
-    if os.path.exists(IMG_GUJ_DEMO):
-        story.append(Image(IMG_GUJ_DEMO, width=6.5*inch, height=3.6*inch))
-        story.append(Paragraph('Figure: Gujarat — top districts (demographic) (see analysis/outputs/gujarat_demographic_top15.png)', styles['Normal']))
-    else:
-        story.append(Paragraph('Figure missing: ' + IMG_GUJ_DEMO, styles['Normal']))
-    story.append(Paragraph('Explanation: Urban concentration and migration-driven updates (Ahmedabad, Surat).', styles['Justify']))
-    story.append(Spacer(1, 12))
-    if os.path.exists(IMG_GUJ_BIO):
-        story.append(Image(IMG_GUJ_BIO, width=6.5*inch, height=3.6*inch))
-        story.append(Paragraph('Figure: Gujarat — top districts (biometric) (see analysis/outputs/gujarat_biometric_top15.png)', styles['Normal']))
-    else:
-        story.append(Paragraph('Figure missing: ' + IMG_GUJ_BIO, styles['Normal']))
-    story.append(Paragraph('Relevant CSVs: `analysis/outputs/gujarat_demographic_by_district.csv`, `analysis/outputs/gujarat_biometric_by_district.csv`', styles['Normal']))
-    story.append(PageBreak())
+    # District level, one section per selected state (--states)
+    story.extend(state_sections(charts))
 
     # Forecasting
     story.append(Paragraph('Forecasting & Future Demand', styles['SectionHeading']))
@@ -150,31 +156,19 @@ def build():
     story.append(Paragraph('• 12‑week horizon', styles['Normal']))
     story.append(Spacer(1, 6))
     story.append(Paragraph('Example forecast CSV (preview): `analysis/outputs/forecasts/state_Uttar_Pradesh_forecast.csv`', styles['Normal']))
-    csv_preview = read_csv_preview(FORECAST_CSV, max_lines=120)
-    story.append(Preformatted(csv_preview, styles['Code']))
+    story.append(Preformatted(csv_preview(preview, max_lines=120), styles['Code']))
     story.append(Paragraph('Explanation: Continued elevated demand; forecasts support proactive planning but are trend-based.', styles['Justify']))
     story.append(PageBreak())
 
     # Key findings
     story.append(Paragraph('Key Findings', styles['SectionHeading']))
-    findings = [
-        'Uttar Pradesh & Maharashtra show sustained highest update volumes',
-        'Ahmedabad & Surat dominate Gujarat updates',
-        'High biometric update counts indicate age-related revalidation needs'
-    ]
-    for f in findings:
+    for f in text['findings']:
         story.append(Paragraph('• ' + f, styles['Normal']))
     story.append(PageBreak())
 
     # Recommendations
     story.append(Paragraph('Recommendations', styles['SectionHeading']))
-    recs = [
-        'Deploy temporary Aadhaar update camps in high-load districts',
-        'Increase staffing during forecasted peak weeks',
-        'Run biometric quality & revalidation awareness programs',
-        'Prioritize urban districts for infrastructure scaling'
-    ]
-    for r in recs:
+    for r in text['recommendations']:
         story.append(Paragraph('• ' + r, styles['Normal']))
     story.append(PageBreak())
 
@@ -187,7 +181,7 @@ def build():
 
     # Reproducibility
     story.append(Paragraph('Reproducibility', styles['SectionHeading']))
-    reproduc_cmds = ("python3 -m venv .venv\nsource .venv/bin/activate\npip install -r analysis/requirements.txt\npython analysis/analytics.py\npython analysis/make_presentation.py")
+    reproduc_cmds = ("python3 -m venv .venv\nsource .venv/bin/activate\npip install -r analysis/requirements.txt\npython analysis/pipeline.py")
     story.append(Preformatted(reproduc_cmds, styles['Code']))
     story.append(PageBreak())
 
@@ -212,5 +206,21 @@ def build():
     print('PDF written to', PDF_PATH)
 
 
+def pdf_stage(pdf_text, charts, highlights):
+    build(pdf_text, charts, highlights.get(PREVIEW))
+    return {'written': [PDF_PATH]}
+
+
+def stage():
+    # the PDF as a pipeline.py stage, rebuilt only when its text, the charts
+    # or the previewed forecast change
+    return Stage('pdf', pdf_stage, inputs=('pdf_text', 'charts', 'highlights'), code=('make_pdf.py',))
+
+
 if __name__ == '__main__':
-    build()
+    # standalone: from the files the last analytics.py run wrote
+    with open(NARRATIVE) as f:
+        text = json.load(f)['pdf']
+    path = os.path.join(OUTDIR, 'forecasts', f'{PREVIEW}_forecast.csv')
+    preview = pd.read_csv(path, index_col=0) if os.path.exists(path) else None
+    build(text, load_manifest(OUTDIR, latest=True), preview)
@@ -1,21 +1,24 @@
 from pptx import Presentation
 from pptx.util import Inches, Pt
 import os
+import json
+
+from pipeline import Stage
+from render import load_manifest, chart_file, state_charts
 
 BASE = os.path.dirname(os.path.abspath(__file__))
 OUT = os.path.join(BASE, 'outputs')
 PPT_PATH = os.path.join(OUT, 'Aadhaar_analytics_presentation.pptx')
+NARRATIVE = os.path.join(BASE, 'narrative.json')
 
-prs = Presentation()
-
-def add_title(title, subtitle=''):
+def add_title(prs, title, subtitle=''):
     slide_layout = prs.slide_layouts[0]
     slide = prs.slides.add_slide(slide_layout)
     slide.shapes.title.text = title
     if subtitle:
         slide.placeholders[1].text = subtitle
 
-def add_bullets(title, bullets):
+def add_bullets(prs, title, bullets):
     slide_layout = prs.slide_layouts[1]
     slide = prs.slides.add_slide(slide_layout)
     slide.shapes.title.text = title
@@ -31,73 +34,78 @@ def add_bullets(title, bullets):
         p.level = 0
         p.font.size = Pt(18)
 
-def add_image_slide(title, image_path, left=Inches(0.5), top=Inches(1.6), width=Inches(9)):
+def add_image_slide(prs, title, image_path, left=Inches(0.5), top=Inches(1.6), width=Inches(9)):
     slide_layout = prs.slide_layouts[5]
     slide = prs.slides.add_slide(slide_layout)
     slide.shapes.title.text = title
     if os.path.exists(image_path):
         slide.shapes.add_picture(image_path, left, top, width=width)
 
+def add_chart_slide(prs, charts, chart_id, title):
+    # manifest charts keep the title given here; the path comes from the manifest
+    add_image_slide(prs, title, chart_file(charts, chart_id, OUT))
+
 
-def main():
-    add_title('Identifying Regional and Age‑Group Patterns in Aadhaar Updates', 'Aadhaar Data Hackathon — Analytics')
+def build(text, charts):
+    # text: the 'slides' part of narrative.json; charts: the chart manifest
+    prs = Presentation()
+    add_title(prs, 'Identifying Regional and Age‑Group Patterns in Aadhaar Updates', 'Aadhaar Data Hackathon — Analytics')
 
-    add_bullets('Objective', [
+    add_bullets(prs, 'Objective', [
         'Identify regional (state/district) and age‑group patterns in Aadhaar updates',
         'Provide insights and recommendations to improve service delivery'
     ])
 
-    add_bullets('Dataset & Method', [
+    add_bullets(prs, 'Dataset & Method', [
         'Demographic and Biometric aggregated CSVs (daily rows)',
         'Aggregated by state/district; weekly resampling for forecasts',
         'Holt–Winters forecasts (12-week horizon) for key series'
     ])
 
-    # Charts
-    charts = [
-        ('Top 10 States — Demographic', os.path.join(OUT, 'state_demographic_top10.png')),
-        ('Top 10 States — Biometric', os.path.join(OUT, 'state_biometric_top10.png')),
-        ('Gujarat — Districts (Demographic)', os.path.join(OUT, 'gujarat_demographic_top15.png')),
-        ('Gujarat — Districts (Biometric)', os.path.join(OUT, 'gujarat_biometric_top15.png')),
+    # Charts: the top states, then the districts of each selected state (--states)
+    chart_slides = [
+        ('Top 10 States — Demographic', 'state_demographic_top10'),
+        ('Top 10 States — Biometric', 'state_biometric_top10'),
     ]
-    for title, path in charts:
-        add_image_slide(title, path)
-
-    # Forecast sample slides (top states)
-    fc_dir = os.path.join(OUT, 'forecasts')
-    sample_forecasts = [
-        ('Forecast — Uttar Pradesh', os.path.join(fc_dir, 'state_Uttar_Pradesh_forecast.png')),
-        ('Forecast — Maharashtra', os.path.join(fc_dir, 'state_Maharashtra_forecast.png')),
-        ('Forecast — Gujarat / Ahmedabad', os.path.join(fc_dir, 'gujarat_Ahmedabad_forecast.png')),
-    ]
-    for title, path in sample_forecasts:
-        add_image_slide(title, path)
+    by_state = state_charts(charts)
+    for groups in by_state.values():
+        chart_slides += [(charts[chart_id]['title'], chart_id) for chart_id in groups.get('districts', [])]
+    for title, chart_id in chart_slides:
+        add_chart_slide(prs, charts, chart_id, title)
+
+    # Forecast sample slides: the two top states, then the top district of each selected state
+    top_states = [k for k, v in charts.items() if v['group'] == 'forecast' and not v.get('state')][:2]
+    sample_forecasts = [(charts[chart_id]['title'].replace('Weekly updates - ', 'Forecast — '), chart_id)
+                        for chart_id in top_states + [g['forecast'][0] for g in by_state.values() if g.get('forecast')]]
+    for title, chart_id in sample_forecasts:
+        add_chart_slide(prs, charts, chart_id, title)
 
     # Insights and recommendations (concise)
-    add_bullets('Key Insights', [
-        'Uttar Pradesh and Maharashtra show consistently high update volumes',
-        'Ahmedabad and Surat dominate Gujarat update requests — urban concentration',
-        'High biometric updates indicate revalidation/quality needs in populous areas'
-    ])
+    add_bullets(prs, 'Key Insights', text['insights'])
 
-    add_bullets('Recommendations', [
-        'Scale temporary/mobile camps and staff during forecasted high weeks',
-        'Targeted outreach in high-update Gujarat districts for address/mobile updates',
-        'Implement biometric quality/revalidation programs to reduce repeat visits'
-    ])
+    add_bullets(prs, 'Recommendations', text['recommendations'])
 
-    add_bullets('Next Steps', [
-        'Compare forecasts with ARIMA/Prophet models for accuracy',
-        'Incorporate event calendars as covariates (campaigns, policy changes)',
-        'Prepare PPT speaker notes and finalize slides for submission'
-    ])
+    add_bullets(prs, 'Next Steps', text['next_steps'])
 
     # Final slide
-    add_bullets('Conclusion', ['Data-driven actions can significantly improve UIDAI service delivery efficiency.'])
+    add_bullets(prs, 'Conclusion', ['Data-driven actions can significantly improve UIDAI service delivery efficiency.'])
 
     prs.save(PPT_PATH)
     print('Presentation saved to', PPT_PATH)
 
 
+def slide_stage(slide_text, charts):
+    build(slide_text, charts)
+    return {'written': [PPT_PATH]}
+
+
+def stage():
+    # the deck as a pipeline.py stage, rebuilt only when its text or the
+    # charts change
+    return Stage('slides', slide_stage, inputs=('slide_text', 'charts'), code=('make_presentation.py',))
+
+
 if __name__ == '__main__':
-    main()
+    # standalone: from the chart manifest the last analytics.py run wrote
+    with open(NARRATIVE) as f:
+        build(json.load(f)['slides'], load_manifest(OUT, latest=True))
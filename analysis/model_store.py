@@ -0,0 +1,115 @@
+import os
+import json
+import pickle
+import hashlib
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL_DIR = os.path.join(BASE_DIR, 'analysis', '.cache', 'models')
+MAX_BYTES = 256 * 1024 * 1024
+
+
+def series_hash(weekly, weeks=None):
+    # weeks and values of the first `weeks` points (all by default)
+    s = weekly if weeks is None else weekly.iloc[:weeks]
+    h = hashlib.sha1()
+    h.update(np.asarray(s.index.asi8).tobytes())
+    h.update(np.asarray(s.to_numpy(dtype=float)).tobytes())
+    return h.hexdigest()
+
+
+def _dump(obj, path):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+class ModelStore:
+    # fitted forecasts keyed by series identity, with the hash of the weekly
+    # data and the model config they were fitted on. Unchanged series are served
+    # from the store; series that only gained weeks return their previous
+    # parameters for a warm-start refit. Entries past max_bytes are evicted
+    # least recently used first.
+    def __init__(self, root=MODEL_DIR, max_bytes=MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(root, 'index.json')
+        self.entries = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.entries = json.load(f)
+        self.clock = max((e['used'] for e in self.entries.values()), default=0) + 1
+        self.hits = 0
+        self.warm = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def _path(self, key):
+        return os.path.join(self.root, 'entries', hashlib.sha1(key.encode()).hexdigest()[:16] + '.pkl')
+
+    def _load(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def lookup(self, key, weekly, config):
+        # ('hit', entry) for unchanged data, ('warm', params) when the stored
+        # weeks are unchanged and new ones were appended, else ('miss', None).
+        # The last stored week may have been partial, so it is not compared.
+        meta = self.entries.get(key)
+        if meta is not None and meta['config'] == config:
+            weeks = meta['weeks']
+            if len(weekly) == weeks and series_hash(weekly) == meta['hash']:
+                entry = self._load(key)
+                if entry is not None:
+                    meta['used'] = self.clock
+                    self.hits += 1
+                    return 'hit', entry
+            elif len(weekly) >= weeks and series_hash(weekly, weeks - 1) == meta['stable_hash']:
+                entry = self._load(key)
+                if entry is not None and entry['params'] is not None:
+                    meta['used'] = self.clock
+                    self.warm += 1
+                    return 'warm', entry['params']
+        self.misses += 1
+        return 'miss', None
+
+    def put(self, key, weekly, config, forecast, method, params):
+        os.makedirs(os.path.join(self.root, 'entries'), exist_ok=True)
+        path = self._path(key)
+        _dump({'forecast': forecast, 'method': method, 'params': params}, path)
+        self.entries[key] = {
+            'config': config,
+            'weeks': len(weekly),
+            'hash': series_hash(weekly),
+            'stable_hash': series_hash(weekly, len(weekly) - 1),
+            'bytes': os.path.getsize(path),
+            'used': self.clock,
+        }
+
+    def save(self):
+        # evict least recently used entries past the cap, then persist the index
+        total = sum(e['bytes'] for e in self.entries.values())
+        for key in sorted(self.entries, key=lambda k: self.entries[k]['used']):
+            if total <= self.max_bytes:
+                break
+            total -= self.entries.pop(key)['bytes']
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            self.evicted += 1
+        os.makedirs(self.root, exist_ok=True)
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.index_path)
+        self.clock += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'warm': self.warm, 'misses': self.misses, 'evicted': self.evicted,
+                'entries': len(self.entries)}
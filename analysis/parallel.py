@@ -0,0 +1,181 @@
+import io
+import os
+import sys
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import instrument
+from cache import ColumnarCache, CACHE_DIR
+from dates import date_format
+from reader import ReaderProfile, parse_size
+from scan import (list_csv_files, new_codebook, iter_csv_batches, iter_cached_batches, make_aggregators,
+                  required_columns, scan_folder, finish)
+
+# files larger than this are split into byte ranges (CSV) or row ranges (cache)
+SPLIT_BYTES = 64 * 1024 * 1024
+SPLIT_ROWS = 2_000_000
+
+
+def byte_ranges(path, split_bytes=SPLIT_BYTES):
+    size = os.path.getsize(path)
+    if size <= split_bytes:
+        return [(0, size)]
+    return [(lo, min(lo + split_bytes, size)) for lo in range(0, size, split_bytes)]
+
+
+def read_byte_range(path, start, end):
+    # header plus every line that *starts* in [start, end); the line straddling
+    # `end` is finished here and skipped by the next range
+    with open(path, 'rb') as f:
+        header = f.readline()
+        if start < len(header):
+            start = len(header)
+        else:
+            f.seek(start - 1)
+            f.readline()
+        pos = f.tell()
+        if pos >= end:
+            return header
+        data = f.read(end - pos)
+        if data and not data.endswith(b'\n'):
+            data += f.readline()
+    return header + data
+
+
+def plan_units(folder, cached_rows=None, split_bytes=SPLIT_BYTES, split_rows=SPLIT_ROWS):
+    # (kind, path, start, stop) work units in file order; cached_rows maps each
+    # path to its row count when the columnar cache is used
+    units = []
+    for fp in list_csv_files(folder):
+        if cached_rows is not None:
+            rows = cached_rows[fp]
+            units.extend(('cache', fp, lo, min(lo + split_rows, rows)) for lo in range(0, max(rows, 1), split_rows))
+        else:
+            units.extend(('csv', fp, lo, hi) for lo, hi in byte_ranges(fp, split_bytes))
+    return units
+
+
+def _warm(path, cache_dir, fmt, profile):
+    before = instrument.COUNTERS.copy()
+    cache = ColumnarCache(cache_dir, profile)
+    rows = len(cache.get(path, fmt))
+    return cache.hits, cache.misses, rows, instrument.collected(before)
+
+
+def run_unit(unit, prefix, agg_kwargs, profile=None, cache_dir=CACHE_DIR):
+    # worker: aggregate one unit with a private codebook and return the
+    # picklable partials
+    kind, path, start, stop = unit
+    before = instrument.COUNTERS.copy()
+    codebook = new_codebook(prefix)
+    aggregators = make_aggregators(codebook, **agg_kwargs)
+    columns = required_columns(aggregators)
+    if kind == 'cache':
+        entry = ColumnarCache(cache_dir, profile).get(path, date_format(prefix))
+        batches = iter_cached_batches(entry, prefix, codebook, profile, start, stop)
+    elif start == 0 and stop >= os.path.getsize(path):
+        batches = iter_csv_batches(path, prefix, codebook, profile, columns)
+    else:
+        source = io.BytesIO(read_byte_range(path, start, stop))
+        batches = iter_csv_batches(source, prefix, codebook, profile, columns)
+    for batch in batches:
+        for agg in aggregators.values():
+            agg.consume(batch)
+    partials = {name: agg.partial() for name, agg in aggregators.items()}
+    partials[instrument.READ_KEY] = instrument.collected(before)
+    return partials
+
+
+def scan_folder_parallel(folder, prefix, workers, agg_kwargs=None, profile=None, cache=None,
+                         split_bytes=SPLIT_BYTES, split_rows=SPLIT_ROWS):
+    # same results as scan.scan_folder, with files and large-file ranges spread
+    # over a process pool; partials are merged in unit order
+    agg_kwargs = agg_kwargs or {}
+    codebook = new_codebook(prefix)
+    aggregators = make_aggregators(codebook, **agg_kwargs)
+    files = list_csv_files(folder)
+    cached_rows = None
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        if cache is not None:
+            # build missing cache entries in parallel before planning row ranges
+            cached_rows = {}
+            n = len(files)
+            warmed = pool.map(_warm, files, [cache.cache_dir] * n, [date_format(prefix)] * n, [profile] * n)
+            for fp, (hits, misses, rows, read) in zip(files, warmed):
+                instrument.absorb(read)
+                cache.hits += hits
+                cache.misses += misses
+                cached_rows[fp] = rows
+        units = plan_units(folder, cached_rows, split_bytes, split_rows)
+        n = len(units)
+        cache_dir = cache.cache_dir if cache is not None else CACHE_DIR
+        for partial in pool.map(run_unit, units, [prefix] * n, [agg_kwargs] * n, [profile] * n, [cache_dir] * n):
+            instrument.absorb(partial.pop(instrument.READ_KEY))
+            for name, agg in aggregators.items():
+                agg.merge(partial[name])
+    return finish(aggregators, prefix)
+
+
+def compare_results(serial, parallel):
+    # names of the results that differ between two scans
+    bad = []
+    for name, expected in serial.items():
+        got = parallel.get(name)
+        try:
+            pd.testing.assert_frame_equal(expected, got, check_exact=True)
+        except AssertionError:
+            bad.append(name)
+    return bad
+
+
+def check(workers=2, rows=40_000):
+    # serial vs parallel scans of a small generated folder, read from the CSVs
+    # split into byte ranges and from the columnar cache split into row
+    # ranges, with every frame-valued aggregator on and spilling (the joined
+    # cells have their own check, join.py --check); returns the mismatches
+    import tempfile
+    from synth import generate
+    kwargs = {'daily': True, 'daily_memory': 1 << 16, 'pincode': True, 'hotspots': 'exact', 'cube': True,
+              'spikes': True}
+    bad = []
+    with tempfile.TemporaryDirectory() as root:
+        folder = generate(os.path.join(root, 'synth'), rows, ('demo',), file_rows=rows // 2, dirty=0.01)[0]['demo']
+        size = max(os.path.getsize(fp) for fp in list_csv_files(folder))
+        for label, cache in (('csv', None), ('cache', ColumnarCache(os.path.join(root, 'cache')))):
+            codebook = new_codebook('demo')
+            serial = scan_folder(folder, 'demo', make_aggregators(codebook, **kwargs), codebook, cache=cache)
+            par = scan_folder_parallel(folder, 'demo', workers, kwargs, cache=cache, split_bytes=size // 7,
+                                       split_rows=rows // 13)
+            bad += [f'{label}: {name}' for name in compare_results(serial, par)]
+    return bad
+
+
+if __name__ == '__main__':
+    # check that parallel ingestion reproduces the serial results exactly;
+    # with no folder, on a small generated one through both the CSV and the
+    # cached path
+    parser = argparse.ArgumentParser(description='Compare parallel and serial ingestion of a dataset folder.')
+    parser.add_argument('folder', nargs='?', help='dataset folder (default: a small generated one)')
+    parser.add_argument('prefix', nargs='?', default='demo')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--split-bytes', type=int, default=SPLIT_BYTES)
+    parser.add_argument('--no-cache', action='store_true')
+    parser.add_argument('--memory-budget', type=parse_size, default=None)
+    parser.add_argument('--engine', choices=['c', 'pyarrow'], default='c')
+    args = parser.parse_args()
+    if args.folder is None:
+        bad = check(max(2, args.workers))
+    else:
+        profile = ReaderProfile(engine=args.engine, memory_budget=args.memory_budget)
+        cache = None if args.no_cache else ColumnarCache(profile=profile)
+        kwargs = {'daily': True, 'pincode': True, 'hotspots': 'exact', 'cube': True, 'spikes': True}
+        codebook = new_codebook(args.prefix)
+        serial = scan_folder(args.folder, args.prefix, make_aggregators(codebook, **kwargs), codebook,
+                             profile=profile, cache=cache)
+        par = scan_folder_parallel(args.folder, args.prefix, args.workers, kwargs, profile=profile, cache=cache,
+                                   split_bytes=args.split_bytes, split_rows=max(1, args.split_bytes // 64))
+        bad = compare_results(serial, par)
+    print('parallel == serial' if not bad else f'MISMATCH in {", ".join(bad)}')
+    sys.exit(1 if bad else 0)
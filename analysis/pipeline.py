@@ -0,0 +1,349 @@
+import os
+import sys
+import json
+import time
+import pickle
+import inspect
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import pandas as pd
+
+import instrument
+from cache import content_hash
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASE_DIR = os.path.dirname(HERE)
+PIPELINE_DIR = os.path.join(BASE_DIR, 'analysis', '.cache', 'pipeline')
+# bump when keys or stored artifacts change, so every stage runs once
+PIPELINE_VERSION = 1
+
+
+def digest(value):
+    # content hash of an artifact: frames and arrays by their values, index
+    # and labels, containers by their items, anything else by its pickle
+    h = hashlib.sha1()
+    _update(h, value)
+    return h.hexdigest()
+
+
+def _update(h, value):
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        labels = list(value.columns) if isinstance(value, pd.DataFrame) else value.name
+        dtypes = [str(t) for t in np.atleast_1d(value.dtypes)]
+        h.update(repr((type(value).__name__, labels, list(value.index.names), dtypes)).encode())
+        h.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+    elif isinstance(value, np.ndarray) and value.dtype != object:
+        h.update(repr((value.dtype.str, value.shape)).encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        h.update(b'dict')
+        for k, v in value.items():
+            _update(h, k)
+            _update(h, v)
+    elif isinstance(value, (list, tuple)):
+        h.update(type(value).__name__.encode())
+        for v in value:
+            _update(h, v)
+    elif value is None or isinstance(value, (str, bytes, int, float, bool)):
+        h.update(repr(value).encode())
+    else:
+        h.update(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def _source(fn):
+    # a stage function's source and that of the functions of its module it
+    # calls, directly or from functions nested in it
+    seen, todo, parts = set(), [fn], []
+    while todo:
+        f = todo.pop()
+        if f in seen:
+            continue
+        seen.add(f)
+        parts.append(inspect.getsource(f))
+        codes = [f.__code__]
+        while codes:
+            code = codes.pop()
+            codes.extend(c for c in code.co_consts if inspect.iscode(c))
+            for name in code.co_names:
+                obj = f.__globals__.get(name)
+                if inspect.isfunction(obj) and obj.__module__ == fn.__module__:
+                    todo.append(obj)
+    return ''.join(parts)
+
+
+class Stage:
+    # one step of a pipeline. run(**inputs, **params, **options) returns a
+    # dict with each name in outputs and, for a stage that writes files, the
+    # paths under 'written'. The stage's key hashes the content of its input
+    # artifacts, of the files it reads (files: paths, or a callable returning
+    # them), of its source and the modules in code, and its params; options
+    # (worker counts and the like) are passed but do not change the key.
+    # main=True runs it on the calling thread, for stages that set signals
+    def __init__(self, name, run, inputs=(), outputs=(), files=(), code=(), params=None, options=None,
+                 main=False):
+        self.name = name
+        self.run = run
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.files = files
+        self.code = tuple(code)
+        self.params = dict(params or {})
+        self.options = dict(options or {})
+        self.main = main
+
+    def paths(self):
+        return list(self.files() if callable(self.files) else self.files)
+
+
+class Pipeline:
+    # stages as a dependency graph over named artifacts, which pass between
+    # stages in memory. A stage runs once everything it reads is ready, next
+    # to the other ready stages (up to jobs threads). With a root folder, each
+    # stage's key, output hashes and artifacts are kept there; a stage whose
+    # key matches the stored one, and whose written files are as it left
+    # them, is skipped and its artifacts are loaded only if a stage that does
+    # run reads them. A stage whose outputs come out unchanged leaves the
+    # stages after it skipped too.
+    def __init__(self, stages, root=PIPELINE_DIR):
+        self.stages = {s.name: s for s in stages}
+        self.producer = {}
+        for s in stages:
+            for name in s.outputs:
+                if name in self.producer:
+                    raise ValueError(f'{name!r} is produced by both {self.producer[name]!r} and {s.name!r}')
+                self.producer[name] = s.name
+        for s in stages:
+            for name in s.inputs:
+                if name not in self.producer:
+                    raise ValueError(f'stage {s.name!r} reads {name!r}, which no stage produces')
+        self.root = root
+        self.manifest = {'version': PIPELINE_VERSION, 'stages': {}, 'files': {}}
+        if root is not None and os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == PIPELINE_VERSION:
+                self.manifest = manifest
+        self.artifacts = {}
+        self.digests = {}
+        self.ran = []
+        self.skipped = []
+        self._lock = threading.Lock()
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.root, 'manifest.json')
+
+    def _artifact_path(self, stage):
+        return os.path.join(self.root, 'artifacts', hashlib.sha1(stage.encode()).hexdigest()[:16] + '.pkl')
+
+    def deps(self, name):
+        return {self.producer[i] for i in self.stages[name].inputs}
+
+    def plan(self, targets=None):
+        # the stages needed for targets (all by default), dependencies first
+        order, state = [], {}
+
+        def visit(name, path):
+            if state.get(name) == 'done':
+                return
+            if state.get(name) == 'open':
+                raise ValueError('cycle: ' + ' -> '.join(path + [name]))
+            state[name] = 'open'
+            for dep in sorted(self.deps(name)):
+                visit(dep, path + [name])
+            state[name] = 'done'
+            order.append(name)
+
+        for name in self.stages if targets is None else targets:
+            if name not in self.stages:
+                raise ValueError(f'unknown stage {name!r}; stages: {", ".join(self.stages)}')
+            visit(name, [])
+        return order
+
+    def file_hash(self, path):
+        # content hash, reused while the file's size and mtime are unchanged
+        st = os.stat(path)
+        known = self.manifest['files'].get(path)
+        if known and known[:2] == [st.st_size, st.st_mtime_ns]:
+            return known[2]
+        sha1 = content_hash(path)
+        with self._lock:
+            self.manifest['files'][path] = [st.st_size, st.st_mtime_ns, sha1]
+        return sha1
+
+    def key(self, stage, digests=None):
+        digests = self.digests if digests is None else digests
+        h = hashlib.sha1(repr((PIPELINE_VERSION, stage.name, sorted(stage.params.items()))).encode())
+        h.update(_source(stage.run).encode())
+        for path in stage.code:
+            h.update(self.file_hash(os.path.join(HERE, path)).encode())
+        for path in stage.paths():
+            h.update(f'{path}:{self.file_hash(path)}'.encode())
+        for name in stage.inputs:
+            h.update(f'{name}:{digests[name]}'.encode())
+        return h.hexdigest()
+
+    def fresh(self, stage, key):
+        # the stored run of this stage is still good for key
+        entry = self.manifest['stages'].get(stage.name)
+        if entry is None or entry['key'] != key or not os.path.exists(self._artifact_path(stage.name)):
+            return False
+        for old in entry['written']:
+            try:
+                st = os.stat(old['path'])
+            except OSError:
+                return False
+            if (st.st_size, st.st_mtime_ns) != (old['size'], old['mtime_ns']):
+                return False
+        return True
+
+    def artifact(self, name):
+        with self._lock:
+            if name not in self.artifacts:
+                with open(self._artifact_path(self.producer[name]), 'rb') as f:
+                    self.artifacts.update(pickle.load(f))
+            return self.artifacts[name]
+
+    def _run(self, stage, key):
+        inputs = {name: self.artifact(name) for name in stage.inputs}
+        with instrument.stage(stage.name):
+            out = stage.run(**inputs, **stage.params, **stage.options) or {}
+        written = out.pop('written', [])
+        missing = [name for name in stage.outputs if name not in out]
+        if missing:
+            raise ValueError(f'stage {stage.name!r} did not return {", ".join(missing)}')
+        out = {name: out[name] for name in stage.outputs}
+        digests = {name: digest(value) for name, value in out.items()}
+        with self._lock:
+            self.artifacts.update(out)
+            self.digests.update(digests)
+        if self.root is None:
+            return
+        path = self._artifact_path(stage.name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(out, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+        written = [{'path': os.path.abspath(p), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+                   for p, st in ((p, os.stat(p)) for p in dict.fromkeys(written))]
+        with self._lock:
+            self.manifest['stages'][stage.name] = {'key': key, 'outputs': digests, 'written': written,
+                                                   'ran': pd.Timestamp.now().isoformat(timespec='seconds')}
+            self._save()
+
+    def _save(self):
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.manifest_path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(self.manifest_path + '.tmp', self.manifest_path)
+
+    def run(self, targets=None, force=(), jobs=1):
+        # runs (or skips) every stage targets need; returns the artifacts in
+        # memory, i.e. those of the stages that ran and any loaded for them
+        order = self.plan(targets)
+        pending = {name: self.deps(name) for name in order}
+        done, running = set(), {}
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+            while pending or running:
+                inline, skipped = [], False
+                for name in [n for n in order if n in pending and pending[n] <= done]:
+                    del pending[name]
+                    stage = self.stages[name]
+                    key = self.key(stage)
+                    if self.root is not None and name not in force and self.fresh(stage, key):
+                        with self._lock:
+                            self.digests.update(self.manifest['stages'][name]['outputs'])
+                        self.skipped.append(name)
+                        done.add(name)
+                        skipped = True
+                    elif stage.main or jobs <= 1:
+                        inline.append((stage, key))
+                    else:
+                        running[pool.submit(self._run, stage, key)] = name
+                for stage, key in inline:
+                    self._run(stage, key)
+                    self.ran.append(stage.name)
+                    done.add(stage.name)
+                # a skipped or finished stage may have made others ready
+                if inline or skipped:
+                    continue
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    future.result()
+                    self.ran.append(name)
+                    done.add(name)
+        if self.root is not None:
+            self._save()
+        return dict(self.artifacts)
+
+    def status(self, targets=None):
+        # stage -> 'unchanged', 'stale', or 'after <stage>' when it waits on a
+        # stale stage whose outputs may or may not change; without running
+        out = {}
+        for name in self.plan(targets):
+            stage = self.stages[name]
+            waits = [dep for dep in sorted(self.deps(name)) if out[dep] != 'unchanged']
+            if waits:
+                out[name] = 'after ' + waits[0]
+                continue
+            entry = self.manifest['stages'].get(name)
+            digests = {}
+            for dep in self.deps(name):
+                digests.update(self.manifest['stages'][dep]['outputs'])
+            out[name] = 'unchanged' if entry is not None and self.fresh(stage, self.key(stage, digests)) else 'stale'
+        return out
+
+
+def stages(args):
+    # the analysis plus the PDF and the slide deck, each left out with a
+    # warning when its library is not installed
+    import analytics
+    out = analytics.stages(args)
+    try:
+        import make_pdf
+        out.append(make_pdf.stage())
+    except ImportError as e:
+        print(f'Warning: skipping the PDF ({e})')
+    try:
+        import make_presentation
+        out.append(make_presentation.stage())
+    except ImportError as e:
+        print(f'Warning: skipping the slides ({e})')
+    return out
+
+
+def main(argv=None):
+    import analytics
+    from serve import mark_run
+    parser = argparse.ArgumentParser(description='Build the analysis, report, PDF and slides, skipping stages whose '
+                                                 'inputs are unchanged.', parents=[analytics.arg_parser(False)])
+    parser.add_argument('targets', nargs='*', help='stages to bring up to date (default: all)')
+    parser.add_argument('--force', action='append', default=[], metavar='STAGE',
+                        help='run this stage even if unchanged (repeatable; "all" for every stage)')
+    parser.add_argument('--dry-run', action='store_true', help='only list which stages would run')
+    args = parser.parse_args(argv)
+    pipeline = Pipeline(stages(args))
+    if args.dry_run:
+        for name, state in pipeline.status(args.targets or None).items():
+            print(f'{name}: {state}')
+        return
+    recorder = instrument.start('pipeline', args.profile, argv)
+    force = set(pipeline.stages) if 'all' in args.force else set(args.force)
+    t0 = time.perf_counter()
+    pipeline.run(args.targets or None, force, args.jobs)
+    print(f'Pipeline: {len(pipeline.ran)} ran ({", ".join(pipeline.ran) or "none"}), '
+          f'{len(pipeline.skipped)} unchanged in {time.perf_counter() - t0:.1f}s')
+    if pipeline.ran:
+        report = recorder.write(analytics.OUT_DIR, args.trace)
+        print(instrument.summary(report))
+        # tells a running query service (serve.py) to load this run's results
+        mark_run(analytics.OUT_DIR)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+import re
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:  # optional: only needed for engine='pyarrow'
+    pa = None
+    pa_csv = None
+
+from schema import clean_columns, age_columns
+
+CHUNKSIZE = 200_000
+MIN_CHUNKSIZE = 10_000
+MAX_CHUNKSIZE = 5_000_000
+SAMPLE_ROWS = 20_000
+# working memory per byte of parsed chunk: key codes, the int64 value matrix
+# and groupby temporaries live alongside the frame itself
+CHUNK_OVERHEAD = 4
+# bytes per row of a cached batch once loaded: codes, day, int64 counts
+CACHED_ROW_BYTES = 64
+CACHED_AGE_BYTES = 16
+
+# compact dtypes for the Aadhaar API schemas; counts are nullable so blank
+# cells survive typed parsing. Counts stay Int32 rather than UInt16: the C
+# parser silently wraps values that overflow a narrow type (70000 -> 4464),
+# so a too-narrow dtype could not fall back, only corrupt
+STRING_COLUMNS = ('date', 'state', 'district')
+PINCODE_DTYPE = 'Int32'
+COUNT_DTYPE = 'Int32'
+
+
+def parse_size(text):
+    # '512M', '2G', '750000' -> bytes
+    m = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*', str(text).lower())
+    if not m:
+        raise ValueError(f'invalid size: {text!r}')
+    return int(float(m.group(1)) * 1024 ** ' kmgt'.index(m.group(2) or ' '))
+
+
+def _rewind(source):
+    if hasattr(source, 'seek'):
+        source.seek(0)
+    return source
+
+
+class ReaderProfile:
+    # how source CSVs are read: compact dtypes, only the columns the consumers
+    # need, the parser engine, and a chunk size that is either fixed or derived
+    # from a memory budget and the measured bytes per row
+    def __init__(self, engine='c', memory_budget=None, chunksize=CHUNKSIZE, typed=True):
+        if engine == 'pyarrow' and pa_csv is None:
+            raise RuntimeError("engine='pyarrow' needs the pyarrow package")
+        self.engine = engine
+        self.memory_budget = memory_budget
+        self.chunksize = chunksize
+        self.typed = typed
+        # measured bytes per parsed row, shared by every file of a scan
+        self.row_bytes = None
+
+    def plan(self, source, prefix=None, columns=None):
+        # raw header names to read and their dtypes; columns=None keeps all
+        raw = list(pd.read_csv(_rewind(source), nrows=0).columns)
+        _rewind(source)
+        clean = dict(zip(raw, clean_columns(raw)))
+        ages = set(age_columns(clean.values(), prefix))
+        keep = [r for r in raw if clean[r] in ages or columns is None or clean[r] in columns]
+        dtypes = {}
+        if self.typed:
+            for r in keep:
+                if clean[r] in ages:
+                    dtypes[r] = COUNT_DTYPE
+                elif clean[r] == 'pincode':
+                    dtypes[r] = PINCODE_DTYPE
+                elif clean[r] in STRING_COLUMNS:
+                    dtypes[r] = 'category'
+        return keep, dtypes
+
+    def measure(self, source, usecols, dtypes):
+        if self.row_bytes is None:
+            sample = pd.read_csv(_rewind(source), usecols=usecols, dtype=dtypes, nrows=SAMPLE_ROWS)
+            _rewind(source)
+            self.row_bytes = max(1.0, sample.memory_usage(deep=True).sum() / max(len(sample), 1))
+        return self.row_bytes
+
+    def rows_for(self, row_bytes, overhead=CHUNK_OVERHEAD):
+        if not self.memory_budget:
+            return self.chunksize
+        rows = int(self.memory_budget / (row_bytes * overhead))
+        return int(np.clip(rows, MIN_CHUNKSIZE, MAX_CHUNKSIZE))
+
+    def chunksize_for(self, source, usecols, dtypes):
+        if not self.memory_budget:
+            return self.chunksize
+        return self.rows_for(self.measure(source, usecols, dtypes))
+
+    def cached_chunksize(self, n_age_cols):
+        if not self.memory_budget:
+            return self.chunksize
+        return self.rows_for(CACHED_ROW_BYTES + CACHED_AGE_BYTES * n_age_cols, overhead=1)
+
+    def read(self, source, prefix=None, columns=None):
+        # cleaned-column chunks of one CSV (path or binary buffer); if typed
+        # parsing hits a malformed value the rest of the file is re-read untyped
+        usecols, dtypes = self.plan(source, prefix, columns)
+        chunksize = self.chunksize_for(source, usecols, dtypes)
+        done = 0
+        try:
+            chunks = self._read_arrow(source, usecols, dtypes, chunksize) if self.engine == 'pyarrow' else \
+                pd.read_csv(_rewind(source), usecols=usecols, dtype=dtypes, chunksize=chunksize)
+            for chunk in chunks:
+                done += len(chunk)
+                chunk.columns = clean_columns(chunk.columns)
+                yield chunk
+        except (ValueError, TypeError) as e:
+            if not dtypes and self.engine != 'pyarrow':
+                raise
+            print(f'Warning: typed read failed after {done} rows ({e}); reading the rest untyped')
+            rest = pd.read_csv(_rewind(source), usecols=usecols, skiprows=range(1, done + 1), chunksize=chunksize)
+            for chunk in rest:
+                chunk.columns = clean_columns(chunk.columns)
+                # malformed counts become blanks, as in the cache build
+                ages = age_columns(chunk.columns, prefix)
+                chunk[ages] = chunk[ages].apply(pd.to_numeric, errors='coerce')
+                yield chunk
+
+    def _read_arrow(self, source, usecols, dtypes, chunksize):
+        types = {r: pa.dictionary(pa.int32(), pa.string()) if d == 'category' else pa.int32()
+                 for r, d in dtypes.items()}
+        # block size that yields roughly `chunksize` rows per record batch
+        if hasattr(source, 'read'):
+            head = _rewind(source).read(1 << 16)
+            _rewind(source)
+        else:
+            with open(source, 'rb') as f:
+                head = f.read(1 << 16)
+        line_bytes = max(1, len(head) // max(head.count(b'\n'), 1))
+        reader = pa_csv.open_csv(
+            source,
+            read_options=pa_csv.ReadOptions(block_size=max(1 << 16, chunksize * line_bytes)),
+            convert_options=pa_csv.ConvertOptions(include_columns=usecols, column_types=types,
+                                                  strings_can_be_null=True))
+        for rb in reader:
+            yield rb.to_pandas()
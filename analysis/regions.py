@@ -0,0 +1,235 @@
+import os
+import re
+import sys
+import time
+import argparse
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# canonical states and districts, plus the old names, misspellings, renames,
+# mergers and bifurcations that resolve to them. A row with an empty
+# canonical_state is a canonical name itself; district rows are keyed by the
+# canonical state (an alias may move a district to another state, e.g. the
+# pre-2014 Andhra Pradesh districts now in Telangana); 'parent' is the district
+# a bifurcated one was carved from; 'since' is when a change took effect
+TABLE = os.path.join(HERE, 'regions.csv')
+CHANGES = ('spelling', 'rename', 'bifurcation', 'merger', 'misfiled')
+# how a raw name resolved, best first; see Regions.resolve
+MATCHES = ('exact', 'variant') + CHANGES + ('unmatched district', 'unmatched state', 'missing state')
+_FOLD = re.compile(r'[^a-z0-9]')
+_SPACE = re.compile(r'\s+')
+
+
+def fold(name):
+    # comparison key: case, spacing, punctuation and '&' vs 'and' are ignored
+    return _FOLD.sub('', str(name).lower().replace('&', 'and'))
+
+
+def clean(name):
+    # display form of a name the table does not know, so its case and
+    # spacing variants still group together
+    return _SPACE.sub(' ', str(name).replace('*', ' ')).strip().title()
+
+
+def table_version(path=TABLE):
+    # content hash of the table; stored state built with another table is stale
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()[:12]
+
+
+class Regions:
+    # the alias table, with each distinct raw (state, district) spelling
+    # resolved at most once per process however many rows, chunks and files
+    # carry it
+    def __init__(self, path=TABLE):
+        table = pd.read_csv(path, dtype=str, keep_default_na=False)
+        self.version = table_version(path)
+        # fold(state) -> (state, district forced on its rows or '', change)
+        self.states = {}
+        # (state, fold(district)) -> (state, district, change)
+        self.districts = {}
+        # (state, district) -> (parent district, since) of a bifurcated district
+        self.parents = {}
+        for r in table.itertuples(index=False):
+            if r.change and r.change not in CHANGES:
+                raise ValueError(f'{path}: unknown change {r.change!r} for {r.state!r} {r.district!r}')
+            if r.district:
+                key, value = (r.state, fold(r.district)), (r.canonical_state or r.state, r.canonical_district or r.district,
+                                                          r.change if r.canonical_state else '')
+                if not r.canonical_state and r.parent:
+                    self.parents[(r.state, r.district)] = (r.parent, r.since)
+                target = self.districts
+            else:
+                key, value = fold(r.state), (r.canonical_state or r.state, r.canonical_district, r.change)
+                target = self.states
+            if key in target and target[key] != value:
+                raise ValueError(f'{path}: {r.state!r} {r.district!r} resolves two ways')
+            target[key] = value
+        self._memo = {}
+        self._district_keys = None
+
+    def resolve(self, state, district=None):
+        # raw names -> (state, district, match); district is None for rows
+        # without one. match is 'exact', 'variant' (case, spacing or
+        # punctuation only), the table's change for an alias, or 'unmatched
+        # state'/'unmatched district' for names the table does not know
+        key = (state, district)
+        if key not in self._memo:
+            self._memo[key] = self._resolve(state, district)
+        return self._memo[key]
+
+    def _resolve(self, state, district):
+        if state is None:
+            return None, None, 'missing state'
+        hit = self.states.get(fold(state))
+        if hit is None:
+            return clean(state), None if district is None else clean(district), 'unmatched state'
+        canon, forced, change = hit
+        match = change or ('exact' if state == canon else 'variant')
+        if forced or district is None:
+            return canon, forced or None, match
+        hit = self.districts.get((canon, fold(district)))
+        if hit is None:
+            return canon, clean(district), 'unmatched district'
+        canon, name, change = hit
+        if change:
+            match = change
+        elif match == 'exact' and district != name:
+            match = 'variant'
+        return canon, name, match
+
+    def canonicalize(self, states, districts=None):
+        # raw name arrays -> canonical (states, districts, matches) arrays;
+        # missing names are None and each distinct pair is resolved once
+        frame = pd.DataFrame({'state': states, 'district': None if districts is None else districts})
+        frame = frame.astype(object).where(frame.notna(), None)
+        group = frame.groupby(['state', 'district'], dropna=False, sort=False).ngroup().to_numpy()
+        first = frame.iloc[np.unique(group, return_index=True)[1]]
+        resolved = np.array([self.resolve(s, d) for s, d in zip(first['state'], first['district'])] or
+                            np.empty((0, 3)), dtype=object).reshape(-1, 3)
+        return resolved[group, 0], resolved[group, 1], resolved[group, 2]
+
+    def state_key(self, name):
+        # lower-cased canonical state of any spelling, for matching user input
+        return self.resolve(name)[0].lower()
+
+    def district_keys(self, name):
+        # lower-cased canonical districts a name resolves to in any state
+        if self._district_keys is None:
+            self._district_keys = {}
+            for (_, key), (_, district, _) in self.districts.items():
+                self._district_keys.setdefault(key, set()).add(district.lower())
+        return self._district_keys.get(fold(name), {clean(name).lower()})
+
+    def parent(self, state, district):
+        # the district a bifurcated one was carved from, or None
+        return self.parents.get((state, district), (None, None))[0]
+
+
+_default = None
+
+
+def default():
+    # the process-wide table, loaded on first use
+    global _default
+    if _default is None:
+        _default = Regions()
+    return _default
+
+
+def state_keys(names):
+    return [default().state_key(n) for n in names]
+
+
+def district_keys(names):
+    return sorted(set().union(*[default().district_keys(n) for n in names]))
+
+
+def normalize(names):
+    # stripped, lower-cased names, the keys the cubes, forecasts and the
+    # joined view match places on; each distinct name is normalized once
+    codes, uniques = pd.factorize(pd.Index(names, dtype=object), use_na_sentinel=False)
+    return pd.Index(uniques, dtype=object).str.strip().str.lower()[codes]
+
+
+def place_key(state, district=''):
+    # lower-cased canonical (state, district) of any spelling
+    canon, name, _ = default().resolve(state, district or None)
+    return canon.lower(), (name or '').lower()
+
+
+def match_summary(matches):
+    # RegionMatches result -> source rows and distinct spellings per match kind
+    df = matches.groupby('match').agg(spellings=('rows', 'size'), rows=('rows', 'sum'))
+    df = df.reindex([m for m in MATCHES if m in df.index])
+    df['row_share'] = (df['rows'] / max(int(df['rows'].sum()), 1)).round(4)
+    return df
+
+
+def unmatched(matches):
+    return matches[matches['match'].str.startswith('unmatched')]
+
+
+def _bench(folder, rows, chunksize=250_000):
+    # group codes for every row of every chunk: strip/lower on each string,
+    # then factorize, vs the scan's path of coding the dictionary-encoded
+    # columns the reader yields and remapping the codes through the memoized
+    # place table
+    import glob
+    from accumulators import Codebook
+    files = sorted(glob.glob(os.path.join(folder, '*.csv')))
+    df = pd.concat([pd.read_csv(f, usecols=['state', 'district'], dtype=str) for f in files], ignore_index=True)
+    df = df.iloc[np.arange(rows) % len(df)].reset_index(drop=True)
+    chunks = [df.iloc[lo:lo + chunksize] for lo in range(0, len(df), chunksize)]
+    coded = [chunk.astype('category') for chunk in chunks]
+    t = time.perf_counter()
+    per_row = set()
+    for chunk in chunks:
+        state = chunk['state'].str.strip().str.lower()
+        pd.factorize(state)
+        pd.factorize(chunk['district'].str.strip().str.lower())
+        per_row.update(state.unique())
+    per_row_s = time.perf_counter() - t
+    codebook = Codebook(regions=Regions())
+    t = time.perf_counter()
+    for chunk in coded:
+        codebook.places(codebook.encode('state_raw', chunk['state']), codebook.encode('district_raw', chunk['district']))
+    canonical_s = time.perf_counter() - t
+    return {'rows': len(df), 'distinct_pairs': len(codebook.regions._memo), 'strip_lower_s': round(per_row_s, 3),
+            'canonical_s': round(canonical_s, 3), 'states_strip_lower': len(per_row),
+            'states_canonical': len(codebook['state'])}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Resolve state/district names against the region table.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('resolve', help='resolve one name or a state/district pair')
+    p.add_argument('state')
+    p.add_argument('district', nargs='?')
+    p = sub.add_parser('scan', help='resolve every distinct spelling in a folder of CSVs')
+    p.add_argument('folder')
+    p.add_argument('--prefix', default='demo', help="age-column prefix of the folder's CSVs")
+    p.add_argument('--unmatched', action='store_true', help='only names the table does not know')
+    p = sub.add_parser('bench', help='canonical code remap vs per-row strip/lower')
+    p.add_argument('folder')
+    p.add_argument('--rows', type=int, default=5_000_000)
+    args = parser.parse_args()
+
+    if args.command == 'resolve':
+        state, district, match = default().resolve(args.state, args.district)
+        parent = default().parent(state, district)
+        print(f'{state} / {district} ({match})' + (f', carved from {parent}' if parent else ''))
+    elif args.command == 'scan':
+        from scan import scan_folder, new_codebook, RegionMatches
+        codebook = new_codebook(args.prefix)
+        matches = scan_folder(args.folder, args.prefix, {'regions': RegionMatches(codebook)}, codebook)['regions']
+        print(f'region table {default().version}')
+        print(match_summary(matches).to_markdown())
+        out = unmatched(matches) if args.unmatched else matches[matches['match'] != 'exact']
+        if not out.empty:
+            out.to_csv(sys.stdout, index=False)
+    else:
+        print(_bench(args.folder, args.rows))
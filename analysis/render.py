@@ -0,0 +1,141 @@
+import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OUT_DIR = os.path.join(BASE_DIR, 'analysis', 'outputs')
+MANIFEST = 'charts.json'
+# bump when drawing changes, so every chart is redrawn once
+RENDER_VERSION = 1
+# one reusable figure per template in each process
+TEMPLATES = {
+    'bar': {'figsize': (10, 6), 'color': 'C0', 'ylabel': 'Total updates'},
+    'age': {'figsize': (8, 4), 'color': 'C2', 'ylabel': 'Total updates'},
+    'forecast': {'figsize': (10, 5)},
+}
+
+_figures = {}
+
+
+def chart(kind, path, data, title, group='', color=None, state=''):
+    # one chart to render: path is relative to the output folder, data is the
+    # Series (bars) or historical/forecast frame it is drawn from; state names
+    # the selected state (--states) a per-state chart belongs to
+    return {'id': os.path.splitext(path)[0], 'kind': kind, 'path': path, 'data': data, 'title': title,
+            'group': group, 'state': state, 'color': color or TEMPLATES[kind].get('color')}
+
+
+def manifest_entry(spec):
+    return {k: spec[k] for k in ('kind', 'path', 'title', 'group', 'state', 'hash')}
+
+
+def chart_hash(spec):
+    # everything the PNG depends on: drawing version, template, labels, data
+    h = hashlib.sha1(repr((RENDER_VERSION, spec['kind'], TEMPLATES[spec['kind']], spec['title'],
+                           spec['color'])).encode())
+    data = spec['data']
+    names = list(data.columns) if isinstance(data, pd.DataFrame) else [data.name]
+    h.update(repr(names).encode())
+    h.update(pd.util.hash_pandas_object(data, index=True).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+def _template(kind):
+    # the process's figure for this template, cleared instead of rebuilt
+    fig = _figures.get(kind)
+    if fig is None:
+        fig = Figure(figsize=TEMPLATES[kind]['figsize'])
+        FigureCanvasAgg(fig)
+        _figures[kind] = fig
+    fig.clf()
+    return fig
+
+
+def draw(spec, out_dir):
+    fig = _template(spec['kind'])
+    ax = fig.add_subplot()
+    data = spec['data']
+    if spec['kind'] == 'forecast':
+        data['historical'].dropna().plot(ax=ax, label='historical')
+        data['forecast'].dropna().plot(ax=ax, label='forecast')
+        ax.legend()
+    else:
+        data.plot(kind='bar', color=spec['color'], ax=ax)
+        ax.set_ylabel(TEMPLATES[spec['kind']]['ylabel'])
+    ax.set_title(spec['title'])
+    fig.tight_layout()
+    fig.savefig(os.path.join(out_dir, spec['path']))
+
+
+def render_block(specs, out_dir):
+    # worker: one block of charts drawn on this process's templates
+    for spec in specs:
+        draw(spec, out_dir)
+    return len(specs)
+
+
+def load_manifest(out_dir=OUT_DIR, latest=False):
+    # chart id -> {kind, path, title, group, state, hash}; empty before the
+    # first render. latest=True keeps only the charts of the last run
+    path = os.path.join(out_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        data = json.load(f)
+    if latest and 'run' in data:
+        return {k: data['charts'][k] for k in data['run'] if k in data['charts']}
+    return data['charts']
+
+
+def state_charts(manifest):
+    # selected state -> group -> its chart ids, in manifest order
+    out = {}
+    for chart_id, entry in manifest.items():
+        if entry.get('state'):
+            out.setdefault(entry['state'], {}).setdefault(entry['group'], []).append(chart_id)
+    return out
+
+
+def chart_file(manifest, chart_id, out_dir=OUT_DIR):
+    # absolute path of a chart, from the manifest when it lists the chart
+    entry = manifest.get(chart_id)
+    return os.path.join(out_dir, entry['path'] if entry else chart_id + '.png')
+
+
+def render_charts(specs, out_dir=OUT_DIR, workers=1):
+    # draws every chart whose data hash differs from the one recorded with
+    # its existing PNG, spread over a process pool, and rewrites the manifest.
+    # Returns {'rendered': n, 'skipped': n}.
+    manifest = load_manifest(out_dir)
+    todo = []
+    for spec in specs:
+        spec['hash'] = chart_hash(spec)
+        old = manifest.get(spec['id'])
+        if old is None or old['hash'] != spec['hash'] or not os.path.exists(os.path.join(out_dir, spec['path'])):
+            todo.append(spec)
+    for spec in todo:
+        os.makedirs(os.path.dirname(os.path.join(out_dir, spec['path'])), exist_ok=True)
+    if workers > 1 and len(todo) > 1:
+        # a few blocks per worker, so each worker's templates are reused
+        size = max(1, -(-len(todo) // (workers * 4)))
+        blocks = [todo[i:i + size] for i in range(0, len(todo), size)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(render_block, blocks, [out_dir] * len(blocks)))
+    else:
+        render_block(todo, out_dir)
+    # charts from earlier runs stay listed while their PNG exists
+    manifest = {k: v for k, v in manifest.items() if os.path.exists(os.path.join(out_dir, v['path']))}
+    for spec in specs:
+        manifest[spec['id']] = manifest_entry(spec)
+    tmp = os.path.join(out_dir, MANIFEST + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump({'version': RENDER_VERSION, 'charts': manifest, 'run': [spec['id'] for spec in specs]}, f, indent=1)
+    os.replace(tmp, os.path.join(out_dir, MANIFEST))
+    return {'rendered': len(todo), 'skipped': len(specs) - len(todo)}
@@ -0,0 +1,484 @@
+import os
+import glob
+from collections import Counter
+import numpy as np
+import pandas as pd
+
+import instrument
+from accumulators import Codebook, KeyCodec, KeyedSum, pack_keys, unpack_keys
+from cube import CubeCells
+from dates import DateDecoder, date_format
+from join import JoinCells
+from reader import ReaderProfile
+from schema import age_columns, days_to_dates, day_weeks, week_dates, DATE_COL, NO_DAY
+from sketches import PincodeExact, PincodeHotspots
+from spill import SpillingReducer, MEMORY_CAP
+
+DAILY_DIMS = ('state', 'district', 'day')
+# day numbers are biased into the non-negative range before packing
+DAY_BIAS = 1 << 23
+LEAF_DIMS = ('state', 'district', 'pincode')
+# codebook dimensions coded from the spellings in a column, before resolution
+RAW_COLUMNS = {'state_raw': 'state', 'district_raw': 'district'}
+RAW_DIMS = ('state_raw', 'district_raw')
+PINCODE_DIMS = ('leaf', 'week')
+
+
+def list_csv_files(folder):
+    return sorted(glob.glob(os.path.join(folder, '*.csv')))
+
+
+def new_codebook(prefix):
+    # shared per-scan state, with the date decoder configured for the dataset
+    return Codebook(dates=DateDecoder(date_format(prefix)))
+
+
+class BaseBatch:
+    # coded key columns are computed at most once per chunk no matter how many
+    # aggregators ask for them; canonical 'state' and 'district' codes are
+    # remapped from the raw spelling codes, 'state_norm' from the state codes
+    def codes(self, dim):
+        if dim not in self._codes:
+            if dim == 'state_norm':
+                self._codes[dim] = self.codebook.normalized_states(self.codes('state'))
+            elif dim in ('state', 'district'):
+                self._codes['state'], self._codes['district'] = self.codebook.places(self.codes('state_raw'),
+                                                                                     self.raw_districts())
+            else:
+                self._codes[dim] = self._encode(dim)
+        return self._codes[dim]
+
+    def raw_districts(self):
+        if self.has('district'):
+            return self.codes('district_raw')
+        return np.full(len(self), -1, dtype=np.int64)
+
+
+class Batch(BaseBatch):
+    # one parsed CSV chunk
+    def __init__(self, chunk, age_cols, codebook, date_col=DATE_COL):
+        self.chunk = chunk
+        self.age_cols = age_cols
+        self.codebook = codebook
+        self.date_col = date_col
+        self._codes = {}
+        self._values = None
+        self._days = None
+        self._bad_dates = {}
+
+    def __len__(self):
+        return len(self.chunk)
+
+    def has(self, dim):
+        return dim in self.chunk.columns
+
+    def _encode(self, dim):
+        return self.codebook.encode(dim, self.chunk[RAW_COLUMNS.get(dim, dim)])
+
+    @property
+    def values(self):
+        if self._values is None:
+            # typed reads give nullable counts; blank cells count as zero
+            self._values = self.chunk[self.age_cols].to_numpy(dtype=np.int64, na_value=0)
+        return self._values
+
+    @property
+    def days(self):
+        if self._days is None:
+            if self.date_col in self.chunk.columns:
+                self._days = self.codebook.dates.decode(self.chunk[self.date_col])
+                self._bad_dates = self.codebook.dates.take_bad_values()
+            else:
+                self._days = np.full(len(self.chunk), NO_DAY, dtype=np.int32)
+                self._bad_dates = {'<missing>': len(self.chunk)}
+        return self._days
+
+    def bad_dates(self):
+        self.days
+        return self._bad_dates
+
+
+class CachedBatch(BaseBatch):
+    # a row slice of a columnar cache entry; file-local dictionary codes are
+    # remapped to the shared codebook through a small lookup array
+    def __init__(self, entry, start, stop, age_idx, age_cols, codebook, remaps):
+        self.entry = entry
+        self.rows = slice(start, stop)
+        self.age_idx = age_idx
+        self.age_cols = age_cols
+        self.codebook = codebook
+        self.remaps = remaps
+        self._codes = {}
+        self._values = None
+
+    def __len__(self):
+        return self.rows.stop - self.rows.start
+
+    def has(self, dim):
+        return True
+
+    def _encode(self, dim):
+        local = np.asarray(self.entry[RAW_COLUMNS.get(dim, dim)][self.rows])
+        if dim in self.remaps:
+            return self.remaps[dim][local]
+        return self.codebook.encode(dim, local)
+
+    @property
+    def values(self):
+        if self._values is None:
+            self._values = np.asarray(self.entry['ages'][self.rows][:, self.age_idx], dtype=np.int64)
+        return self._values
+
+    @property
+    def days(self):
+        return np.asarray(self.entry['day'][self.rows])
+
+    def bad_dates(self):
+        # recorded per file when the entry was built; reported by the slice
+        # that starts the file
+        return self.entry.meta['bad_dates'] if self.rows.start == 0 else {}
+
+
+class StateTotals:
+    # per-state sums of every age column
+    columns = ('state',)
+
+    def __init__(self, codebook):
+        self.sums = KeyedSum(['state'], codebook)
+
+    def consume(self, batch):
+        self.sums.add([batch.codes('state')], batch.values, batch.age_cols)
+
+    def result(self):
+        return self.sums.to_frame()
+
+    def partial(self):
+        return self.sums.partial()
+
+    def merge(self, partial, sign=1):
+        self.sums.merge(partial, sign)
+
+
+class DistrictTotals:
+    # per-(state, district) sums of every age column for all states in one
+    # grouped pass; states are keyed on their lower-cased canonical name
+    columns = ('state', 'district')
+
+    def __init__(self, codebook):
+        self.sums = KeyedSum(['state_norm', 'district'], codebook)
+
+    def consume(self, batch):
+        if not batch.has('district'):
+            return
+        self.sums.add([batch.codes('state_norm'), batch.codes('district')], batch.values, batch.age_cols)
+
+    def result(self):
+        return self.sums.to_frame()
+
+    def partial(self):
+        return self.sums.partial()
+
+    def merge(self, partial, sign=1):
+        self.sums.merge(partial, sign)
+
+
+class RegionMatches:
+    # source rows per raw (state, district) spelling and what the region table
+    # resolved it to, for the unmatched-names report; missing names are None
+    columns = ('state', 'district')
+
+    def __init__(self, codebook):
+        self.codebook = codebook
+        # packed (raw state code + 1, raw district code + 1) -> rows
+        self.pairs = KeyCodec(dtype=np.int64)
+        self.rows = np.zeros(0, dtype=np.int64)
+
+    def _add(self, state, district, rows):
+        slot = self.pairs.encode(pack_keys(RAW_DIMS, [state + 1, district + 1]))
+        if len(self.rows) < len(self.pairs):
+            self.rows = np.concatenate([self.rows, np.zeros(len(self.pairs) - len(self.rows), dtype=np.int64)])
+        np.add.at(self.rows, slot, rows)
+
+    def consume(self, batch):
+        # one bincount over the chunk's raw pair codes
+        state, district = batch.codes('state_raw') + 1, batch.raw_districts() + 1
+        if not len(state):
+            return
+        width = int(district.max()) + 1
+        n = np.bincount(state * width + district)
+        seen = np.flatnonzero(n)
+        self._add(seen // width - 1, seen % width - 1, n[seen])
+
+    def partial(self):
+        rows = np.flatnonzero(self.rows)
+        state, district = unpack_keys(RAW_DIMS, np.asarray(self.pairs.values, dtype=np.int64)[rows])
+        return {'state': np.append(self.codebook['state_raw'].values, None)[state - 1],
+                'district': np.append(self.codebook['district_raw'].values, None)[district - 1],
+                'rows': self.rows[rows]}
+
+    def merge(self, partial, sign=1):
+        self._add(self.codebook.encode('state_raw', partial['state']),
+                  self.codebook.encode('district_raw', partial['district']), sign * partial['rows'])
+
+    def result(self):
+        df = pd.DataFrame(self.partial()).rename(columns={'state': 'raw_state', 'district': 'raw_district'})
+        df['state'], df['district'], df['match'] = self.codebook.regions.canonicalize(df['raw_state'],
+                                                                                      df['raw_district'])
+        df['parent'] = [self.codebook.regions.parent(s, d) for s, d in zip(df['state'], df['district'])]
+        return df.sort_values(['rows', 'raw_state', 'raw_district'], ascending=[False, True, True],
+                              kind='stable', na_position='first').reset_index(drop=True)
+
+
+class DailySeries:
+    # (state, district, date) -> total updates across all age columns; chunks
+    # are reduced into a running keyed aggregate as they arrive, so memory
+    # follows the number of distinct keys (up to memory_cap, then spilled runs)
+    # rather than the number of input rows
+    columns = ('state', 'district', 'date')
+
+    def __init__(self, codebook, memory_cap=None):
+        self.codebook = codebook
+        # value columns: total_updates, source rows
+        self.sums = SpillingReducer(2, memory_cap or MEMORY_CAP)
+
+    def _add(self, state, district, days, totals, rows):
+        key = pack_keys(DAILY_DIMS, [state, district, days.astype(np.int64) + DAY_BIAS])
+        self.sums.add(key, np.column_stack([totals, rows]))
+
+    def consume(self, batch):
+        state, district, days = batch.codes('state'), batch.codes('district'), batch.days
+        ok = (state >= 0) & (district >= 0) & (days != NO_DAY)
+        self._add(state[ok], district[ok], days[ok], batch.values[ok].sum(axis=1),
+                  np.ones(int(ok.sum()), dtype=np.int64))
+
+    def partial(self):
+        keys, values = self.sums.reduced()
+        # keys whose every source row was retracted disappear
+        keep = values[:, 1] > 0
+        state, district, day = unpack_keys(DAILY_DIMS, keys[keep])
+        return {
+            'state': self.codebook['state'].decode(state),
+            'district': self.codebook['district'].decode(district),
+            'day': (day - DAY_BIAS).astype(np.int32),
+            'total_updates': values[keep, 0],
+            'rows': values[keep, 1],
+        }
+
+    def merge(self, partial, sign=1):
+        # sign=-1 retracts a partial that was merged earlier
+        state = self.codebook.encode('state', partial['state'])
+        district = self.codebook.encode('district', partial['district'])
+        self._add(state, district, np.asarray(partial['day']), sign * np.asarray(partial['total_updates']),
+                  sign * np.asarray(partial['rows']))
+
+    def result(self):
+        p = self.partial()
+        df = pd.DataFrame({
+            'state': p['state'],
+            'district': p['district'],
+            'date': days_to_dates(p['day']),
+            'total_updates': p['total_updates'],
+        })
+        if df.empty:
+            return df
+        return df.sort_values(['state', 'district', 'date'], ignore_index=True)
+
+
+class PincodeWeekly:
+    # (state, district, pincode, week) -> total updates, the leaves of the
+    # hierarchical forecasts. Leaves are coded once through a packed
+    # (state, district, pincode) codec and summed per week, so memory follows
+    # leaves x weeks. Rows without a pincode stay under pincode -1, as in the
+    # columnar cache, so leaves still add up to their district.
+    columns = ('state', 'district', 'pincode', 'date')
+    # partial key and result column of the time bucket
+    period, time_col = 'week', 'week'
+    bucket = staticmethod(day_weeks)
+    dates = staticmethod(week_dates)
+
+    def __init__(self, codebook, memory_cap=None):
+        self.codebook = codebook
+        self.leaves = KeyCodec(dtype=np.int64)
+        self.sums = SpillingReducer(2, memory_cap or MEMORY_CAP)
+
+    def _add(self, state, district, pincode, periods, totals, rows):
+        leaf = self.leaves.encode(pack_keys(LEAF_DIMS, [state, district, pincode]))
+        key = pack_keys(PINCODE_DIMS, [leaf, periods.astype(np.int64) + DAY_BIAS])
+        self.sums.add(key, np.column_stack([totals, rows]))
+
+    def consume(self, batch):
+        if not (batch.has('district') and batch.has('pincode')):
+            return
+        state, district, days = batch.codes('state'), batch.codes('district'), batch.days
+        pincode = batch.codes('pincode')
+        if (pincode < 0).any():
+            pincode = np.where(pincode < 0, self.codebook.encode('pincode', np.array([-1]))[0], pincode)
+        ok = (state >= 0) & (district >= 0) & (days != NO_DAY)
+        self._add(state[ok], district[ok], pincode[ok], self.bucket(days[ok]), batch.values[ok].sum(axis=1),
+                  np.ones(int(ok.sum()), dtype=np.int64))
+
+    def partial(self):
+        keys, values = self.sums.reduced()
+        keep = values[:, 1] > 0
+        leaf, period = unpack_keys(PINCODE_DIMS, keys[keep])
+        state, district, pincode = unpack_keys(LEAF_DIMS, self.leaves.decode(leaf).astype(np.int64))
+        return {
+            'state': self.codebook['state'].decode(state),
+            'district': self.codebook['district'].decode(district),
+            'pincode': self.codebook['pincode'].decode(pincode),
+            self.period: (period - DAY_BIAS).astype(np.int32),
+            'total_updates': values[keep, 0],
+            'rows': values[keep, 1],
+        }
+
+    def merge(self, partial, sign=1):
+        state = self.codebook.encode('state', partial['state'])
+        district = self.codebook.encode('district', partial['district'])
+        pincode = self.codebook.encode('pincode', partial['pincode'])
+        self._add(state, district, pincode, np.asarray(partial[self.period]),
+                  sign * np.asarray(partial['total_updates']), sign * np.asarray(partial['rows']))
+
+    def result(self):
+        # one row per (state, district, pincode, week ending date)
+        p = self.partial()
+        df = pd.DataFrame({
+            'state': p['state'],
+            'district': p['district'],
+            'pincode': p['pincode'],
+            self.time_col: self.dates(p[self.period]),
+            'total_updates': p['total_updates'],
+        })
+        if df.empty:
+            return df
+        return df.sort_values(['state', 'district', 'pincode', self.time_col], ignore_index=True)
+
+
+class PincodeDaily(PincodeWeekly):
+    # (state, district, pincode, date) -> total updates, the daily series of
+    # the demand-spike detector (spikes.py)
+    period, time_col = 'day', 'date'
+    bucket = staticmethod(np.asarray)
+    dates = staticmethod(days_to_dates)
+
+
+class DateQuality:
+    # rows whose date did not decode, by raw value; these rows are left out of
+    # the daily series
+    columns = ('date',)
+
+    def __init__(self):
+        self.bad = Counter()
+
+    def consume(self, batch):
+        self.bad.update(batch.bad_dates())
+
+    def result(self):
+        df = pd.DataFrame(sorted(self.bad.items(), key=lambda kv: (-kv[1], kv[0])), columns=['value', 'rows'])
+        return df
+
+    def partial(self):
+        return dict(self.bad)
+
+    def merge(self, partial, sign=1):
+        for value, rows in partial.items():
+            self.bad[value] += sign * rows
+        self.bad = +self.bad
+
+
+def required_columns(aggregators):
+    # source columns the registered consumers read (age columns always)
+    return set().union(*(agg.columns for agg in aggregators.values()))
+
+
+def iter_csv_batches(source, prefix, codebook, profile=None, columns=None):
+    # source: a CSV path or an open binary buffer holding header + rows
+    instrument.count(bytes=os.path.getsize(source) if isinstance(source, str) else source.getbuffer().nbytes)
+    for chunk in (profile or ReaderProfile()).read(source, prefix, columns):
+        instrument.count(rows=len(chunk), chunks=1)
+        age_cols = age_columns(chunk.columns, prefix)
+        if not age_cols or 'state' not in chunk.columns:
+            continue
+        chunk[age_cols] = chunk[age_cols].fillna(0)
+        yield Batch(chunk, age_cols, codebook)
+
+
+def iter_cached_batches(entry, prefix, codebook, profile=None, start=0, stop=None):
+    # row slices [start, stop) of one cache entry; columns are mapped lazily,
+    # so consumers only touch the arrays they use
+    stop = len(entry) if stop is None else min(stop, len(entry))
+    age_cols = age_columns(entry.age_cols, prefix)
+    if not age_cols:
+        return
+    chunksize = (profile or ReaderProfile()).cached_chunksize(len(age_cols))
+    age_idx = [entry.age_cols.index(c) for c in age_cols]
+    remaps = {
+        'state_raw': np.append(codebook.encode('state_raw', entry.states), -1),
+        'district_raw': np.append(codebook.encode('district_raw', entry.districts), -1),
+    }
+    # bytes mapped per row, over every cached column
+    row_bytes = sum(a.itemsize * int(np.prod(a.shape[1:])) for a in entry.arrays.values())
+    for lo in range(start, stop, chunksize):
+        rows = min(lo + chunksize, stop) - lo
+        instrument.count(rows=rows, chunks=1, bytes=rows * row_bytes)
+        yield CachedBatch(entry, lo, min(lo + chunksize, stop), age_idx, age_cols, codebook, remaps)
+
+
+def iter_batches(folder, prefix, codebook, profile=None, cache=None, columns=None):
+    # every usable chunk of every CSV in the folder, from the columnar cache
+    # when one is given and straight from the CSV text otherwise
+    for fp in list_csv_files(folder):
+        if cache is not None:
+            yield from iter_cached_batches(cache.get(fp, date_format(prefix)), prefix, codebook, profile)
+        else:
+            yield from iter_csv_batches(fp, prefix, codebook, profile, columns)
+
+
+def make_aggregators(codebook, daily=False, daily_memory=None, pincode=False, hotspots=None, cube=False, joined=False,
+                     spikes=False):
+    # the consumers fed by one scan of a dataset folder
+    aggregators = {
+        'state': StateTotals(codebook),
+        'district': DistrictTotals(codebook),
+        # raw spellings behind the canonical names, for the unmatched report
+        'regions': RegionMatches(codebook),
+    }
+    if daily:
+        aggregators['daily'] = DailySeries(codebook, daily_memory)
+        # only date consumers decode dates, so only they report bad ones
+        aggregators['dates'] = DateQuality()
+    if pincode:
+        # weekly pincode leaves for the hierarchical forecasts
+        aggregators['pincode'] = PincodeWeekly(codebook, daily_memory)
+    if cube:
+        # (state, district, day) cells of the pre-aggregated cube
+        aggregators['cube'] = CubeCells(codebook)
+    if hotspots:
+        # top pincodes per state, district and week: sketched or exact
+        aggregators['hotspots'] = PincodeHotspots(codebook) if hotspots == 'sketch' else PincodeExact(codebook)
+    if joined:
+        # (state, district, pincode, day) cells, one side of the joined view
+        aggregators['joined'] = JoinCells(codebook, daily_memory)
+    if spikes:
+        # daily pincode series for the demand-spike detector
+        aggregators['pincode_daily'] = PincodeDaily(codebook, daily_memory)
+    return aggregators
+
+
+def scan_folder(folder, prefix, aggregators, codebook, profile=None, cache=None):
+    # single pass over the folder: every registered aggregator sees each chunk
+    # from the same read, so adding a consumer never adds another scan
+    columns = required_columns(aggregators)
+    for batch in iter_batches(folder, prefix, codebook, profile, cache, columns):
+        for agg in aggregators.values():
+            agg.consume(batch)
+    return finish(aggregators, prefix)
+
+
+def finish(aggregators, prefix):
+    # every aggregator's result, each timed as its own stage: the daily
+    # series merge and the cube cells can outweigh the scan itself
+    results = {}
+    for name, agg in aggregators.items():
+        with instrument.stage(f'{prefix}:{name}'):
+            results[name] = agg.result()
+    return results
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+
+DATE_COL = 'date'
+# day number used for dates that could not be parsed
+NO_DAY = np.iinfo(np.int32).min
+# weeks end on Sunday, as with resample('W'); day 3 (1970-01-04) is a Sunday
+WEEK_SHIFT = 3
+
+
+def clean_columns(cols):
+    return [c.strip().lower().replace(' ', '_') for c in cols]
+
+
+def age_columns(cols, prefix=None):
+    # 'demo_age_5_17', 'bio_age_17_', ...; prefix narrows to one dataset
+    if prefix is None:
+        return [c for c in cols if '_age' in c]
+    return [c for c in cols if c.startswith(f'{prefix}_age')]
+
+
+def days_to_dates(days):
+    return pd.to_datetime(np.asarray(days, dtype=np.int64).astype('datetime64[D]'))
+
+
+def day_weeks(days):
+    # day numbers -> week numbers (weeks ending on Sunday)
+    return (np.asarray(days, dtype=np.int64) + WEEK_SHIFT) // 7
+
+
+def week_dates(weeks):
+    # week numbers -> their Sunday
+    return days_to_dates(np.asarray(weeks, dtype=np.int64) * 7 - WEEK_SHIFT + 6)
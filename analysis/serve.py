@@ -0,0 +1,498 @@
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+import threading
+import http.client
+import multiprocessing
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+
+import numpy as np
+import pandas as pd
+
+from cube import CUBE_DIR, DAY_BIAS, GRAINS, Cube, build as build_cube
+from regions import normalize, place_key
+from forecast import read_forecasts, write_forecasts
+from reader import parse_size
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+OUT_DIR = os.path.join(BASE_DIR, 'analysis', 'outputs')
+# written by analytics.py once a run has finished; the service reloads when it changes
+RUN_STAMP = 'last_run.json'
+DATASETS = ('demo', 'bio')
+PORT = 8091
+CACHE_BYTES = 64 * 1024 * 1024
+POLL_SECONDS = 2.0
+# most recent queries replayed against a reloaded snapshot before it goes live
+WARM_QUERIES = 512
+
+
+def mark_run(out_dir=OUT_DIR, datasets=DATASETS):
+    # record a finished run; replaced atomically so readers never see half a file
+    path = os.path.join(out_dir, RUN_STAMP)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'finished': pd.Timestamp.now().isoformat(timespec='seconds'), 'datasets': list(datasets)}, f)
+    os.replace(path + '.tmp', path)
+
+
+def _stamp(out_dir):
+    path = os.path.join(out_dir, RUN_STAMP)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class LRUCache:
+    # query results (etag, body) by query key, bounded by total body bytes;
+    # the least recently used results are evicted first
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = self.evicted = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item
+
+    def put(self, key, item):
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[1])
+            self.items[key] = item
+            self.bytes += len(item[1])
+            while self.bytes > self.max_bytes and len(self.items) > 1:
+                _, (_, body) = self.items.popitem(last=False)
+                self.bytes -= len(body)
+                self.evicted += 1
+
+    def stats(self):
+        return {'entries': len(self.items), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses,
+                'evicted': self.evicted}
+
+
+class Snapshot:
+    # the aggregates of one finished run, copied into memory so the next run
+    # can rewrite the files while this one is still being queried. Each
+    # snapshot has its own result cache, so a reload never serves stale results
+    def __init__(self, cube_dir=CUBE_DIR, out_dir=OUT_DIR, cache_bytes=CACHE_BYTES):
+        self.stamp = _stamp(out_dir)
+        self.generation = 'startup'
+        if self.stamp is not None:
+            with open(os.path.join(out_dir, RUN_STAMP)) as f:
+                self.generation = json.load(f)['finished']
+        self.loaded = pd.Timestamp.now().isoformat(timespec='seconds')
+        self.cubes = {name: Cube.open(name, cube_dir).load() for name in DATASETS
+                      if os.path.exists(os.path.join(cube_dir, name, 'meta.json'))}
+        try:
+            fc = read_forecasts(os.path.join(out_dir, 'forecasts'))
+        except FileNotFoundError:
+            fc = pd.DataFrame(columns=['kind', 'state', 'district', 'week', 'historical', 'forecast', 'method'])
+        # week order and ISO weeks once here, so a query is a slice and an encode
+        fc = fc.sort_values('week', kind='stable').reset_index(drop=True)
+        fc['week'] = pd.to_datetime(fc['week']).dt.strftime('%Y-%m-%d')
+        self.forecasts = fc[['week', 'kind', 'state', 'district', 'historical', 'forecast', 'method']]
+        # (kind, normalized state, normalized district) -> row positions, in week order
+        self.forecast_rows = fc.groupby([fc['kind'], normalize(fc['state']), normalize(fc['district'])]).indices
+        self.cache = LRUCache(cache_bytes)
+
+
+def _list(value):
+    return value.split(',') if value else None
+
+
+def _where(params):
+    return {'states': _list(params.get('state')), 'districts': _list(params.get('district')),
+            'start': params.get('start'), 'end': params.get('end')}
+
+
+def _rows(df):
+    # frame -> '{"rows": [...]}' JSON; index levels become fields, NaN
+    # becomes null. pandas' encoder is much faster than json.dumps on records
+    df = df.reset_index()
+    for col in df.columns:
+        if pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = df[col].dt.strftime('%Y-%m-%d')
+    return '{"rows": ' + df.to_json(orient='records') + '}'
+
+
+def _grain(params, default):
+    grain = params.get('grain', default)
+    if grain not in GRAINS:
+        raise ValueError(f'unknown grain {grain!r} (expected one of {", ".join(GRAINS)})')
+    return grain
+
+
+def q_totals(snap, cube, params):
+    # /totals?dataset=demo&by=district&state=gujarat&start=2025-03-01&band=5_17&top=10
+    df = cube.totals(params.get('by', 'state'), bands=_list(params.get('band')), grain=_grain(params, 'day'),
+                     **_where(params))
+    if 'top' in params:
+        df = df.head(int(params['top']))
+    return _rows(df)
+
+
+def q_series(snap, cube, params):
+    # /series?dataset=demo&grain=week&by=state&state=bihar,gujarat
+    by = params.get('by')
+    df = cube.series(_grain(params, 'week'), None if by in (None, 'none') else by, bands=_list(params.get('band')),
+                     **_where(params))
+    columns = [list(c) if isinstance(c, tuple) else c for c in df.columns]
+    return json.dumps({'index': list(df.index.strftime('%Y-%m-%d')), 'columns': columns,
+                       'data': df.to_numpy().tolist()})
+
+
+def q_ages(snap, cube, params):
+    # /ages?dataset=bio&by=state: every age band's total and share per group
+    df = cube.totals(params.get('by', 'state'), grain=_grain(params, 'day'), **_where(params))
+    total = df['total_updates'].to_numpy()
+    for col, band in zip(cube.age_cols, cube.bands):
+        df[f'share_{band}'] = np.divide(df[col].to_numpy(), total, out=np.full(len(df), np.nan), where=total > 0)
+    if 'top' in params:
+        df = df.head(int(params['top']))
+    return _rows(df)
+
+
+def q_forecasts(snap, cube, params):
+    # /forecasts?state=gujarat[&district=surat]: one weekly series, history and forecast
+    if not params.get('state'):
+        raise ValueError('forecasts need a state')
+    district = params.get('district', '')
+    kind = 'district' if district else 'state'
+    key = (kind,) + place_key(params['state'], district)
+    rows = snap.forecast_rows.get(key)
+    if rows is None:
+        raise LookupError(f'no {kind} forecast for {params["state"]!r}' + (f' / {district!r}' if district else ''))
+    return '{"rows": ' + snap.forecasts.iloc[rows].drop(columns='kind').to_json(orient='records') + '}'
+
+
+QUERIES = {'/totals': q_totals, '/series': q_series, '/ages': q_ages, '/forecasts': q_forecasts}
+
+
+class Service:
+    # the current snapshot plus the reload watcher. Requests read
+    # self.snapshot once, so each is answered entirely from one run even
+    # when a reload swaps the snapshot halfway through
+    def __init__(self, cube_dir=CUBE_DIR, out_dir=OUT_DIR, cache_bytes=CACHE_BYTES):
+        self.cube_dir, self.out_dir, self.cache_bytes = cube_dir, out_dir, cache_bytes
+        self.snapshot = Snapshot(cube_dir, out_dir, cache_bytes)
+        self.reloads = 0
+
+    def reload_if_changed(self):
+        if _stamp(self.out_dir) == self.snapshot.stamp:
+            return False
+        try:
+            snap = Snapshot(self.cube_dir, self.out_dir, self.cache_bytes)
+        except (OSError, ValueError, KeyError) as e:
+            # a run still writing or a damaged output: keep serving the old one
+            print(f'reload failed, still serving {self.snapshot.generation}: {e}', file=sys.stderr)
+            return False
+        # answer the queries clients were last asking before going live, so
+        # the swap does not turn every hot query into a miss at once
+        for key in list(self.snapshot.cache.items)[-WARM_QUERIES:]:
+            self.answer(snap, key[0], dict(key[1:]))
+        self.snapshot = snap
+        self.reloads += 1
+        return True
+
+    def watch(self, interval=POLL_SECONDS):
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.reload_if_changed()
+        threading.Thread(target=loop, daemon=True).start()
+
+    def health(self, snap):
+        return {'generation': snap.generation, 'loaded': snap.loaded, 'reloads': self.reloads,
+                'datasets': {name: {'slots': len(c.states), 'days': c.meta['days'], 'age_cols': c.age_cols}
+                             for name, c in snap.cubes.items()},
+                'forecast_series': len(snap.forecast_rows), 'cache': snap.cache.stats()}
+
+    def query(self, path, params):
+        # -> (status, etag, cache state, JSON body)
+        snap = self.snapshot
+        if path == '/health':
+            return 200, None, 'none', json.dumps(self.health(snap)).encode()
+        if path not in QUERIES:
+            return 404, None, 'none', json.dumps({'error': f'unknown path {path!r}',
+                                                  'paths': ['/health'] + list(QUERIES)}).encode()
+        return self.answer(snap, path, params)
+
+    def answer(self, snap, path, params):
+        key = (path,) + tuple(sorted(params.items()))
+        hit = snap.cache.get(key)
+        if hit is not None:
+            return 200, hit[0], 'hit', hit[1]
+        dataset = params.get('dataset', 'demo')
+        try:
+            cube = snap.cubes.get(dataset)
+            if cube is None and path != '/forecasts':
+                raise LookupError(f'no cube for dataset {dataset!r}')
+            body = QUERIES[path](snap, cube, params).encode()
+        except LookupError as e:
+            return 404, None, 'miss', json.dumps({'error': e.args[0]}).encode()
+        except ValueError as e:
+            return 400, None, 'miss', json.dumps({'error': str(e)}).encode()
+        etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+        snap.cache.put(key, (etag, body))
+        return 200, etag, 'miss', body
+
+
+class Handler(BaseHTTPRequestHandler):
+    # keep-alive JSON over HTTP/1.1; a matching If-None-Match gets a bodyless 304.
+    # Headers and body are separate writes: without TCP_NODELAY every
+    # response would wait out the client's delayed ACK (~40 ms)
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        t0 = time.perf_counter()
+        url = urlsplit(self.path)
+        status, etag, cache, body = self.server.service.query(url.path, dict(parse_qsl(url.query)))
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+        self.send_response(status)
+        if etag is not None:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+        self.send_header('X-Cache', cache)
+        self.send_header('Server-Timing', f'app;dur={(time.perf_counter() - t0) * 1000:.3f}')
+        self.send_header('Content-Length', str(len(body)))
+        if body:
+            self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+def serve(host='127.0.0.1', port=PORT, cube_dir=CUBE_DIR, out_dir=OUT_DIR, cache_bytes=CACHE_BYTES,
+          poll=POLL_SECONDS, verbose=False, ready=None):
+    # port 0 binds a free port; `ready` (a queue) is sent the bound one
+    service = Service(cube_dir, out_dir, cache_bytes)
+    service.watch(poll)
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+    print(f'serving {", ".join(service.snapshot.cubes) or "no cubes"} '
+          f'({service.snapshot.generation}) on http://{host}:{server.server_port}', flush=True)
+    if ready is not None:
+        ready.put(server.server_port)
+    server.serve_forever()
+
+
+def get(url, path, params=None, etag=None):
+    # client: -> (status, etag, decoded JSON or None for 304)
+    req = Request(url.rstrip('/') + path + ('?' + urlencode(params) if params else ''))
+    if etag:
+        req.add_header('If-None-Match', etag)
+    try:
+        with urlopen(req) as resp:
+            return resp.status, resp.headers.get('ETag'), json.load(resp)
+    except HTTPError as e:
+        if e.code == 304:
+            return 304, etag, None
+        return e.code, None, json.load(e)
+
+
+def synthetic_outputs(root, states=36, districts=30, days=400, seed=91):
+    # generated cubes and forecast table under root/cube and root/outputs,
+    # for benchmarking the service without a pipeline run
+    rng = np.random.default_rng(seed)
+    cube_dir, out_dir = os.path.join(root, 'cube'), os.path.join(root, 'outputs')
+    os.makedirs(os.path.join(out_dir, 'forecasts'), exist_ok=True)
+    day0 = (pd.Timestamp('2024-01-01') - pd.Timestamp(0)).days
+    names = [f'State {i:02d}' for i in range(states)]
+    for prefix, bands in (('demo', ['demo_age_17_', 'demo_age_5_17']), ('bio', ['bio_age_17_', 'bio_age_5_17'])):
+        slot = np.arange(states * districts)
+        n = len(slot) * days // 3
+        cells = pd.DataFrame({'slot': rng.choice(slot, n), 'day': rng.integers(0, days, n)}).drop_duplicates()
+        df = pd.DataFrame({'state': np.array(names, dtype=object)[cells['slot'].to_numpy() // districts],
+                           'district': [f'District {i % districts:02d}' for i in cells['slot']],
+                           'day': cells['day'].to_numpy() + day0 + DAY_BIAS})
+        for band in bands:
+            df[band] = rng.poisson(20, len(df))
+        df['rows'] = rng.integers(1, 5, len(df))
+        build_cube(df, prefix, cube_dir)
+    weeks = pd.date_range(pd.Timestamp('2024-01-01') + pd.Timedelta(days=days), periods=24, freq='W')
+    series = [('state', s, '') for s in names] + [('district', s, f'District {d:02d}') for s in names
+                                                   for d in range(districts)]
+    fc = pd.DataFrame([(kind, s, d, w) for kind, s, d in series for w in weeks],
+                      columns=['kind', 'state', 'district', 'week'])
+    value = rng.gamma(2, 50, len(fc)).round(1)
+    past = np.tile(np.arange(len(weeks)) < 12, len(series))
+    fc['historical'] = np.where(past, value, np.nan)
+    fc['forecast'] = np.where(past, np.nan, value)
+    fc['method'] = 'holt_winters'
+    write_forecasts(fc, os.path.join(out_dir, 'forecasts'))
+    mark_run(out_dir)
+    return cube_dir, out_dir
+
+
+def bench_paths(url, queries):
+    # the query mix: totals, top districts, weekly series, age shares and
+    # forecasts over every state, so most requests repeat (as planners' do)
+    _, _, health = get(url, '/health')
+    mix = []
+    for dataset in health['datasets']:
+        _, _, states = get(url, '/totals', {'dataset': dataset})
+        names = [r['key'] for r in states['rows']]
+        for state in names:
+            mix += [('/totals', {'dataset': dataset, 'by': 'district', 'state': state, 'top': 10}),
+                    ('/series', {'dataset': dataset, 'grain': 'week', 'by': 'state', 'state': state}),
+                    ('/series', {'dataset': dataset, 'grain': 'month', 'state': state}),
+                    ('/ages', {'dataset': dataset, 'by': 'district', 'state': state})]
+        mix += [('/totals', {'dataset': dataset}), ('/ages', {'dataset': dataset})]
+    if health['forecast_series']:
+        mix += [('/forecasts', {'state': name}) for name in names]
+    return [p + ('?' + urlencode(q) if q else '') for p, q in (random.choice(mix) for _ in range(queries))]
+
+
+def bench(url, requests=5000, concurrency=8, rate=500.0, conditional=False, reload_out=None):
+    # open-loop load: `concurrency` keep-alive clients sending `rate`
+    # requests a second between them. A request sent late because the
+    # previous answer was slow counts from its scheduled time, so a backed-up
+    # server shows up in the tail; the client's own sleep overshoot does not
+    paths = bench_paths(url, requests)
+    host = urlsplit(url).netloc
+    # one pass over the distinct queries first: the run measures the steady
+    # state, the first answers are reported separately
+    warm = http.client.HTTPConnection(host)
+    t0 = time.perf_counter()
+    for path in dict.fromkeys(paths):
+        warm.request('GET', path)
+        warm.getresponse().read()
+    warmup = time.perf_counter() - t0
+    warm.close()
+    latency = np.zeros(len(paths))
+    service = np.zeros(len(paths))
+    statuses = np.zeros(len(paths), dtype=np.int64)
+    start = time.perf_counter() + 0.1
+    interval = concurrency / rate
+
+    def client(worker):
+        conn = http.client.HTTPConnection(host)
+        etags = {}
+        done = 0.0
+        for i in range(worker, len(paths), concurrency):
+            due = start + (i // concurrency) * interval
+            time.sleep(max(0.0, due - time.perf_counter()))
+            sent = due if done > due else time.perf_counter()
+            headers = {'If-None-Match': etags[paths[i]]} if conditional and paths[i] in etags else {}
+            conn.request('GET', paths[i], headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+            done = time.perf_counter()
+            latency[i] = done - sent
+            service[i] = float(resp.getheader('Server-Timing').split('dur=')[1]) / 1000
+            statuses[i] = resp.status
+            if resp.getheader('ETag'):
+                etags[paths[i]] = resp.getheader('ETag')
+            if reload_out and i == len(paths) // 2:
+                mark_run(reload_out)
+        conn.close()
+
+    threads = [threading.Thread(target=client, args=(w,)) for w in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    _, _, health = get(url, '/health')
+    ms = latency * 1000
+    return {'requests': len(paths), 'distinct': len(set(paths)), 'warmup_s': warmup, 'rps': len(paths) / elapsed,
+            'p50_ms': float(np.percentile(ms, 50)), 'p99_ms': float(np.percentile(ms, 99)), 'max_ms': float(ms.max()),
+            # time spent inside the service, without network and scheduling
+            'service_p99_ms': float(np.percentile(service * 1000, 99)),
+            'status': {int(s): int(n) for s, n in zip(*np.unique(statuses, return_counts=True))},
+            'reloads': health['reloads'], 'cache': health['cache']}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local JSON query service over the analytics aggregates.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('serve', help='serve the cubes and forecasts of the last run')
+    p.add_argument('--host', default='127.0.0.1')
+    p.add_argument('--port', type=int, default=PORT)
+    p.add_argument('--cache-size', type=parse_size, default=CACHE_BYTES, help='result cache budget, e.g. 64M')
+    p.add_argument('--poll', type=float, default=POLL_SECONDS, help='seconds between checks for a finished run')
+    p.add_argument('--verbose', action='store_true', help='log every request')
+    p = sub.add_parser('get', help='query a running service, e.g. get /totals by=district state=gujarat')
+    p.add_argument('path')
+    p.add_argument('params', nargs='*', help='key=value query parameters')
+    p.add_argument('--url', default=f'http://127.0.0.1:{PORT}')
+    p.add_argument('--json', action='store_true', help='print the raw JSON')
+    p = sub.add_parser('bench', help='latency under load, against generated data unless --url is given')
+    p.add_argument('--url', default=None)
+    p.add_argument('--requests', type=int, default=5000)
+    p.add_argument('--concurrency', type=int, default=4)
+    p.add_argument('--rate', type=float, default=300.0, help='requests per second')
+    p.add_argument('--conditional', action='store_true', help='revalidate with If-None-Match')
+    p.add_argument('--reload', action='store_true', help='finish a (generated) run halfway through')
+    p.add_argument('--target-ms', type=float, default=10.0, help='exit non-zero when p99 is over this')
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        serve(args.host, args.port, cache_bytes=args.cache_size, poll=args.poll, verbose=args.verbose)
+    elif args.command == 'get':
+        status, _, data = get(args.url, args.path, dict(kv.split('=', 1) for kv in args.params))
+        if args.json or status != 200:
+            print(json.dumps(data, indent=1))
+        elif 'rows' in data:
+            print(pd.DataFrame(data['rows']).to_markdown(index=False))
+        else:
+            columns = ['/'.join(c) if isinstance(c, list) else c for c in data['columns']]
+            print(pd.DataFrame(data['data'], index=data['index'], columns=columns).to_markdown())
+        if status != 200:
+            sys.exit(1)
+    elif args.url:
+        result = bench(args.url, args.requests, args.concurrency, args.rate, args.conditional)
+    else:
+        # generated cubes, served by a separate process so the load
+        # generator does not share its interpreter
+        with tempfile.TemporaryDirectory() as root:
+            cube_dir, out_dir = synthetic_outputs(root)
+            # on a free port, clear of a running service and of fetch.py's stand-in
+            ready = multiprocessing.Queue()
+            server = multiprocessing.Process(target=serve, args=('127.0.0.1', 0, cube_dir, out_dir),
+                                             kwargs={'poll': 0.2, 'ready': ready}, daemon=True)
+            server.start()
+            url = f'http://127.0.0.1:{ready.get(timeout=60)}'
+            for _ in range(100):
+                try:
+                    get(url, '/health')
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            result = bench(url, args.requests, args.concurrency, args.rate, args.conditional,
+                           reload_out=out_dir if args.reload else None)
+            server.terminate()
+    if args.command == 'bench':
+        print(json.dumps(result, indent=1))
+        if result['p99_ms'] > args.target_ms:
+            sys.exit(f'p99 {result["p99_ms"]:.1f} ms is over the {args.target_ms:g} ms target')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,411 @@
+import os
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from accumulators import KeyCodec, KeyedSum, pack_keys, unpack_keys
+from schema import NO_DAY, day_weeks, week_dates
+
+LEVELS = ('state', 'district', 'week')
+MODES = ('sketch', 'exact')
+TOP_K = 10
+# Space-Saving counters per group: a pincode that is not tracked has at most
+# the smallest tracked count, which is at most group total / CAPACITY
+CAPACITY = 64
+# Count-Min rows and per-level widths: an estimate exceeds the true count by
+# at most e / width of the group total, with probability 1 - e^-DEPTH
+DEPTH = 4
+WIDTHS = {'state': 1024, 'district': 256, 'week': 8192}
+HOTSPOT_COLUMNS = ['level', 'state', 'district', 'week', 'rank', 'pincode', 'estimate', 'lower', 'upper']
+# (a * x + b) mod p hashing; fixed, so every process hashes pincodes alike
+PRIME = (1 << 31) - 1
+HASH_A, HASH_B = np.random.default_rng(91).integers(1, PRIME, size=(2, DEPTH), dtype=np.int64)
+# items are packed under their group as group << ITEM_BITS | (pincode + 1)
+ITEM_BITS = 32
+
+
+def level_keys(batch):
+    # (level, group key per row, row mask) for every level; district groups
+    # pack the normalized state with the district, week groups are week numbers
+    state, district, days = batch.codes('state_norm'), batch.codes('district'), batch.days
+    out = [('state', state, state >= 0)]
+    ok = (state >= 0) & (district >= 0)
+    out.append(('district', np.where(ok, pack_keys(('state_norm', 'district'), [np.maximum(state, 0),
+                                                                               np.maximum(district, 0)]), -1), ok))
+    ok = days != NO_DAY
+    out.append(('week', np.where(ok, day_weeks(np.where(ok, days, 0)), -1), ok))
+    return out
+
+
+def decode_groups(level, keys, codebook):
+    # group keys -> (state, district, week) display columns
+    keys = np.asarray(keys, dtype=np.int64)
+    blank = np.full(len(keys), '', dtype=object)
+    if level == 'state':
+        return codebook['state_norm'].decode(keys), blank, blank
+    if level == 'district':
+        state, district = unpack_keys(('state_norm', 'district'), keys)
+        return codebook['state_norm'].decode(state), codebook['district'].decode(district), blank
+    return blank, blank, week_dates(keys).strftime('%Y-%m-%d').to_numpy(dtype=object)
+
+
+def encode_groups(level, groups, codebook):
+    # inverse of the decoded partial form used for merging across codebooks
+    if level == 'state':
+        return codebook.encode('state_norm', groups[0])
+    if level == 'district':
+        return pack_keys(('state_norm', 'district'), [codebook.encode('state_norm', groups[0]),
+                                                      codebook.encode('district', groups[1])])
+    return np.asarray(groups[0], dtype=np.int64)
+
+
+def reduce_items(rows, items, weights):
+    # sum the weights of repeated (row, item) pairs
+    keys = (rows.astype(np.int64) << ITEM_BITS) | (items.astype(np.int64) + 1)
+    uniq, inv = np.unique(keys, return_inverse=True)
+    sums = np.zeros(len(uniq), dtype=np.int64)
+    np.add.at(sums, inv, weights)
+    return uniq >> ITEM_BITS, (uniq & ((1 << ITEM_BITS) - 1)) - 1, sums
+
+
+def group_ranks(group):
+    # position of each row within its run of equal (sorted) group values
+    if len(group) == 0:
+        return np.zeros(0, dtype=np.int64)
+    start = np.flatnonzero(np.r_[True, group[1:] != group[:-1]])
+    return np.arange(len(group)) - np.repeat(start, np.diff(np.r_[start, len(group)]))
+
+
+class CountMin:
+    # (groups x DEPTH x width) counters; linear, so partials merge (and
+    # retract) exactly, and an estimate never falls below the true count
+    def __init__(self, width, depth=DEPTH):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((0, depth, width), dtype=np.int64)
+
+    def _grow(self, n):
+        if n > len(self.table):
+            grown = np.zeros((max(n, 2 * len(self.table)), self.depth, self.width), dtype=np.int64)
+            grown[:len(self.table)] = self.table
+            self.table = grown
+
+    def _cols(self, items):
+        items = np.asarray(items, dtype=np.int64)
+        return (HASH_A[:self.depth, None] * items[None, :] + HASH_B[:self.depth, None]) % PRIME % self.width
+
+    def add(self, rows, items, weights):
+        if len(rows) == 0:
+            return
+        self._grow(int(rows.max()) + 1)
+        depth = np.arange(self.depth)[:, None]
+        np.add.at(self.table, (np.broadcast_to(rows, (self.depth, len(rows))), depth, self._cols(items)),
+                  np.broadcast_to(weights, (self.depth, len(rows))))
+
+    def estimate(self, rows, items):
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.int64)
+        self._grow(int(rows.max()) + 1)
+        return self.table[rows[None, :], np.arange(self.depth)[:, None], self._cols(items)].min(axis=0)
+
+    def merge(self, rows, table, sign=1):
+        # rows: this sketch's row for each row of the other table
+        if len(rows) == 0:
+            return
+        self._grow(int(rows.max()) + 1)
+        np.add.at(self.table, rows, sign * table)
+
+
+class SpaceSaving:
+    # per-group Space-Saving summaries as flat arrays sorted by group, then
+    # count (descending). count is an upper bound on an item's total and
+    # count - err a lower bound; once a group is full, items it does not
+    # track have at most its smallest count
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+        self.group = np.zeros(0, dtype=np.int64)
+        self.item = np.zeros(0, dtype=np.int64)
+        self.count = np.zeros(0, dtype=np.int64)
+        self.err = np.zeros(0, dtype=np.int64)
+
+    def floors(self, group, count, n):
+        # per group: the smallest count when the summary is full, else 0
+        size = np.bincount(group, minlength=n)
+        low = np.full(n, np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(low, group, count)
+        return np.where(size >= self.capacity, low, 0)
+
+    def merge(self, group, item, count, err=None, complete=False, bound=None):
+        # fold in another summary (or, with complete=True, exact counts that
+        # cover every item, e.g. a batch); an item missing from one side is
+        # charged that side's floor, then each group keeps its top counters.
+        # bound(group, item) is another upper bound on the totals (the
+        # Count-Min estimate), used to take back overcharged floors before
+        # counters are evicted
+        err = np.zeros(len(group), dtype=np.int64) if err is None else err
+        n = int(max(self.group.max(initial=-1), np.max(group, initial=-1))) + 1
+        floor_a = self.floors(self.group, self.count, n)
+        floor_b = np.zeros(n, dtype=np.int64) if complete else self.floors(group, count, n)
+        na = len(self.group)
+        keys = np.concatenate([(self.group << ITEM_BITS) | (self.item + 1),
+                               (np.asarray(group, dtype=np.int64) << ITEM_BITS) | (np.asarray(item) + 1)])
+        uniq, inv = np.unique(keys, return_inverse=True)
+        total = np.zeros(len(uniq), dtype=np.int64)
+        total_err = np.zeros(len(uniq), dtype=np.int64)
+        np.add.at(total, inv, np.concatenate([self.count, count]))
+        np.add.at(total_err, inv, np.concatenate([self.err, err]))
+        in_a = np.zeros(len(uniq), dtype=bool)
+        in_a[inv[:na]] = True
+        in_b = np.zeros(len(uniq), dtype=bool)
+        in_b[inv[na:]] = True
+        g = uniq >> ITEM_BITS
+        charge = np.where(in_a, 0, floor_a[g]) + np.where(in_b, 0, floor_b[g])
+        item = (uniq & ((1 << ITEM_BITS) - 1)) - 1
+        count, err = total + charge, total_err + charge
+        if bound is not None:
+            tight = np.minimum(count, bound(g, item))
+            err = np.maximum(err - (count - tight), 0)
+            count = tight
+        self._keep(g, item, count, err)
+
+    def retract(self, group, item, count):
+        # subtract an earlier contribution from the counters that track it;
+        # contributions already folded into a floor cannot be taken back
+        keys = (self.group << ITEM_BITS) | (self.item + 1)
+        drop = (np.asarray(group, dtype=np.int64) << ITEM_BITS) | (np.asarray(item) + 1)
+        order = np.argsort(keys)
+        pos = np.searchsorted(keys, drop, sorter=order)
+        pos = np.minimum(pos, max(len(keys) - 1, 0))
+        hit = (len(keys) > 0) & (keys[order[pos]] == drop) if len(keys) else np.zeros(len(drop), dtype=bool)
+        np.add.at(self.count, order[pos[hit]], -np.asarray(count)[hit])
+        np.maximum(self.count, 0, out=self.count)
+        np.minimum(self.err, self.count, out=self.err)
+        keep = self.count > 0
+        self._keep(self.group[keep], self.item[keep], self.count[keep], self.err[keep])
+
+    def _keep(self, group, item, count, err):
+        order = np.lexsort((item, -count, group))
+        group, item, count, err = group[order], item[order], count[order], err[order]
+        keep = group_ranks(group) < self.capacity
+        self.group, self.item, self.count, self.err = group[keep], item[keep], count[keep], err[keep]
+
+
+class HeavyHitters:
+    # the sketches of one level: a codec of its group keys, per-group totals,
+    # a Count-Min table and Space-Saving summaries
+    def __init__(self, width, capacity=CAPACITY):
+        self.groups = KeyCodec(dtype=np.int64)
+        self.totals = np.zeros(0, dtype=np.int64)
+        self.cms = CountMin(width)
+        self.ss = SpaceSaving(capacity)
+
+    def _rows(self, keys):
+        rows = self.groups.encode(keys)
+        if len(self.groups) > len(self.totals):
+            totals = np.zeros(max(len(self.groups), 2 * len(self.totals)), dtype=np.int64)
+            totals[:len(self.totals)] = self.totals
+            self.totals = totals
+        return rows
+
+    def add(self, keys, items, weights):
+        rows, items, weights = reduce_items(self._rows(keys), items, weights)
+        np.add.at(self.totals, rows, weights)
+        self.cms.add(rows, items, weights)
+        self.ss.merge(rows, items, weights, complete=True, bound=self.cms.estimate)
+
+    def top(self, k=TOP_K):
+        # per group: (group key, rank, pincode, estimate, lower, upper),
+        # ranked by the tighter of the two upper bounds
+        ss = self.ss
+        upper = np.minimum(ss.count, self.cms.estimate(ss.group, ss.item))
+        lower = np.maximum(ss.count - ss.err, 0)
+        order = np.lexsort((ss.item, -upper, ss.group))
+        group, item, upper, lower = ss.group[order], ss.item[order], upper[order], lower[order]
+        keep = group_ranks(group) < k
+        keys = np.asarray(self.groups.values, dtype=np.int64)[group[keep]]
+        return keys, group_ranks(group[keep]) + 1, item[keep], upper[keep], lower[keep], upper[keep]
+
+    def partial(self):
+        n = len(self.groups)
+        return {'keys': np.asarray(self.groups.values, dtype=np.int64), 'totals': self.totals[:n],
+                'cms': self.cms.table[:n], 'group': self.ss.group, 'item': self.ss.item,
+                'count': self.ss.count, 'err': self.ss.err}
+
+    def merge(self, keys, partial, sign=1):
+        # keys: the partial's group keys in this codebook's coding
+        rows = self._rows(keys)
+        np.add.at(self.totals, rows, sign * partial['totals'])
+        self.cms.merge(rows, partial['cms'], sign)
+        group = rows[partial['group']] if len(partial['group']) else partial['group']
+        if sign > 0:
+            self.ss.merge(group, partial['item'], partial['count'], partial['err'], bound=self.cms.estimate)
+        else:
+            self.ss.retract(group, partial['item'], partial['count'])
+
+
+class PincodeHotspots:
+    # the pincodes behind the update load, per state, district and week, in
+    # bounded memory: Space-Saving tracks the candidates and Count-Min caps
+    # their counts. Every reported pincode carries bounds with
+    # lower <= true total <= upper (estimate == upper).
+    columns = ('state', 'district', 'pincode', 'date')
+
+    def __init__(self, codebook, capacity=CAPACITY):
+        self.codebook = codebook
+        self.levels = {level: HeavyHitters(WIDTHS[level], capacity) for level in LEVELS}
+        # pincode code -> pincode value, grown with the codec
+        self._pins = np.zeros(0, dtype=np.int64)
+
+    def pincodes(self, batch):
+        codes = batch.codes('pincode')
+        codec = self.codebook['pincode']
+        if len(self._pins) < len(codec):
+            new = pd.to_numeric(pd.Series(codec.values[len(self._pins):]), errors='coerce')
+            self._pins = np.concatenate([self._pins, new.fillna(-1).to_numpy(dtype=np.int64)])
+        return np.append(self._pins, -1)[codes]
+
+    def consume(self, batch):
+        if not (batch.has('district') and batch.has('pincode')):
+            return
+        pins = self.pincodes(batch)
+        totals = batch.values.sum(axis=1)
+        for level, keys, ok in level_keys(batch):
+            self.levels[level].add(keys[ok], pins[ok], totals[ok])
+
+    def result(self, k=TOP_K):
+        frames = []
+        for level, hh in self.levels.items():
+            keys, rank, item, estimate, lower, upper = hh.top(k)
+            state, district, week = decode_groups(level, keys, self.codebook)
+            frames.append(pd.DataFrame({'level': level, 'state': state, 'district': district, 'week': week,
+                                        'rank': rank, 'pincode': item, 'estimate': estimate, 'lower': lower,
+                                        'upper': upper}))
+        return hotspot_frame(frames)
+
+    def partial(self):
+        out = {}
+        for level, hh in self.levels.items():
+            p = hh.partial()
+            state, district, week = decode_groups(level, p['keys'], self.codebook)
+            p['groups'] = (p['keys'],) if level == 'week' else (state, district)
+            del p['keys']
+            out[level] = p
+        return out
+
+    def merge(self, partial, sign=1):
+        # sign=-1 retracts exactly from the Count-Min tables and totals, and
+        # from the Space-Saving counters that still track the pincodes
+        for level, p in partial.items():
+            self.levels[level].merge(encode_groups(level, p['groups'], self.codebook), p, sign)
+
+
+class PincodeExact:
+    # exact per-group pincode totals in compact arrays: pincodes are indexed
+    # by their codebook code, so memory follows distinct (group, pincode)
+    # pairs. Same result shape as PincodeHotspots, with exact bounds; used to
+    # validate the sketches.
+    columns = ('state', 'district', 'pincode', 'date')
+    dims = {'state': ['state_norm', 'pincode'], 'district': ['state_norm', 'district', 'pincode'],
+            'week': ['week', 'pincode']}
+
+    def __init__(self, codebook):
+        self.codebook = codebook
+        self.sums = {level: KeyedSum(dims, codebook) for level, dims in self.dims.items()}
+
+    def consume(self, batch):
+        if not (batch.has('district') and batch.has('pincode')):
+            return
+        pins = batch.codes('pincode')
+        if (pins < 0).any():
+            # rows without a pincode count under -1, as in the sketches
+            pins = np.where(pins < 0, self.codebook.encode('pincode', np.array([-1]))[0], pins)
+        totals = batch.values.sum(axis=1)[:, None]
+        codes = {'state': [batch.codes('state_norm')], 'district': [batch.codes('state_norm'), batch.codes('district')]}
+        for level, keys, ok in level_keys(batch):
+            group = codes.get(level, [keys])
+            self.sums[level].add([np.where(ok, c, -1) for c in group] + [pins], totals, ['total_updates'])
+
+    def result(self, k=TOP_K):
+        frames = []
+        for level, sums in self.sums.items():
+            df = sums.to_frame()
+            if df.empty:
+                continue
+            df = df.reset_index()
+            group = list(df.columns[:-2])
+            df = df.sort_values(group + ['total_updates', 'pincode'], ascending=[True] * len(group) + [False, True],
+                                kind='stable')
+            df['rank'] = df.groupby(group, sort=False).cumcount() + 1
+            df = df[df['rank'] <= k]
+            week = week_dates(df['week']).strftime('%Y-%m-%d') if level == 'week' else ''
+            frames.append(pd.DataFrame({
+                'level': level,
+                'state': df['state_norm'] if 'state_norm' in df else '',
+                'district': df['district'] if 'district' in df else '',
+                'week': week,
+                'rank': df['rank'],
+                'pincode': pd.to_numeric(df['pincode'], errors='coerce').fillna(-1).astype(np.int64),
+                'estimate': df['total_updates'], 'lower': df['total_updates'], 'upper': df['total_updates'],
+            }))
+        return hotspot_frame(frames)
+
+    def partial(self):
+        return {level: sums.partial() for level, sums in self.sums.items()}
+
+    def merge(self, partial, sign=1):
+        for level, p in partial.items():
+            self.sums[level].merge(p, sign)
+
+
+def hotspot_frame(frames):
+    frames = [f for f in frames if not f.empty]
+    if not frames:
+        return pd.DataFrame(columns=HOTSPOT_COLUMNS)
+    df = pd.concat(frames, ignore_index=True)[HOTSPOT_COLUMNS]
+    df['level'] = pd.Categorical(df['level'], categories=LEVELS, ordered=True)
+    df = df.sort_values(['level', 'state', 'district', 'week', 'rank'], kind='stable', ignore_index=True)
+    df['level'] = df['level'].astype(str)
+    return df
+
+
+def validate(sketch, exact):
+    # sketch vs exact hot spots per level: recall of the exact top-K, how
+    # often the exact total lies inside [lower, upper], and the largest
+    # relative error of the estimates
+    keys = ['level', 'state', 'district', 'week', 'pincode']
+    both = exact.merge(sketch, on=keys, how='left', suffixes=('_exact', ''))
+    found = both['estimate'].notna()
+    inside = found & (both['lower'] <= both['estimate_exact']) & (both['estimate_exact'] <= both['upper'])
+    rel = (both['estimate'] - both['estimate_exact']).abs() / both['estimate_exact'].where(both['estimate_exact'] > 0)
+    both = both.assign(found=found, inside=inside, rel=rel)
+    return both.groupby('level', sort=False).agg(pairs=('found', 'size'), recall=('found', 'mean'),
+                                                  within_bounds=('inside', 'mean'), max_rel_error=('rel', 'max'))
+
+
+if __name__ == '__main__':
+    # sketch and exact hot spots from one scan, and how well they agree
+    from cache import ColumnarCache
+    from reader import ReaderProfile
+    from scan import new_codebook, scan_folder
+
+    BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    parser = argparse.ArgumentParser(description='Validate the pincode heavy-hitter sketches against exact counts.')
+    parser.add_argument('--folder', default=os.path.join(BASE_DIR, 'api_data_aadhar_demographic'))
+    parser.add_argument('--prefix', default='demo')
+    parser.add_argument('--capacity', type=int, default=CAPACITY)
+    parser.add_argument('--chunksize', type=int, default=None, help='rows per batch (small values stress the merges)')
+    parser.add_argument('--no-cache', action='store_true')
+    args = parser.parse_args()
+    codebook = new_codebook(args.prefix)
+    aggregators = {'sketch': PincodeHotspots(codebook, args.capacity), 'exact': PincodeExact(codebook)}
+    t0 = time.perf_counter()
+    profile = ReaderProfile(chunksize=args.chunksize) if args.chunksize else None
+    res = scan_folder(args.folder, args.prefix, aggregators, codebook, profile,
+                      cache=None if args.no_cache else ColumnarCache())
+    print(f'scan {time.perf_counter() - t0:.2f}s')
+    for name, agg in aggregators.items():
+        print(f'{name}: {len(res[name])} hot spots')
+    report = validate(res['sketch'], res['exact'])
+    print(report.to_markdown(floatfmt='.3f'))
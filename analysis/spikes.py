@@ -0,0 +1,338 @@
+import os
+import sys
+import time
+import pickle
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from regions import default as regions_default
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SPIKE_DIR = os.path.join(BASE_DIR, 'analysis', '.cache', 'spikes')
+OUT_DIR = os.path.join(BASE_DIR, 'analysis', 'outputs')
+STATE_VERSION = 2
+LEVELS = ('state', 'district', 'pincode')
+KEYS = {'state': ['state'], 'district': ['state', 'district'], 'pincode': ['state', 'district', 'pincode']}
+# weight of the newest active day in the running mean and variance
+ALPHA = 0.1
+# weight of the newest active day in a series' factor for that weekday; the
+# first few of each weekday are averaged evenly
+SEASON_ALPHA = 0.1
+# active share taken for a series active every day, which says only that it
+# expects many rows a day
+MAX_SHARE = 1 - 1e-12
+# a day this many scales above its series' running mean raises an alert
+THRESHOLD = 5.0
+# days with updates a series must have had before it can alert
+WARMUP = 7
+# fewest updates in a day worth an alert
+MIN_UPDATES = 20
+ALERT_COLUMNS = ['date', 'level', 'rank', 'state', 'district', 'pincode', 'updates', 'baseline', 'scale', 'score',
+                 'ratio', 'active_share']
+
+
+def _active_mean(lam):
+    # rows on a day with any, for rows arriving at random lam a day:
+    # lam / (1 - exp(-lam)), which tends to 1 for small lam
+    return np.where(lam > 1e-9, lam / -np.expm1(-np.maximum(lam, 1e-9)), 1.0)
+
+
+def _dump(obj, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+class SeriesStats:
+    # running statistics of the daily updates of every series of one level,
+    # as flat arrays indexed by series code. Most pincode and many district
+    # series have updates on only a few days, so a series is followed as the
+    # share of days with updates and the exponentially weighted mean and
+    # variance of its updates on those days; a spike is a day far above the
+    # series' usual active day. Updates follow the week (offices are shut or
+    # short-staffed at weekends), so the mean and variance are of
+    # deseasonalised updates and a day is scored against the mean scaled to
+    # its weekday. The weekday factors are the level's: one profile, averaging
+    # 1 over the week, learnt from the level's daily total, since a sparse
+    # series sees too few of each weekday to learn its own (see _weekday).
+    # Folding in a day is a few vector operations over all series, however
+    # long the history.
+    def __init__(self, level):
+        self.level = level
+        self.keys = pd.MultiIndex.from_arrays([[]] * len(KEYS[level]), names=KEYS[level])
+        self.mean = np.zeros(0)
+        self.var = np.zeros(0)
+        self.rate = np.zeros(0)
+        # days followed since the series' first, and days with updates
+        self.seen = np.zeros(0, dtype=np.int32)
+        self.active = np.zeros(0, dtype=np.int32)
+        # weekday factors (Monday first), the days behind each, and the
+        # deseasonalised running total of the level they are relative to
+        self.season = np.ones(7)
+        self.season_days = np.zeros(7, dtype=np.int32)
+        self.total = 0.0
+
+    def __len__(self):
+        return len(self.mean)
+
+    def codes(self, keys):
+        # series codes of a MultiIndex of keys, adding the unseen series
+        codes = self.keys.get_indexer(keys)
+        new = codes < 0
+        if new.any():
+            added = keys[new].unique()
+            self.keys = self.keys.append(added)
+            for name in ('mean', 'var', 'rate', 'seen', 'active'):
+                old = getattr(self, name)
+                setattr(self, name, np.append(old, np.zeros(len(added), dtype=old.dtype)))
+            codes[new] = self.keys.get_indexer(keys[new])
+        return codes
+
+    def _fold_season(self, weekday, total, alpha, season_alpha):
+        # the level's total for the day moves its weekday factor (the first
+        # few of each weekday are averaged evenly) and the running total;
+        # returns what the factors were divided by to keep averaging 1
+        if self.total <= 0:
+            self.total = total
+            return 1.0
+        weight = max(season_alpha, 1.0 / (self.season_days[weekday] + 1))
+        self.season[weekday] += weight * (total / self.total - self.season[weekday])
+        self.season_days[weekday] += 1
+        norm = self.season.mean()
+        self.season /= norm
+        self.total *= norm
+        self.total += alpha * (total / self.season[weekday] - self.total)
+        return norm
+
+    def _weekday(self, weekday):
+        # per series, what the level's weekday factor does to an active day.
+        # Taking a series' rows as arriving at random, its active share gives
+        # the rows it expects a day, lam; a factor f scales that, and updates
+        # on a day with any rows scale with _active_mean(lam). A dense series
+        # scales by about f; for a sparse one the weekday changes how often it
+        # is active, not what an active day brings
+        lam = -np.log1p(-np.minimum(self.rate, MAX_SHARE))
+        return _active_mean(lam * self.season[weekday]) / _active_mean(lam)
+
+    def fold(self, codes, values, weekday, alpha=ALPHA, threshold=THRESHOLD, warmup=WARMUP,
+             min_updates=MIN_UPDATES, season_alpha=SEASON_ALPHA):
+        # one day: the codes and totals of the series with updates that day,
+        # and its weekday (0 is Monday); a series counts 0 on the days after
+        # its first without any. Each series is scored against its state
+        # before the day, then the day is folded in with its move capped at
+        # threshold scales, so one spike barely lifts the baseline for the
+        # next. Returns the alerting (codes, updates, baseline, scale, score,
+        # active share)
+        x = np.zeros(len(self))
+        x[codes] = values
+        on = np.zeros(len(self), dtype=bool)
+        on[codes] = values > 0
+        live = (self.seen > 0) | on
+        factor = self._weekday(weekday)
+        expected = self.mean * factor
+        # a Poisson floor keeps low-count series from alerting on a few updates
+        scale = np.sqrt(np.maximum(self.var * factor * factor, expected) + 1.0)
+        score = (x - expected) / scale
+        hit = np.flatnonzero(on & (self.active >= warmup) & (score >= threshold) & (x >= min_updates))
+        alerts = (hit, x[hit], expected[hit], scale[hit], score[hit], self.rate[hit])
+        step = np.clip(x, expected - threshold * scale, expected + threshold * scale) / factor - self.mean
+        first = self.active == 0
+        self.mean = np.where(on, np.where(first, x / factor, self.mean + alpha * step), self.mean)
+        self.var = np.where(on & ~first, (1 - alpha) * (self.var + alpha * step * step), self.var)
+        self.rate = np.where(live, np.where(self.seen == 0, 1.0, self.rate + alpha * (on - self.rate)), self.rate)
+        self.seen += live
+        self.active += on
+        # the series' levels absorb the profile's renormalisation
+        norm = self._fold_season(weekday, float(values.sum()), alpha, season_alpha)
+        self.mean *= norm
+        self.var *= norm * norm
+        return alerts
+
+
+def level_frames(daily):
+    # PincodeDaily result -> {level: daily totals keyed by the level's
+    # columns}; rows without a pincode count towards their district and state
+    out = {'pincode': daily.loc[daily['pincode'] != -1, KEYS['pincode'] + ['date', 'total_updates']]}
+    for level in ('district', 'state'):
+        out[level] = daily.groupby(KEYS[level] + ['date'], sort=False, observed=True)['total_updates'].sum() \
+                          .reset_index()
+    return out
+
+
+class Detector:
+    # per-level series stats plus the days folded in so far, persisted under
+    # root/prefix (nothing is kept without a root). update() folds in only
+    # the days after the last one folded; a folded day whose totals changed
+    # (late rows) or a new day before it refolds every day from the start
+    def __init__(self, prefix, root=SPIKE_DIR, alpha=ALPHA, threshold=THRESHOLD, warmup=WARMUP,
+                 min_updates=MIN_UPDATES, season_alpha=SEASON_ALPHA):
+        self.path = None if root is None else os.path.join(root, prefix, 'state.pkl')
+        self.config = {'version': STATE_VERSION, 'alpha': alpha, 'threshold': threshold, 'warmup': warmup,
+                       'min_updates': min_updates, 'season_alpha': season_alpha, 'regions': regions_default().version}
+        self.stats = {}
+        self._reset()
+        if self.path is not None and os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                state = pickle.load(f)
+            if state['config'] == self.config:
+                self.levels, self.day_totals, self.alerts = state['levels'], state['day_totals'], state['alerts']
+
+    def _reset(self):
+        self.levels = {level: SeriesStats(level) for level in LEVELS}
+        # total updates of every folded day, to spot days that changed
+        self.day_totals = pd.Series(dtype='int64')
+        self.alerts = pd.DataFrame(columns=ALERT_COLUMNS)
+
+    @property
+    def last_day(self):
+        return self.day_totals.index.max() if len(self.day_totals) else None
+
+    def update(self, daily):
+        # folds the days of a PincodeDaily result not folded yet; returns the
+        # alerts they raised
+        totals = daily.groupby('date')['total_updates'].sum().sort_index()
+        known = totals.reindex(self.day_totals.index)
+        rebuilt = bool(len(self.day_totals)) and (
+            not known.equals(self.day_totals.astype(known.dtype))
+            or bool(((totals.index < self.last_day) & ~totals.index.isin(self.day_totals.index)).any()))
+        if rebuilt:
+            self._reset()
+        last = self.last_day
+        new = daily if last is None else daily[daily['date'] > last]
+        days = totals.index if last is None else totals.index[totals.index > last]
+        t0 = time.perf_counter()
+        found = []
+        for level, frame in level_frames(new).items():
+            stats = self.levels[level]
+            frame = frame.sort_values('date', kind='stable')
+            codes = stats.codes(pd.MultiIndex.from_frame(frame[KEYS[level]]))
+            values = frame['total_updates'].to_numpy(dtype=float)
+            bounds = np.searchsorted(frame['date'].to_numpy(), days.to_numpy(), side='left')
+            bounds = np.append(bounds, len(frame))
+            for i, day in enumerate(days):
+                lo, hi = bounds[i], bounds[i + 1]
+                hit, *found_day = stats.fold(codes[lo:hi], values[lo:hi], day.dayofweek, self.config['alpha'],
+                                             self.config['threshold'], self.config['warmup'],
+                                             self.config['min_updates'], self.config['season_alpha'])
+                if len(hit):
+                    found.append(self._alerts(level, stats.keys[hit], day, *found_day))
+        self.day_totals = pd.concat([self.day_totals, totals[days]]) if len(self.day_totals) else totals[days]
+        alerts = ranked(pd.concat(found, ignore_index=True)) if found else pd.DataFrame(columns=ALERT_COLUMNS)
+        if len(alerts):
+            self.alerts = alerts if self.alerts.empty else pd.concat([self.alerts, alerts], ignore_index=True)
+        self.stats = {'days': len(days), 'series': {level: len(s) for level, s in self.levels.items()},
+                      'alerts': len(alerts), 'rebuilt': rebuilt, 'fold_s': round(time.perf_counter() - t0, 4)}
+        return alerts
+
+    def _alerts(self, level, keys, day, x, mean, scale, score, rate):
+        df = keys.to_frame(index=False)
+        if 'district' not in df:
+            df['district'] = ''
+        df['pincode'] = df['pincode'].astype('Int64') if 'pincode' in df else pd.array([pd.NA] * len(df), 'Int64')
+        df.insert(0, 'level', level)
+        df.insert(0, 'date', day)
+        df['updates'] = x.astype(np.int64)
+        df['baseline'] = mean.round(1)
+        df['scale'] = scale.round(2)
+        df['score'] = score.round(2)
+        df['ratio'] = (x / np.maximum(mean, 1.0)).round(2)
+        # share of recent days the series had any updates
+        df['active_share'] = rate.round(3)
+        return df
+
+    def save(self):
+        if self.path is not None:
+            _dump({'config': self.config, 'levels': self.levels, 'day_totals': self.day_totals,
+                   'alerts': self.alerts}, self.path)
+
+
+def ranked(alerts):
+    # newest day first, then state, district and pincode alerts, each by score
+    alerts = alerts.copy()
+    alerts['level'] = pd.Categorical(alerts['level'], categories=LEVELS, ordered=True)
+    alerts = alerts.sort_values(['date', 'level', 'score'], ascending=[False, True, False], kind='stable',
+                                ignore_index=True)
+    alerts['rank'] = alerts.groupby(['date', 'level'], observed=True).cumcount() + 1
+    alerts['level'] = alerts['level'].astype(str)
+    return alerts[ALERT_COLUMNS]
+
+
+def write_alerts(alerts, day, out_dir=OUT_DIR):
+    # every alert so far, and those of `day` (the last day folded) alone
+    paths = [os.path.join(out_dir, 'spike_alerts.csv'), os.path.join(out_dir, 'spike_alerts_latest.csv')]
+    alerts = ranked(alerts) if len(alerts) else alerts
+    alerts.to_csv(paths[0], index=False)
+    alerts[alerts['date'] == day].to_csv(paths[1], index=False)
+    return paths
+
+
+def _scan(folder, prefix):
+    from scan import new_codebook, make_aggregators, scan_folder
+    codebook = new_codebook(prefix)
+    aggregators = {'pincode_daily': make_aggregators(codebook, spikes=True)['pincode_daily']}
+    return scan_folder(folder, prefix, aggregators, codebook)['pincode_daily']
+
+
+def _check(folder, prefix, split):
+    # days folded in one pass vs the first `split` of them, a save and reload,
+    # then the rest; and a changed folded day, which must refold from scratch
+    import tempfile
+    daily = _scan(folder, prefix)
+    days = np.sort(daily['date'].unique())
+    cut = days[int(len(days) * split) - 1]
+    ok = True
+    with tempfile.TemporaryDirectory() as root:
+        whole = Detector(prefix, root=None)
+        whole.update(daily)
+        part = Detector(prefix, root=root)
+        part.update(daily[daily['date'] <= cut])
+        part.save()
+        part = Detector(prefix, root=root)
+        part.update(daily)
+        print(f'{len(days)} days, series ' + ', '.join(f'{k}={v:,}' for k, v in whole.stats['series'].items()) +
+              f'; one pass {whole.stats["fold_s"]:.3f}s, last {len(days) - len(days[days <= cut])} days after '
+              f'reload {part.stats["fold_s"]:.3f}s; {len(whole.alerts)} alerts')
+        for level in LEVELS:
+            a, b = whole.levels[level], part.levels[level]
+            if not (a.keys.equals(b.keys) and np.array_equal(a.mean, b.mean) and np.array_equal(a.var, b.var)
+                    and np.array_equal(a.seen, b.seen) and np.array_equal(a.season, b.season)):
+                print(f'MISMATCH: {level} state differs between one pass and incremental')
+                ok = False
+        if not ranked(whole.alerts).equals(ranked(part.alerts)):
+            print('MISMATCH: alerts differ between one pass and incremental')
+            ok = False
+        late = daily.copy()
+        late.loc[late['date'] == days[0], 'total_updates'] += 1
+        part.update(late)
+        if not part.stats['rebuilt']:
+            print('MISMATCH: a changed folded day did not refold')
+            ok = False
+    print('incremental == one pass' if ok else 'incremental != one pass')
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Demand-spike alerts over daily state, district and pincode series.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p = sub.add_parser('scan', help='alerts for a folder of CSVs, from scratch (nothing is stored)')
+    p.add_argument('folder')
+    p.add_argument('--prefix', default='demo', help="age-column prefix of the folder's CSVs")
+    p.add_argument('--top', type=int, default=20)
+    p = sub.add_parser('check', help='incremental folding vs one pass over a folder')
+    p.add_argument('folder')
+    p.add_argument('--prefix', default='demo')
+    p.add_argument('--split', type=float, default=0.8, help='share of days folded before the reload')
+    args = parser.parse_args()
+
+    if args.command == 'scan':
+        detector = Detector(args.prefix, root=None)
+        detector.update(_scan(args.folder, args.prefix))
+        print(detector.stats)
+        alerts = detector.alerts
+        print(alerts[alerts['date'] == detector.last_day].head(args.top).to_markdown(index=False))
+    else:
+        sys.exit(0 if _check(args.folder, args.prefix, args.split) else 1)
@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+import weakref
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SPILL_DIR = os.path.join(BASE_DIR, 'analysis', '.cache', 'spill')
+MEMORY_CAP = 256 * 1024 * 1024
+# pending rows are folded into the running aggregate once there are this many
+# (or as many as the aggregate already holds, whichever is larger)
+COMPACT_ROWS = 1_000_000
+# rows read from each spilled run per step of the final merge
+MERGE_BLOCK = 1_000_000
+
+
+def reduce_sorted(keys, values):
+    # sum the value rows of equal keys; keys must be sorted
+    if len(keys) == 0:
+        return keys, values
+    start = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    return keys[start], np.add.reduceat(values, start, axis=0)
+
+
+def reduce_keys(keys, values):
+    order = np.argsort(keys, kind='stable')
+    return reduce_sorted(keys[order], values[order])
+
+
+class SpillingReducer:
+    # running int64 key -> value-row sums held in fixed memory: additions are
+    # buffered and folded into a sorted, reduced aggregate; when that outgrows
+    # the cap it is written out as a sorted run and the final read k-way merges
+    # the runs block by block
+    def __init__(self, width, memory_cap=MEMORY_CAP, spill_dir=SPILL_DIR):
+        self.width = width
+        self.memory_cap = memory_cap
+        self.spill_dir = spill_dir
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.values = np.zeros((0, width), dtype=np.int64)
+        self.pending = []
+        self.pending_rows = 0
+        self.runs = []
+        self.tmp = None
+
+    def nbytes(self):
+        return self.keys.nbytes + self.values.nbytes + self.pending_rows * 8 * (self.width + 1)
+
+    def add(self, keys, values):
+        if len(keys) == 0:
+            return
+        values = np.asarray(values, dtype=np.int64).reshape(len(keys), self.width)
+        self.pending.append((np.asarray(keys, dtype=np.int64), values))
+        self.pending_rows += len(keys)
+        if self.pending_rows >= max(COMPACT_ROWS, len(self.keys)) or self.nbytes() > self.memory_cap:
+            self.compact()
+
+    def compact(self):
+        if not self.pending:
+            return
+        keys = np.concatenate([self.keys] + [k for k, _ in self.pending])
+        values = np.concatenate([self.values] + [v for _, v in self.pending])
+        self.pending = []
+        self.pending_rows = 0
+        self.keys, self.values = reduce_keys(keys, values)
+        if self.nbytes() > self.memory_cap:
+            self.spill()
+
+    def spill(self):
+        if self.tmp is None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            self.tmp = tempfile.mkdtemp(prefix='run-', dir=self.spill_dir)
+            # runs only live as long as the reducer
+            weakref.finalize(self, shutil.rmtree, self.tmp, True)
+        path = os.path.join(self.tmp, f'{len(self.runs):05d}')
+        np.save(path + '.keys.npy', self.keys)
+        np.save(path + '.values.npy', self.values)
+        self.runs.append(path)
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.values = np.zeros((0, self.width), dtype=np.int64)
+
+    def blocks(self, block=MERGE_BLOCK):
+        # sorted, fully reduced (keys, values) blocks over memory and every run;
+        # each run is sorted with unique keys, so everything up to the smallest
+        # key ending a current block is final once those blocks are combined
+        self.compact()
+        sources = [(np.load(p + '.keys.npy', mmap_mode='r'), np.load(p + '.values.npy', mmap_mode='r'))
+                   for p in self.runs]
+        sources.append((self.keys, self.values))
+        pos = [0] * len(sources)
+        while True:
+            live = [i for i, (k, _) in enumerate(sources) if pos[i] < len(k)]
+            if not live:
+                return
+            bound = min(sources[i][0][min(pos[i] + block, len(sources[i][0])) - 1] for i in live)
+            ks, vs = [], []
+            for i in live:
+                k, v = sources[i]
+                end = pos[i] + int(np.searchsorted(k[pos[i]:pos[i] + block], bound, side='right'))
+                ks.append(np.asarray(k[pos[i]:end]))
+                vs.append(np.asarray(v[pos[i]:end]))
+                pos[i] = end
+            yield reduce_keys(np.concatenate(ks), np.concatenate(vs))
+
+    def reduced(self):
+        # the whole aggregate as sorted (keys, values); spilled runs are merged
+        # back and removed, so later additions start from the merged state
+        if self.runs:
+            parts = list(self.blocks())
+            self.keys = np.concatenate([k for k, _ in parts]) if parts else np.zeros(0, dtype=np.int64)
+            self.values = np.concatenate([v for _, v in parts]) if parts else np.zeros((0, self.width), dtype=np.int64)
+            for p in self.runs:
+                os.remove(p + '.keys.npy')
+                os.remove(p + '.values.npy')
+            self.runs = []
+        else:
+            self.compact()
+        return self.keys, self.values
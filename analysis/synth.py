@@ -0,0 +1,275 @@
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SYNTH_DIR = os.path.join(BASE_DIR, 'analysis', '.cache', 'synth')
+MANIFEST = 'synth.json'
+SYNTH_VERSION = 1
+# rows per file, like the API pages; files are written in chunks of CHUNK_ROWS
+FILE_ROWS = 1_000_000
+CHUNK_ROWS = 250_000
+FOLDERS = {'demo': 'api_data_aadhar_demographic', 'bio': 'api_data_aadhar_biometric'}
+# per-dataset seed offsets; the geography comes from the shared seed
+DATASET_SEEDS = {'demo': 0, 'bio': 1000}
+# states and UTs, largest first; volumes fall off as a Zipf-Mandelbrot law
+# over this order, roughly as in the API sample
+STATES = (
+    'Andhra Pradesh', 'Maharashtra', 'West Bengal', 'Tamil Nadu', 'Uttar Pradesh', 'Karnataka', 'Bihar',
+    'Gujarat', 'Odisha', 'Kerala', 'Telangana', 'Madhya Pradesh', 'Rajasthan', 'Assam', 'Punjab',
+    'Chhattisgarh', 'Jharkhand', 'Himachal Pradesh', 'Haryana', 'Uttarakhand', 'Jammu and Kashmir', 'Delhi',
+    'Tripura', 'Manipur', 'Goa', 'Meghalaya', 'Arunachal Pradesh', 'Nagaland', 'Mizoram', 'Puducherry',
+    'Chandigarh', 'Sikkim', 'Andaman and Nicobar Islands', 'Ladakh', 'Lakshadweep',
+    'Dadra and Nagar Haveli and Daman and Diu',
+)
+# old names and misspellings seen in the API data
+STATE_ALIASES = {
+    'West Bengal': ['Westbengal', 'West Bangal', 'WESTBENGAL', 'West  Bengal'],
+    'Odisha': ['Orissa', 'ODISHA'],
+    'Puducherry': ['Pondicherry'],
+    'Andaman and Nicobar Islands': ['Andaman & Nicobar Islands'],
+    'Jammu and Kashmir': ['Jammu & Kashmir'],
+    'Dadra and Nagar Haveli and Daman and Diu': ['Dadra & Nagar Haveli', 'Daman & Diu', 'Daman and Diu'],
+}
+# share of dirty rows by defect
+DEFECTS = {'state': 0.5, 'district': 0.2, 'date': 0.15, 'pincode': 0.1, 'count': 0.05}
+# relative volume by weekday, Monday first
+WEEKDAY = np.array([1.0, 1.05, 1.0, 0.95, 0.9, 0.75, 0.3])
+# mean updates per row by age column: older band first, as in the API files
+COUNT_MEANS = {'demo': (12.0, 1.3), 'bio': (11.0, 8.0)}
+
+
+def parse_count(text):
+    # '1M', '250k', '1B', '1000000' -> rows
+    text = str(text).strip().lower().replace('_', '')
+    scale = {'k': 10 ** 3, 'm': 10 ** 6, 'b': 10 ** 9, 'g': 10 ** 9}.get(text[-1:], 1)
+    try:
+        return int(float(text[:-1] if scale > 1 else text) * scale)
+    except ValueError:
+        raise ValueError(f'invalid row count: {text!r}') from None
+
+
+class Geography:
+    # states -> districts -> pincodes, with the weights rows are drawn by.
+    # Built from the seed alone, so every file of a dataset (and every
+    # worker) sees the same geography
+    def __init__(self, seed=91, states=len(STATES)):
+        rng = np.random.default_rng([seed, 0])
+        names = list(STATES[:states])
+        state_w = 1.0 / (np.arange(1, len(names) + 1) + 4) ** 1.6
+        rows = []
+        for s, (name, w) in enumerate(zip(names, state_w / state_w.max())):
+            n_districts = int(np.clip(round(75 * w ** 0.6 * rng.uniform(0.7, 1.3)), 1, 84))
+            district_w = 1.0 / np.arange(1, n_districts + 1) ** 0.8
+            district_w /= district_w.sum()
+            for d in range(n_districts):
+                n_pins = int(np.clip(rng.lognormal(3.0, 0.8), 1, 150))
+                pin_w = rng.gamma(1.5, size=n_pins)
+                # 6-digit pincodes, one block per state and district
+                pins = 110000 + s * 24000 + d * 280 + np.arange(n_pins)
+                rows.append(pd.DataFrame({'state': s, 'district': f'{name[:3].upper()} District {d + 1:02d}',
+                                          'pincode': pins, 'weight': state_w[s] * district_w[d] * pin_w / pin_w.sum()}))
+        self.states = names
+        self.pins = pd.concat(rows, ignore_index=True)
+        self.p = self.pins['weight'].to_numpy() / self.pins['weight'].sum()
+        self.cdf = np.cumsum(self.p)
+        state = np.array(names, dtype=object)[self.pins['state'].to_numpy()]
+        # 'state,district,pincode' of every leaf, joined once
+        self.location = np.array([f'{s},{d},{p}' for s, d, p in zip(state, self.pins['district'], self.pins['pincode'])],
+                                 dtype=object)
+
+    def __len__(self):
+        return len(self.pins)
+
+
+def day_counts(total, start, days, seed=91):
+    # rows per day: weekday seasonality, a slow upward trend and day-to-day noise
+    rng = np.random.default_rng([seed, 1])
+    dates = pd.date_range(start, periods=days, freq='D')
+    w = WEEKDAY[dates.weekday] * np.linspace(0.8, 1.2, days) * rng.gamma(20, 1 / 20, days)
+    return dates, rng.multinomial(total, w / w.sum())
+
+
+def _dirty_state(name, rng):
+    options = STATE_ALIASES.get(name, []) + [name.lower(), name.upper(), name + ' ', ' ' + name,
+                                             name.replace(' and ', ' & ')]
+    return options[rng.integers(len(options))]
+
+
+def chunk_lines(geo, prefix, dates, cum, lo, hi, seed, dirty):
+    # CSV lines for rows [lo, hi) of the dataset. Rows are in date order, as
+    # the API pages are, so a row's date follows from its offset alone;
+    # within a day rows are ordered by state, district and pincode
+    rng = np.random.default_rng([seed, 2, lo])
+    n = hi - lo
+    day = np.searchsorted(cum, np.arange(lo, hi), side='right')
+    leaf = np.minimum(np.searchsorted(geo.cdf, rng.random(n)), len(geo) - 1)
+    order = np.lexsort((leaf, day))
+    day, leaf = day[order], leaf[order]
+    older, younger = COUNT_MEANS[prefix]
+    # negative binomial: mostly small counts with a long tail
+    a = rng.negative_binomial(1.0, 1.0 / (1.0 + older), n).astype(object)
+    b = rng.negative_binomial(0.5, 0.5 / (0.5 + younger), n).astype(object)
+    date = np.array(dates.strftime('%d-%m-%Y'), dtype=object)[day]
+    location = geo.location[leaf]
+    bad = np.flatnonzero(rng.random(n) < dirty)
+    if len(bad):
+        kinds = rng.choice(list(DEFECTS), len(bad), p=np.array(list(DEFECTS.values())) / sum(DEFECTS.values()))
+        state = geo.pins['state'].to_numpy()
+        district = geo.pins['district'].to_numpy()
+        pins = geo.pins['pincode'].to_numpy()
+        for i, kind in zip(bad, kinds):
+            j = leaf[i]
+            name = geo.states[state[j]]
+            if kind == 'state':
+                location[i] = f'{_dirty_state(name, rng)},{district[j]},{pins[j]}'
+            elif kind == 'district':
+                location[i] = f'{name},{["", district[j].lower(), district[j].upper()][rng.integers(3)]},{pins[j]}'
+            elif kind == 'pincode':
+                location[i] = f'{name},{district[j]},'
+            elif kind == 'date':
+                date[i] = ['', dates[day[i]].strftime('%Y-%m-%d'), '31-02-2025'][rng.integers(3)]
+            else:
+                a[i] = ['', 'NA'][rng.integers(2)]
+    return [f'{d},{loc},{y},{o}' for d, loc, y, o in zip(date, location, b, a)]
+
+
+def header(prefix):
+    return f'date,state,district,pincode,{prefix}_age_5_17,{prefix}_age_17_\n'
+
+
+def write_file(path, prefix, geo, dates, cum, lo, hi, seed, dirty):
+    # one API page: the header, then rows [lo, hi) written chunk by chunk
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(header(prefix))
+        for start in range(lo, hi, CHUNK_ROWS):
+            f.write('\n'.join(chunk_lines(geo, prefix, dates, cum, start, min(hi, start + CHUNK_ROWS), seed, dirty)))
+            f.write('\n')
+    os.replace(tmp, path)
+    return hi - lo
+
+
+_geo = {}
+
+
+def _write_task(task):
+    # worker: the geography is rebuilt once per process from the seed
+    path, prefix, config, lo, hi = task
+    key = (config['seed'], config['states'])
+    if key not in _geo:
+        _geo[key] = Geography(config['seed'], config['states'])
+    # both datasets share the geography; each draws its own days and rows
+    seed = config['seed'] + DATASET_SEEDS[prefix]
+    dates, counts = day_counts(config['rows'], config['start'], config['days'], seed)
+    return write_file(path, prefix, _geo[key], dates, np.cumsum(counts), lo, hi, seed, config['dirty'])
+
+
+def _pages(prefix, rows, file_rows):
+    # file names of a dataset's pages, named by record offset like the API's
+    return [f'{FOLDERS[prefix]}_{lo}_{min(rows, lo + file_rows)}.csv' for lo in range(0, rows, file_rows)]
+
+
+def _read_manifest(folder, prefix):
+    # (config, files, complete) of the synth run that wrote folder, or None
+    # if synth.py did not write it. Manifests before the file list was kept
+    # are plain configs; their files follow from the config
+    path = os.path.join(folder, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    if 'config' not in manifest:
+        return manifest, _pages(prefix, manifest['rows'], manifest['file_rows']), True
+    return manifest['config'], manifest['files'], manifest['complete']
+
+
+def _write_manifest(folder, config, files, complete):
+    path = os.path.join(folder, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'config': config, 'files': files, 'complete': complete}, f)
+    os.replace(path + '.tmp', path)
+
+
+def generate(out_dir=SYNTH_DIR, rows=1_000_000, datasets=('demo', 'bio'), seed=91, start='2025-03-01', days=300,
+             states=len(STATES), dirty=0.001, file_rows=FILE_ROWS, workers=1):
+    # writes each dataset's API pages under out_dir/<API folder>/ and returns
+    # ({prefix: folder}, rows written). A folder whose manifest matches the
+    # request is kept as it is, so benchmarks can reuse generated data. Only
+    # the files a previous synth manifest lists are ever removed: the folders
+    # share their names with the real extracts, so a non-empty folder without
+    # a manifest is refused rather than cleared
+    config = {'version': SYNTH_VERSION, 'rows': int(rows), 'seed': seed, 'start': str(start), 'days': days,
+              'states': states, 'dirty': dirty, 'file_rows': file_rows}
+    folders, stale = {}, {}
+    for prefix in datasets:
+        folder = os.path.join(out_dir, FOLDERS[prefix])
+        folders[prefix] = folder
+        manifest = _read_manifest(folder, prefix)
+        if manifest is None:
+            if os.path.isdir(folder) and os.listdir(folder):
+                raise ValueError(f'{folder} holds files synth.py did not write (no {MANIFEST}); '
+                                 f'refusing to write synthetic pages there')
+            stale[prefix] = []
+        elif manifest[0] != config or not manifest[2]:
+            stale[prefix] = manifest[1]
+    tasks = []
+    for prefix, old in stale.items():
+        folder = folders[prefix]
+        os.makedirs(folder, exist_ok=True)
+        pages = _pages(prefix, config['rows'], file_rows)
+        # listed before writing, so an interrupted run is cleaned up by the next
+        _write_manifest(folder, config, sorted(set(old) | set(pages)), False)
+        for name in old:
+            if os.path.exists(os.path.join(folder, name)):
+                os.remove(os.path.join(folder, name))
+        for name, lo in zip(pages, range(0, config['rows'], file_rows)):
+            tasks.append((os.path.join(folder, name), prefix, config, lo, min(config['rows'], lo + file_rows)))
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(_write_task, tasks))
+    else:
+        for task in tasks:
+            _write_task(task)
+    for prefix in stale:
+        _write_manifest(folders[prefix], config, _pages(prefix, config['rows'], file_rows), True)
+    return folders, sum(hi - lo for _, _, _, lo, hi in tasks)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write seeded synthetic Aadhaar API pages.')
+    parser.add_argument('--rows', type=parse_count, default=1_000_000, help='rows per dataset, e.g. 1M, 250M, 1B')
+    parser.add_argument('--out', default=SYNTH_DIR)
+    parser.add_argument('--datasets', default='demo,bio')
+    parser.add_argument('--seed', type=int, default=91)
+    parser.add_argument('--start', default='2025-03-01')
+    parser.add_argument('--days', type=int, default=300)
+    parser.add_argument('--states', type=int, default=len(STATES), help=f'number of states (up to {len(STATES)})')
+    parser.add_argument('--dirty', type=float, default=0.001, help='share of rows with a defect')
+    parser.add_argument('--file-rows', type=parse_count, default=FILE_ROWS)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+    datasets = [d.strip() for d in args.datasets.split(',') if d.strip()]
+    unknown = set(datasets) - set(FOLDERS)
+    if unknown:
+        sys.exit(f'unknown datasets: {", ".join(sorted(unknown))} (expected demo, bio)')
+    t0 = time.perf_counter()
+    try:
+        folders, written = generate(args.out, args.rows, datasets, args.seed, args.start, args.days, args.states,
+                                    args.dirty, args.file_rows, args.workers)
+    except ValueError as e:
+        sys.exit(str(e))
+    elapsed = time.perf_counter() - t0
+    for prefix, folder in folders.items():
+        size = sum(os.path.getsize(os.path.join(folder, f)) for f in os.listdir(folder))
+        print(f'{prefix}: {args.rows:,} rows, {size / 2 ** 20:.0f} MB in {folder}')
+    if written:
+        print(f'{elapsed:.1f}s ({written / max(elapsed, 1e-9):,.0f} rows/s)')
+    else:
+        print('already generated with these settings')
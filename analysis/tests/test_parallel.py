@@ -0,0 +1,12 @@
+import os
+import sys
+
+# the analysis scripts import each other by bare module name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parallel import check
+
+
+def test_parallel_matches_serial():
+    # byte-range (CSV) and row-range (cache) splits give the serial results
+    assert check() == []